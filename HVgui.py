@@ -1,28 +1,170 @@
 #!/usr/bin/env python3
 """
 Enhanced GUI for CAEN Desktop High Voltage Power Supply using CAENpy library
+
+The window comes up before CAENpy, numpy and the plotting, recording and
+sequence modules are imported: they are loaded on a helper thread once the
+window is shown (see preload()), and imported where used in case they are
+needed before that thread got to them.
 """
 import tkinter as tk
-from tkinter import ttk, messagebox, scrolledtext
+from tkinter import ttk, messagebox, scrolledtext, filedialog
+import argparse
+import functools
+import importlib
+import logging
+import os
+import queue
 import threading
 import time
 import re
 
-# Import the CAEN Desktop HV library 
-from CAENpy.CAENDesktopHighVoltagePowerSupply import CAENDesktopHighVoltagePowerSupply
+from hv_readout import ReadAborted
+from hv_devices import DeviceManager, PollSettings, TRANSPORTS, check_setpoint
+from hv_client import DEFAULT_ADDRESS as DEFAULT_DAEMON_ADDRESS
+from hv_metrics import Metrics
+from hv_diagnostics import DiagnosticsPanel
+from hv_ramp import RampEngine, LIMIT_HOLD, LIMIT_ABORT, DONE as RAMP_DONE, ABORTED as RAMP_ABORTED
+from hv_burst import BurstTrigger
+from hv_groups import ChannelGroups, bulk_write
+from hv_profiles import ProfileStore, apply_profile, capture as capture_profile
+from hv_alarm import AlarmEngine, load_rules, dispatch_alarms, ACTION_LOG as ALARM_LOG
+from hv_log import LogPanel, get_logger, start_logging
+from hv_display import DisplayModel, channel_cells
+
+# Auto refresh period and the bounds it may adapt within on a slow link (seconds)
+POLL_INTERVAL = 2.0
+POLL_MIN_INTERVAL = 0.5
+POLL_MAX_INTERVAL = 10.0
+
+# Faster period used while any channel is ramping
+POLL_RAMP_INTERVAL = 0.5
+
+# Where readings are recorded when "Record to disk" is ticked
+RECORD_DIR = os.path.join(os.path.expanduser("~"), "hv_data")
+
+# How often setpoints, limits and ramp rates are read back when nothing was written
+SETPOINT_READ_PERIOD = 30.0
+
+# Alarm rules loaded at start when the file exists, see hv_alarm
+ALARM_RULES = os.path.join(RECORD_DIR, "alarms.json")
+
+# Channel groups, loaded at start when the file exists and saved on every change
+CHANNEL_GROUPS = os.path.join(RECORD_DIR, "groups.json")
+
+# Setpoint profiles, one file per supply, see hv_profiles
+PROFILE_DIR = os.path.join(RECORD_DIR, "profiles")
+
+# Where triggered bursts are saved, see hv_burst
+BURST_DIR = os.path.join(RECORD_DIR, "bursts")
+
+# Channel combo box entries naming a group start with this
+GROUP_PREFIX = "group: "
+
+# Imported on a helper thread once the window is shown, see preload()
+PRELOAD_MODULES = ("numpy", "hv_history", "hv_recorder", "hv_rollup", "hv_plot", "hv_sequence")
+
+# Device library of each transport, preloaded too
+TRANSPORT_MODULES = {"caenpy": "CAENpy.CAENDesktopHighVoltagePowerSupply",
+                     "asyncio": "hv_transport"}
 
 
 class CAENDesktopGUI:
-    def __init__(self, root):
+    def __init__(self, root, transport="caenpy", alarm_rules=None):
         self.root = root
         self.root.title("CAEN Desktop High Voltage Power Supply Control")
         self.root.geometry("900x900")
         
-        self.hv = None
+        self.plot_window = None
+        self.plot = None
+        self.plot_offsets = {}
+        self.diagnostics_window = None
         self.monitoring = False
         self.channel_widgets = {}
-        self.num_channels = 4  # Will be updated after connection
+        # Column headers of the channel table, built with the first row
+        self.channel_header = None
+        # Entries of the channel combo box -> (device, channel)
+        self.channel_choices = {}
+        self.groups = ChannelGroups()
+        self.profiles = ProfileStore(PROFILE_DIR)
+        self.display = DisplayModel()
+
+        self.logger = get_logger()
+        if self.logger.level == logging.NOTSET:
+            self.logger.setLevel(logging.INFO)
+
+        # Each device has its own I/O worker, results come back through ui_calls
+        self.ui_calls = queue.Queue()
+        settings = PollSettings(interval=POLL_INTERVAL, min_interval=POLL_MIN_INTERVAL,
+                                max_interval=POLL_MAX_INTERVAL, ramp_interval=POLL_RAMP_INTERVAL,
+                                setpoint_period=SETPOINT_READ_PERIOD)
+        # Rules run on the device workers, see hv_alarm
+        self.alarms = AlarmEngine()
+        # Latency of every supply command and poll cycle, see the diagnostics panel
+        self.metrics = Metrics()
+        # Off until enabled in the Bursts dialog
+        self.bursts = BurstTrigger(directory=BURST_DIR, enabled=False)
+        self.devices = DeviceManager(self.call_in_ui, self.root.after, self.root.after_cancel,
+                                     settings, on_snapshot=self.apply_snapshot,
+                                     on_poll_error=self._on_refresh_error,
+                                     transport=transport, alarms=self.alarms,
+                                     on_alarm=self._on_alarm, on_link=self._on_link,
+                                     metrics=self.metrics, bursts=self.bursts,
+                                     on_burst=self._on_burst)
+        self.ramps = RampEngine(on_progress=self._on_ramp_progress,
+                                on_finished=self._on_ramp_finished)
+        self.sequence = None
         self.setup_gui()
+        self.process_ui_calls()
+        # Idle callbacks run in order, the window is drawn before this one
+        preload = PRELOAD_MODULES + tuple(m for m in [TRANSPORT_MODULES.get(transport)] if m)
+        self.root.after_idle(self.preload, preload)
+        if alarm_rules or os.path.exists(ALARM_RULES):
+            self.load_alarm_rules(alarm_rules or ALARM_RULES)
+        if os.path.exists(CHANNEL_GROUPS):
+            try:
+                self.groups = ChannelGroups.load(CHANNEL_GROUPS)
+            except (OSError, ValueError, TypeError, AttributeError) as e:
+                self.log(f"Cannot load channel groups from {CHANNEL_GROUPS}: {e}", logging.ERROR)
+            self.update_channel_choices()
+
+    def preload(self, modules):
+        """Import modules on a helper thread, so the first connect or plot does not wait
+
+        A module that fails to import is left to fail where it is used.
+        """
+        def run():
+            started = time.monotonic()
+            for name in modules:
+                try:
+                    importlib.import_module(name)
+                except ImportError as e:
+                    self.log(f"Preloading {name} failed: {e}", logging.DEBUG)
+            self.log(f"Preloaded {len(modules)} modules in {time.monotonic() - started:.2f} s",
+                     logging.DEBUG)
+
+        threading.Thread(target=run, name="hv-preload", daemon=True).start()
+
+    @property
+    def connected(self):
+        return bool(self.devices.connected)
+
+    def call_in_ui(self, func, *args):
+        """Run func(*args) on the Tk thread, safe to call from any thread"""
+        self.ui_calls.put((func, args))
+
+    def process_ui_calls(self):
+        """Run the calls queued by other threads"""
+        while True:
+            try:
+                func, args = self.ui_calls.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                func(*args)
+            except Exception as e:
+                self.log(f"UI callback error: {e}", logging.ERROR)
+        self.root.after(20, self.process_ui_calls)
         
     def setup_gui(self):
         """Setup the GUI elements"""
@@ -38,7 +180,7 @@ class CAENDesktopGUI:
         ttk.Label(conn_frame, text="Connection Type:").grid(row=0, column=2, sticky="w", padx=(10,0))
         self.conn_type_var = tk.StringVar(value="USB")
         conn_combo = ttk.Combobox(conn_frame, textvariable=self.conn_type_var, 
-                                 values=["USB", "Ethernet"], 
+                                 values=["USB", "Ethernet", "Daemon"], 
                                  width=8, state="readonly")
         conn_combo.grid(row=0, column=3, padx=5)
         conn_combo.bind("<<ComboboxSelected>>", self.on_conn_type_change)
@@ -47,11 +189,24 @@ class CAENDesktopGUI:
         self.device_var = tk.StringVar(value="0")
         ttk.Entry(conn_frame, textvariable=self.device_var, width=5).grid(row=0, column=5, padx=5)
         
-        self.connect_btn = ttk.Button(conn_frame, text="Connect", command=self.toggle_connection)
+        self.connect_btn = ttk.Button(conn_frame, text="Connect", command=self.connect)
         self.connect_btn.grid(row=0, column=6, padx=10)
         
         self.status_label = ttk.Label(conn_frame, text="Disconnected", foreground="red")
         self.status_label.grid(row=0, column=7, padx=10)
+
+        # Connected devices, each one can be disconnected on its own
+        ttk.Label(conn_frame, text="Devices:").grid(row=1, column=0, sticky="w", pady=(5,0))
+        self.device_select_var = tk.StringVar(value="")
+        self.device_combo = ttk.Combobox(conn_frame, textvariable=self.device_select_var,
+                                         values=[], width=30, state="readonly")
+        self.device_combo.grid(row=1, column=1, columnspan=3, sticky="w", padx=5, pady=(5,0))
+        ttk.Button(conn_frame, text="Disconnect",
+                   command=self.disconnect).grid(row=1, column=4, columnspan=2, pady=(5,0))
+        ttk.Button(conn_frame, text="Disconnect All",
+                   command=self.disconnect_all).grid(row=1, column=6, padx=10, pady=(5,0))
+        ttk.Button(conn_frame, text="Profiles...",
+                   command=self.open_profiles).grid(row=1, column=7, padx=10, pady=(5,0))
         
         # Device Info Frame
         info_frame = ttk.LabelFrame(self.root, text="Device Information", padding="5")
@@ -86,6 +241,28 @@ class CAENDesktopGUI:
         ttk.Button(refresh_frame, text="All Channels OFF", 
                   command=self.all_channels_off).pack(side="left", padx=10)
 
+        ttk.Button(refresh_frame, text="Live Plot",
+                  command=self.open_plot).pack(side="left", padx=10)
+
+        # Stream every reading to RECORD_DIR
+        self.record_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(refresh_frame, text="Record to disk", variable=self.record_var,
+                        command=self.on_record_toggle).pack(side="left", padx=10)
+
+        ttk.Button(refresh_frame, text="Export...",
+                  command=self.open_export).pack(side="left", padx=10)
+
+        ttk.Button(refresh_frame, text="Diagnostics",
+                  command=self.open_diagnostics).pack(side="left", padx=10)
+
+        ttk.Button(refresh_frame, text="Bursts...",
+                  command=self.open_bursts).pack(side="left", padx=10)
+
+        ttk.Button(refresh_frame, text="Alarm Rules...",
+                   command=self.choose_alarm_rules).pack(side="left", padx=10)
+        self.alarm_label = ttk.Label(refresh_frame, text="No alarm rules")
+        self.alarm_label.pack(side="left", padx=5)
+
         # Add monitoring status indicator
         #status_frame = ttk.Frame(refresh_frame)
         #status_frame.grid(row=0, column=3, sticky="ew", padx=5)
@@ -102,10 +279,12 @@ class CAENDesktopGUI:
         
         # Channel selection
         ttk.Label(param_frame, text="Channel:").grid(row=0, column=0, sticky="w")
-        self.channel_var = tk.StringVar(value="0")
+        self.channel_var = tk.StringVar(value="")
         self.channel_combo = ttk.Combobox(param_frame, textvariable=self.channel_var, 
-                                         values=["0"], width=5, state="readonly")
+                                         values=[], width=16, state="readonly")
         self.channel_combo.grid(row=0, column=1, padx=5)
+        ttk.Button(param_frame, text="Groups...",
+                   command=self.open_groups).grid(row=0, column=2, sticky="w", padx=5)
         
         # Parameter selection
         ttk.Label(param_frame, text="Parameter:").grid(row=1, column=0, sticky="w", pady=(5,0))
@@ -148,6 +327,39 @@ class CAENDesktopGUI:
         self.ramp_btn = ttk.Button(ramp_frame, text="Ramp Voltage", 
                                   command=self.ramp_voltage, state="disabled")
         self.ramp_btn.grid(row=0, column=6, padx=10)
+
+        # IMON limit, blank for none
+        ttk.Label(ramp_frame, text="IMON limit:").grid(row=1, column=0, sticky="w", pady=(5,0))
+        self.ramp_limit_var = tk.StringVar(value="")
+        ttk.Entry(ramp_frame, textvariable=self.ramp_limit_var, width=10).grid(row=1, column=1, padx=5, pady=(5,0))
+        ttk.Label(ramp_frame, text="A").grid(row=1, column=2, sticky="w", pady=(5,0))
+
+        ttk.Label(ramp_frame, text="On limit:").grid(row=1, column=3, sticky="w", padx=(10,0), pady=(5,0))
+        self.ramp_action_var = tk.StringVar(value=LIMIT_HOLD)
+        ttk.Combobox(ramp_frame, textvariable=self.ramp_action_var, values=[LIMIT_HOLD, LIMIT_ABORT],
+                     width=8, state="readonly").grid(row=1, column=4, padx=5, pady=(5,0))
+
+        self.ramp_all_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(ramp_frame, text="All channels of device",
+                        variable=self.ramp_all_var).grid(row=1, column=5, columnspan=2, sticky="w", pady=(5,0))
+
+        ramp_buttons = ttk.Frame(ramp_frame)
+        ramp_buttons.grid(row=2, column=0, columnspan=7, sticky="w", pady=(5,0))
+        ttk.Button(ramp_buttons, text="Pause", command=self.pause_ramps).pack(side="left", padx=2)
+        ttk.Button(ramp_buttons, text="Resume", command=self.resume_ramps).pack(side="left", padx=2)
+        ttk.Button(ramp_buttons, text="Abort Ramps", command=self.abort_ramps).pack(side="left", padx=2)
+        self.ramp_status_label = ttk.Label(ramp_buttons, text="No ramps running")
+        self.ramp_status_label.pack(side="left", padx=10)
+
+        # IV scans and conditioning recipes
+        sequence_frame = ttk.Frame(ramp_frame)
+        sequence_frame.grid(row=3, column=0, columnspan=7, sticky="w", pady=(5,0))
+        ttk.Button(sequence_frame, text="Run Sequence...",
+                   command=self.run_sequence).pack(side="left", padx=2)
+        ttk.Button(sequence_frame, text="Stop Sequence",
+                   command=self.stop_sequence).pack(side="left", padx=2)
+        self.sequence_status_label = ttk.Label(sequence_frame, text="No sequence running")
+        self.sequence_status_label.pack(side="left", padx=10)
         
         # Quick presets frame
         preset_frame = ttk.LabelFrame(self.root, text="Quick Presets", padding="10")
@@ -179,16 +391,26 @@ class CAENDesktopGUI:
         
         self.log_text = scrolledtext.ScrolledText(log_frame, height=6, width=70)
         self.log_text.pack(fill="both", expand=True)
-        
+        self.log_panel = LogPanel(self.log_text)
+        self.logger.addHandler(self.log_panel)
+
+        log_buttons = ttk.Frame(log_frame)
+        log_buttons.pack(pady=5)
+
         # Clear log button
-        ttk.Button(log_frame, text="Clear Log", command=self.clear_log).pack(pady=5)
+        ttk.Button(log_buttons, text="Clear Log", command=self.clear_log).pack(side="left", padx=5)
+
+        # Per-update messages are only shown when asked for
+        self.debug_log_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(log_buttons, text="Show Debug", variable=self.debug_log_var,
+                        command=self.on_debug_log_toggle).pack(side="left", padx=5)
 
 
     def on_auto_refresh_toggle(self):
         """Called when auto refresh checkbox is toggled"""
         if self.auto_refresh_var.get():
             self.log("Auto refresh enabled")
-            if self.hv and not self.monitoring:
+            if self.connected and not self.monitoring:
                 self.monitoring = True
                 self.monitor_channels()  # Start monitoring if not already running
         else:
@@ -197,75 +419,270 @@ class CAENDesktopGUI:
             self.monitor_channels()
 
         
+    def on_record_toggle(self):
+        """Start or stop recording readings to disk"""
+        for device in self.devices.connected:
+            if self.record_var.get():
+                self.start_recording(device)
+            else:
+                self.stop_recording(device)
+
+    def start_recording(self, device):
+        if device.recorder is None:
+            device.start_recording(RECORD_DIR)
+            # Daemon devices are recorded by the daemon
+            if device.recorder is not None:
+                self.log(f"Recording {device.label} readings to {device.recorder.directory}")
+
+    def stop_recording(self, device):
+        if device.recorder is not None:
+            written = device.stop_recording()
+            self.log(f"Recording of {device.label} stopped, {written} records written")
+
+    def open_plot(self):
+        """Open the VMON/IMON strip chart of the recorded history"""
+        from hv_plot import StripChart
+        from hv_rollup import read_rollup
+        if not self.connected:
+            messagebox.showerror("Error", "Not connected to device")
+            return
+        if self.plot_window is not None:
+            self.plot_window.lift()
+            return
+        series = []
+        archives = []
+        self.plot_offsets = {}
+        for device in self.devices.connected:
+            self.plot_offsets[device] = len(series)
+            series.extend((self.channel_name(device, ch), device.history[ch])
+                          for ch in range(device.num_channels))
+            # Long windows reach back into the recorded rollups, daemon devices record remotely
+            record_dir_name = getattr(device, 'record_dir_name', None)
+            if record_dir_name is None:
+                archives.extend([None] * device.num_channels)
+                continue
+            directory = os.path.join(RECORD_DIR, record_dir_name)
+            archives.extend(functools.partial(read_rollup, directory, ch)
+                            for ch in range(device.num_channels))
+        self.plot_window = tk.Toplevel(self.root)
+        self.plot_window.title("Live Plot")
+        self.plot_window.geometry("800x400")
+        self.plot_window.protocol("WM_DELETE_WINDOW", self.close_plot)
+        self.plot = StripChart(self.plot_window, series, archives)
+        self.plot.pack(fill="both", expand=True)
+
+    def close_plot(self):
+        if self.plot_window is not None:
+            self.plot_window.destroy()
+        self.plot_window = None
+        self.plot = None
+
+    def open_export(self):
+        """Choose recordings, time window and channels to export to CSV, Parquet or HDF5"""
+        from hv_recorder import INDEX_FILE
+        from hv_export import parse_time, channel_list
+        directories = []
+        if os.path.isdir(RECORD_DIR):
+            directories = [name for name in sorted(os.listdir(RECORD_DIR))
+                           if os.path.exists(os.path.join(RECORD_DIR, name, INDEX_FILE))]
+        if not directories:
+            messagebox.showerror("Export", f"No recordings in {RECORD_DIR}")
+            return
+
+        window = tk.Toplevel(self.root)
+        window.title("Export Readings")
+        frame = ttk.Frame(window, padding="10")
+        frame.pack(fill="both", expand=True)
+
+        ttk.Label(frame, text="Recordings:").grid(row=0, column=0, sticky="nw")
+        listbox = tk.Listbox(frame, selectmode="extended", height=min(len(directories), 8),
+                             exportselection=False, width=40)
+        for name in directories:
+            listbox.insert("end", name)
+        listbox.selection_set(0, "end")
+        listbox.grid(row=0, column=1, sticky="ew", pady=2)
+
+        fields = {}
+        for row, (key, label) in enumerate((('start', "Start (YYYY-mm-dd HH:MM:SS):"),
+                                            ('end', "End (blank = up to now):"),
+                                            ('channels', "Channels (e.g. 0,1, blank = all):")),
+                                           start=1):
+            ttk.Label(frame, text=label).grid(row=row, column=0, sticky="w")
+            fields[key] = tk.StringVar()
+            ttk.Entry(frame, textvariable=fields[key], width=25).grid(row=row, column=1,
+                                                                    sticky="w", pady=2)
+        status = ttk.Label(frame, text="")
+        status.grid(row=5, column=0, columnspan=2, sticky="w")
+
+        def start_export():
+            try:
+                t0, t1 = parse_time(fields['start'].get()), parse_time(fields['end'].get())
+                channels = channel_list(fields['channels'].get())
+            except ValueError as e:
+                messagebox.showerror("Export", str(e), parent=window)
+                return
+            selected = [os.path.join(RECORD_DIR, directories[i]) for i in listbox.curselection()]
+            if not selected:
+                return
+            path = filedialog.asksaveasfilename(
+                parent=window, title="Export readings", defaultextension=".csv",
+                filetypes=[("CSV", "*.csv"), ("Parquet", "*.parquet"), ("HDF5", "*.h5")])
+            if not path:
+                return
+            export_btn.config(state="disabled")
+            self.export_readings(selected, path, t0, t1, channels,
+                                 lambda text: status.config(text=text),
+                                 lambda: export_btn.config(state="normal"))
+
+        export_btn = ttk.Button(frame, text="Export...", command=start_export)
+        export_btn.grid(row=6, column=1, sticky="e", pady=5)
+
+    def export_readings(self, directories, path, t0, t1, channels, show, finished):
+        """Export on a helper thread, show(text) reports progress on the Tk thread"""
+        from hv_export import export as export_records, format_for
+        started = time.monotonic()
+
+        def progress(rows):
+            self.call_in_ui(show, f"{rows} records...")
+
+        def run():
+            try:
+                rows = export_records(directories, path, format_for(path), t0, t1, channels,
+                                      progress=progress)
+            except Exception as e:
+                self.call_in_ui(done, None, e)
+                return
+            self.call_in_ui(done, rows, None)
+
+        def done(rows, error):
+            finished()
+            if error is not None:
+                show(f"Export failed: {error}")
+                self.log(f"Export to {path} failed: {error}", logging.ERROR)
+                return
+            show(f"{rows} records written")
+            self.log(f"Exported {rows} records to {path} in {time.monotonic() - started:.1f} s")
+
+        threading.Thread(target=run, name="hv-export", daemon=True).start()
+
+    def open_diagnostics(self):
+        """Open the table of command and poll cycle latencies"""
+        if self.diagnostics_window is not None:
+            self.diagnostics_window.lift()
+            return
+        self.diagnostics_window = tk.Toplevel(self.root)
+        self.diagnostics_window.title("Diagnostics")
+        self.diagnostics_window.geometry("850x400")
+        self.diagnostics_window.protocol("WM_DELETE_WINDOW", self.close_diagnostics)
+        DiagnosticsPanel(self.diagnostics_window, self.metrics).pack(fill="both", expand=True)
+
+    def close_diagnostics(self):
+        if self.diagnostics_window is not None:
+            self.diagnostics_window.destroy()
+        self.diagnostics_window = None
+
     def on_conn_type_change(self, event=None):
         """Update port placeholder when connection type changes"""
         if self.conn_type_var.get() == "USB":
             self.port_var.set("/dev/ttyACM0")
+        elif self.conn_type_var.get() == "Daemon":
+            self.port_var.set(DEFAULT_DAEMON_ADDRESS)
         else:
             self.port_var.set("192.168.1.100")
     
+    def channel_name(self, device, ch):
+        """Channel label, prefixed with the device once there are several"""
+        if len(self.devices.connected) > 1:
+            return f"{device.label} CH{ch}"
+        return f"CH{ch}"
+
     def create_channel_status(self):
-        """Create channel status display after knowing number of channels"""
-        # Clear any existing widgets
-        for widget in self.status_frame.winfo_children():
-            widget.destroy()
-        
-        # Headers
-        headers = ["Channel", "Status", "VSET (V)", "VMON (V)", "ISET (A)", "IMON (A)", "Control"]
-        for i, header in enumerate(headers):
-            label = ttk.Label(self.status_frame, text=header, font=("TkDefaultFont", 9, "bold"))
-            label.grid(row=0, column=i, padx=5, pady=2, sticky="w")
-        
-        # Channel rows
-        for ch in range(self.num_channels):
-            self.channel_widgets[ch] = {}
-            
-            # Channel number
-            ttk.Label(self.status_frame, text=f"CH{ch}").grid(row=ch+1, column=0, padx=5, pady=2)
-            
-            # Status indicator
-            status_label = ttk.Label(self.status_frame, text="OFF", width=8, 
-                                   background="lightgray", relief="sunken")
-            status_label.grid(row=ch+1, column=1, padx=5, pady=2)
-            self.channel_widgets[ch]['status'] = status_label
-            
-            # VSET
-            vset_label = ttk.Label(self.status_frame, text="0.0", width=10, relief="sunken")
-            vset_label.grid(row=ch+1, column=2, padx=5, pady=2)
-            self.channel_widgets[ch]['vset'] = vset_label
-            
-            # VMON
-            vmon_label = ttk.Label(self.status_frame, text="0.0", width=10, relief="sunken")
-            vmon_label.grid(row=ch+1, column=3, padx=5, pady=2)
-            self.channel_widgets[ch]['vmon'] = vmon_label
-            
-            # ISET
-            iset_label = ttk.Label(self.status_frame, text="0.0", width=12, relief="sunken")
-            iset_label.grid(row=ch+1, column=4, padx=5, pady=2)
-            self.channel_widgets[ch]['iset'] = iset_label
-            
-            # IMON
-            imon_label = ttk.Label(self.status_frame, text="0.0", width=12, relief="sunken")
-            imon_label.grid(row=ch+1, column=5, padx=5, pady=2)
-            self.channel_widgets[ch]['imon'] = imon_label
-            
-            # Control buttons
-            control_frame = ttk.Frame(self.status_frame)
-            control_frame.grid(row=ch+1, column=6, padx=5, pady=2, sticky="w")
-            
-            on_btn = ttk.Button(control_frame, text="ON", width=4, state="disabled",
-                              command=lambda c=ch: self.turn_on_channel(c))
-            on_btn.grid(row=0, column=0, padx=2)
-            
-            off_btn = ttk.Button(control_frame, text="OFF", width=4, state="disabled",
-                               command=lambda c=ch: self.turn_off_channel(c))
-            off_btn.grid(row=0, column=1, padx=2)
-            
-            self.channel_widgets[ch]['on_btn'] = on_btn
-            self.channel_widgets[ch]['off_btn'] = off_btn
-        
-        # Update channel combo box
-        self.channel_combo['values'] = [str(i) for i in range(self.num_channels)]
+        """Show a row for every channel of the connected devices
+
+        Only the rows of channels that came or went are built or destroyed,
+        connecting a second supply leaves the rows of the first one alone.
+        """
+        if self.channel_header is None:
+            headers = ["Channel", "Status", "VSET (V)", "VMON (V)", "ISET (A)", "IMON (A)", "Control"]
+            self.channel_header = []
+            for i, header in enumerate(headers):
+                label = ttk.Label(self.status_frame, text=header, font=("TkDefaultFont", 9, "bold"))
+                label.grid(row=0, column=i, padx=5, pady=2, sticky="w")
+                self.channel_header.append(label)
+
+        channels = self.devices.channels()
+        present = set(channels)
+        for key in [key for key in self.channel_widgets if key not in present]:
+            widgets = self.channel_widgets.pop(key)
+            self.display.forget(widgets.values())
+            for name in ('name', 'status', 'vset', 'vmon', 'iset', 'imon', 'controls'):
+                widgets[name].destroy()
+
+        for row, (device, ch) in enumerate(channels, start=1):
+            key = (device, ch)
+            widgets = self.channel_widgets.get(key)
+            if widgets is None:
+                widgets = self.channel_widgets[key] = self.create_channel_row(device, ch)
+                # Switchable while the link answers, see set_channel_controls()
+                state = "normal" if device.online else "disabled"
+                self.display.set(widgets['on_btn'], state=state)
+                self.display.set(widgets['off_btn'], state=state)
+            # Rows below a removed device move up, names gain the device prefix
+            self.display.set(widgets['name'], text=self.channel_name(device, ch))
+            for column, name in enumerate(('name', 'status', 'vset', 'vmon', 'iset', 'imon')):
+                widgets[name].grid(row=row, column=column, padx=5, pady=2)
+            widgets['controls'].grid(row=row, column=6, padx=5, pady=2, sticky="w")
+
+        self.update_channel_choices()
+
+    def create_channel_row(self, device, ch):
+        """Widgets of one channel row, gridded by create_channel_status()"""
+        widgets = {}
+        # Channel name, set by create_channel_status()
+        widgets['name'] = ttk.Label(self.status_frame)
+
+        # Status indicator
+        widgets['status'] = ttk.Label(self.status_frame, text="OFF", width=8,
+                                      background="lightgray", relief="sunken")
+
+        # VSET, VMON, ISET, IMON
+        for name, width in (('vset', 10), ('vmon', 10), ('iset', 12), ('imon', 12)):
+            widgets[name] = ttk.Label(self.status_frame, text="0.0", width=width, relief="sunken")
+
+        # Control buttons
+        control_frame = ttk.Frame(self.status_frame)
+        widgets['controls'] = control_frame
+
+        on_btn = ttk.Button(control_frame, text="ON", width=4, state="disabled",
+                            command=lambda d=device, c=ch: self.turn_on_channel(d, c))
+        on_btn.grid(row=0, column=0, padx=2)
+
+        off_btn = ttk.Button(control_frame, text="OFF", width=4, state="disabled",
+                             command=lambda d=device, c=ch: self.turn_off_channel(d, c))
+        off_btn.grid(row=0, column=1, padx=2)
+
+        widgets['on_btn'] = on_btn
+        widgets['off_btn'] = off_btn
+        return widgets
+
+    def set_channel_controls(self, device, enabled):
+        """Enable or disable the ON/OFF buttons of every channel of device"""
+        state = "normal" if enabled else "disabled"
+        for (row_device, ch), widgets in self.channel_widgets.items():
+            if row_device is device:
+                self.display.set(widgets['on_btn'], state=state)
+                self.display.set(widgets['off_btn'], state=state)
+
+    def update_channel_choices(self):
+        """Fill the channel combo box with the channels and the channel groups"""
+        self.channel_choices = {self.channel_name(device, ch): (device, ch)
+                                for device, ch in self.devices.channels()}
+        values = list(self.channel_choices)
+        if self.channel_choices:
+            values += [GROUP_PREFIX + name for name in self.groups.names()]
+        self.channel_combo['values'] = values
+        if self.channel_var.get() not in values:
+            self.channel_var.set(next(iter(values), ""))
     
     def on_param_change(self, event=None):
         """Update units label when parameter changes"""
@@ -276,17 +693,9 @@ class CAENDesktopGUI:
         }
         self.units_label.config(text=units.get(param, ""))
     
-    def toggle_connection(self):
-        """Toggle connection state"""
-        if self.hv:
-            self.disconnect()
-        else:
-            self.connect()
-
-
     def set_remote_mode(self):
         """Switch device to remote control mode"""
-        if not self.hv:
+        if not self.connected:
             messagebox.showerror("Error", "Not connected to device")
             return
 
@@ -300,317 +709,690 @@ class CAENDesktopGUI:
             messagebox.showinfo("Success", "Device switched to REMOTE mode")
 
         except Exception as e:
-            self.log(f"Failed to set remote mode: {e}")
+            self.log(f"Failed to set remote mode: {e}", logging.ERROR)
             messagebox.showerror("Error", f"Could not set remote mode:\n{str(e)}\n\nPlease use front panel to switch to REMOTE mode")
             
     def connect(self):
-        """Connect to CAEN Desktop HV Power Supply"""
+        """Connect to one more CAEN Desktop HV Power Supply"""
         try:
             port_or_ip = self.port_var.get()
             device_id = int(self.device_var.get()) if self.device_var.get() else None
-            
-            self.log(f"Connecting to {port_or_ip} (Device ID: {device_id}) using {self.conn_type_var.get()}")
-            
-            if self.conn_type_var.get() == "USB":
-                self.hv = CAENDesktopHighVoltagePowerSupply(port=port_or_ip)
-            else:
-                self.hv = CAENDesktopHighVoltagePowerSupply(ip=port_or_ip)
-            
-            # Get device info
-            device_info = self.hv.idn
-            self.num_channels = self.hv.channels_count
-            
-            self.device_info_label.config(text=f"{device_info} ({self.num_channels} channels)")
-            self.status_label.config(text="Connected", foreground="green")
-            self.connect_btn.config(text="Disconnect")
-            self.set_btn.config(state="normal")
-            self.ramp_btn.config(state="normal")
-            
-            # Create channel status display
-            self.create_channel_status()
-            
-            # Enable control buttons
-            for ch in range(self.num_channels):
-                self.channel_widgets[ch]['on_btn'].config(state="normal")
-                self.channel_widgets[ch]['off_btn'].config(state="normal")
-            
-            self.log(f"Connected successfully! Device: {device_info}")
+            device = self.devices.add(self.conn_type_var.get(), port_or_ip, device_id)
+        except ValueError as e:
+            messagebox.showerror("Connection Error", str(e))
+            return
 
+        self.log(f"Connecting {device.label} to {port_or_ip} (Device ID: {device_id}) using {self.conn_type_var.get()}")
+        self.status_label.config(text="Connecting...", foreground="orange")
+        device.connect(on_done=self._on_connected,
+                       on_error=lambda e: self._on_connect_failed(device, e))
 
-            # After successful connection, try to set remote mode
-            # self.set_remote_mode()
-            
-            # Start monitoring
-            self.monitoring = True
-            self.monitor_channels()
-            
-        except Exception as e:
-            messagebox.showerror("Connection Error", f"Failed to connect:\n{str(e)}")
-            self.log(f"Connection failed: {e}")
-    
-    def disconnect(self):
-        """Disconnect from CAEN Desktop HV Power Supply"""
-        # Stop monitoring
-        self.monitoring = False
-        
-        if self.hv:
-            # Close connection if the library supports it
-            if hasattr(self.hv, 'close'):
-                self.hv.close()
-            self.hv = None
-        
-        self.device_info_label.config(text="Not connected")
-        self.status_label.config(text="Disconnected", foreground="red")
-        self.connect_btn.config(text="Connect")
-        self.set_btn.config(state="disabled")
-        self.ramp_btn.config(state="disabled")
-        
-        # Disable control buttons and reset displays
-        for ch in range(self.num_channels):
-            if ch in self.channel_widgets:
-                widgets = self.channel_widgets[ch]
-                widgets['on_btn'].config(state="disabled")
-                widgets['off_btn'].config(state="disabled")
-                widgets['status'].config(text="OFF", background="lightgray")
-                widgets['vset'].config(text="")
-                widgets['vmon'].config(text="")
-                widgets['iset'].config(text="")
-                widgets['imon'].config(text="")
-        
-        self.log("Disconnected")
+    def _on_connected(self, device):
+        """Finish connecting once the device's worker has opened it"""
+        self.close_plot()
+        if self.record_var.get():
+            self.start_recording(device)
 
+        self.update_device_info()
+        self.set_btn.config(state="normal")
+        self.ramp_btn.config(state="normal")
 
+        # Create channel status display
+        self.create_channel_status()
 
+        self.log(f"Connected successfully! {device.label}: {device.idn}")
+        self.apply_connect_profile(device)
 
-    def monitor_channels(self):
-        """Monitor all channels continuously"""
-        print(self.monitoring,self.hv)
-        if not self.monitoring or not self.hv:
-            # Update status indicator
-            if hasattr(self, 'monitoring_status_label'):
-                self.monitoring_status_label.config(text="Stopped", foreground="red")
+        # After successful connection, try to set remote mode
+        # self.set_remote_mode()
+
+        # Start monitoring
+        self.monitoring = True
+        self.monitor_channels()
+
+    def apply_connect_profile(self, device):
+        """Apply the profile chosen for this supply on connect, if any"""
+        try:
+            name = self.profiles.on_connect(device.idn)
+        except (OSError, ValueError) as e:
+            self.log(f"Cannot read the profiles of {device.label}: {e}", logging.ERROR)
+            return
+        if name:
+            self.apply_profile(device, name)
+
+    def apply_profile(self, device, name):
+        """Write the setpoints of a profile that differ from the device's"""
+        try:
+            apply_profile(device, self.profiles.get(device.idn, name),
+                          on_done=lambda results: self._on_profile_applied(device, name, results),
+                          on_error=lambda e: self.log(f"Profile {name} on {device.label} "
+                                                      f"failed: {e}", logging.ERROR))
+        except (OSError, ValueError) as e:
+            self.log(f"Cannot apply profile {name} to {device.label}: {e}", logging.ERROR)
+            messagebox.showerror("Error", f"Cannot apply profile {name}:\n{e}")
+
+    def _on_profile_applied(self, device, name, results):
+        changed = sum(1 for result in results.values() if result['changed'])
+        errors = [f"{self.channel_name(device, channel)} {param}: {result['error']}"
+                  for (channel, param), result in sorted(results.items()) if result['error']]
+        self.log(f"Profile {name} on {device.label}: {changed} of {len(results)} setpoints "
+                 f"written, {len(results) - changed} already set")
+        for error in errors:
+            self.log(f"Profile {name}: {error}", logging.ERROR)
+
+    def open_profiles(self):
+        """Save, apply and delete the setpoint profiles of the selected device"""
+        device = next((d for d in self.devices.connected
+                       if d.name == self.device_select_var.get()), None)
+        if device is None:
+            messagebox.showerror("Error", "Not connected to device")
+            return
+        window = tk.Toplevel(self.root)
+        window.title(f"Profiles of {device.label}")
+        frame = ttk.Frame(window, padding="10")
+        frame.pack(fill="both", expand=True)
+
+        ttk.Label(frame, text=device.idn).grid(row=0, column=0, columnspan=4, sticky="w")
+        listbox = tk.Listbox(frame, height=8, width=40)
+        listbox.grid(row=1, column=0, columnspan=4, sticky="nsew", pady=5)
+        ttk.Label(frame, text="Name:").grid(row=2, column=0, sticky="w")
+        name_var = tk.StringVar()
+        ttk.Entry(frame, textvariable=name_var, width=30).grid(row=2, column=1, columnspan=3,
+                                                               sticky="w")
+
+        def fill():
+            listbox.delete(0, "end")
+            on_connect = self.profiles.on_connect(device.idn)
+            for name in self.profiles.names(device.idn):
+                listbox.insert("end", f"{name} (on connect)" if name == on_connect else name)
+
+        def selected(event=None):
+            if listbox.curselection():
+                name_var.set(self.profiles.names(device.idn)[listbox.curselection()[0]])
+
+        def save():
+            name = name_var.get().strip()
+            if not name:
+                messagebox.showerror("Error", "A profile needs a name", parent=window)
                 return
-    
 
-        # Update status indicator
-        if hasattr(self, 'monitoring_status_label'):
-            self.monitoring_status_label.config(text="Running", foreground="green")
+            def read(values):
+                try:
+                    self.profiles.put(device.idn, name, capture_profile(values))
+                except OSError as e:
+                    self.log(f"Cannot save profile {name}: {e}", logging.ERROR)
+                    return
+                self.log(f"Profile {name} saved with the setpoints of {device.label}")
+                if window.winfo_exists():
+                    fill()
 
-        if self.auto_refresh_var.get():
-            # Just call the same refresh function that works manually
-            self.log("Auto refresh: Calling manual refresh function...")
-            self.refresh_status()
+            device.read_setpoints(on_done=read, on_error=lambda e: self.log(
+                f"Cannot read the setpoints of {device.label}: {e}", logging.ERROR))
 
-            
-        # Schedule next update
-        if self.monitoring:
-            self.root.after(2000, self.monitor_channels)  # Update every 2 seconds
+        def apply():
+            if name_var.get().strip():
+                self.apply_profile(device, name_var.get().strip())
 
+        def delete():
+            self.profiles.delete(device.idn, name_var.get().strip())
+            fill()
+
+        def toggle_on_connect():
+            name = name_var.get().strip()
+            try:
+                if self.profiles.on_connect(device.idn) == name:
+                    name = None
+                self.profiles.set_on_connect(device.idn, name)
+            except ValueError as e:
+                messagebox.showerror("Error", str(e), parent=window)
+                return
+            fill()
 
-    def _update_single_channel(self, ch, vset, vmon, iset, imon, status, is_ramping, overcurrent):
-        """Helper method to update a single channel - avoids lambda closure issues"""
-        self.log(f"Auto refresh: Updating display CH{ch} with VSET={vset}")
-        self.update_channel_display(ch, vset, vmon, iset, imon, status, is_ramping, overcurrent)
+        listbox.bind("<<ListboxSelect>>", selected)
+        ttk.Button(frame, text="Save Current", command=save).grid(row=3, column=0, pady=10)
+        ttk.Button(frame, text="Apply", command=apply).grid(row=3, column=1, pady=10)
+        ttk.Button(frame, text="Delete", command=delete).grid(row=3, column=2, pady=10)
+        ttk.Button(frame, text="On Connect", command=toggle_on_connect).grid(row=3, column=3,
+                                                                            pady=10)
+        fill()
 
-    def _update_channel_error(self, ch, error_msg):
-        """Helper method to handle channel errors"""
-        self.log(f"Error reading CH{ch}: {error_msg}")
-        self.update_channel_display(ch, 0, 0, 0, 0, "off", False, False)
+    def _on_connect_failed(self, device, error):
+        self.devices.remove(device)
+        self.update_device_info()
+        messagebox.showerror("Connection Error", f"Failed to connect:\n{str(error)}")
+        self.log(f"Connection failed: {error}", logging.ERROR)
 
-            
-    def update_channel_display(self, ch, vset, vmon, iset, imon, status, is_ramping, overcurrent):
-        """Update channel display with current values"""
-        if ch not in self.channel_widgets:
+    def update_device_info(self):
+        """Show the connected devices in the info frame and the device selector"""
+        connected = self.devices.connected
+        self.update_link_info()
+        if connected:
+            offline = [device.label for device in connected if not device.online]
+            if offline:
+                self.status_label.config(text=f"{len(connected)} connected, link down: "
+                                              f"{', '.join(offline)}", foreground="orange")
+            else:
+                self.status_label.config(text=f"{len(connected)} connected", foreground="green")
+        else:
+            self.status_label.config(text="Disconnected", foreground="red")
+        self.device_combo['values'] = [device.name for device in connected]
+        if self.device_select_var.get() not in self.device_combo['values']:
+            self.device_select_var.set(connected[-1].name if connected else "")
+
+    def update_link_info(self):
+        """Show each device with the state and latency of its link"""
+        connected = self.devices.connected
+        text = "\n".join(f"{device.name}: {device.idn} ({device.num_channels} channels, "
+                         f"{device.link.describe()})" for device in connected)
+        if self.device_info_label.cget("text") != (text or "Not connected"):
+            self.device_info_label.config(text=text or "Not connected")
+
+    def disconnect(self, device=None):
+        """Disconnect one CAEN Desktop HV Power Supply, the selected one by default"""
+        if device is None:
+            device = next((d for d in self.devices.connected
+                           if d.name == self.device_select_var.get()), None)
+            if device is None:
+                return
+
+        self.set_channel_controls(device, False)
+        self.close_plot()
+        self.stop_recording(device)
+        self.ramps.forget(device)
+        if self.sequence is not None:
+            self.sequence.forget(device)
+        self.devices.remove(device)
+
+        # Drop the rows of the device
+        self.create_channel_status()
+        self.update_device_info()
+
+        if not self.connected:
+            self.monitoring = False
+            self.monitor_channels()
+            self.set_btn.config(state="disabled")
+            self.ramp_btn.config(state="disabled")
+
+        self.log(f"Disconnected {device.label}")
+
+    def disconnect_all(self):
+        for device in list(self.devices.connected):
+            self.disconnect(device)
+
+
+
+
+    def monitor_channels(self):
+        """Start or stop periodic polling of every device to match the monitoring state"""
+        if not self.monitoring or not self.connected or not self.auto_refresh_var.get():
+            for device in self.devices:
+                device.stop_polling()
+            self.monitoring_status_label.config(text="Stopped", foreground="red")
             return
 
-        # Add debug logging to see what values we're actually getting
-        self.log(f"Updating CH{ch}: VSET={vset}, VMON={vmon}, Status={status}")
-
-        widgets = self.channel_widgets[ch]
-
-        # Update values
-        if vset is not None:
-            widgets['vset'].config(text=f"{vset:.1f}")
-        if vmon is not None:
-            widgets['vmon'].config(text=f"{vmon:.1f}")
-        if iset is not None:
-            widgets['iset'].config(text=f"{iset:.2e}")
-        if imon is not None:
-            widgets['imon'].config(text=f"{imon:.2e}")
-
-        # Update status
-        if overcurrent:
-            widgets['status'].config(text="OVERCUR", background="red")
-        elif is_ramping:
-            widgets['status'].config(text="RAMPING", background="yellow")
-        elif status == "on":
-            widgets['status'].config(text="ON", background="lightgreen")
+        # Each scheduler keeps a single timer chain however often this is called
+        for device in self.devices.connected:
+            device.start_polling()
+        self.update_monitoring_status()
+
+    def update_monitoring_status(self):
+        """Show the polling periods currently in use"""
+        intervals = [device.poll_interval for device in self.devices.connected
+                     if device.polling]
+        if not intervals:
+            return
+        if max(intervals) - min(intervals) < 0.05:
+            text = f"Running ({intervals[0]:.1f} s)"
         else:
-            widgets['status'].config(text="OFF", background="lightgray")
+            text = f"Running ({min(intervals):.1f}-{max(intervals):.1f} s)"
+        self.monitoring_status_label.config(text=text, foreground="green")
+
+    def update_channel_display(self, key, vset, vmon, iset, imon, status, is_ramping, overcurrent):
+        """Update the row of channel key=(device, ch), only cells that changed are touched"""
+        if key not in self.channel_widgets:
+            return
+
+        # Debug logging to see what values we're actually getting, off by default
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.log(f"Updating {self.channel_name(*key)}: VSET={vset}, VMON={vmon}, Status={status}", logging.DEBUG)
+
+        widgets = self.channel_widgets[key]
+        for cell, options in channel_cells(vset, vmon, iset, imon, status,
+                                           is_ramping, overcurrent).items():
+            self.display.set(widgets[cell], **options)
 
     def refresh_status(self):
         """Manually refresh status"""
-        if not self.hv:
+        if not self.connected:
             messagebox.showerror("Error", "Not connected to device")
             return
 
-        self.log("Refreshing channel status...")
+        self.log("Refreshing channel status...", logging.DEBUG)
 
-        # Perform immediate refresh in a separate thread
-        def refresh_thread():
-            try:
-                for ch in range(self.num_channels):
-                    try:
-                        # Use only the main class methods, avoid channel object properties
-                        vset = self.hv.get_single_channel_parameter('VSET', ch)
-                        vmon = self.hv.get_single_channel_parameter('VMON', ch)
-                        iset_microamps = self.hv.get_single_channel_parameter('ISET', ch)
-                        imon_microamps = self.hv.get_single_channel_parameter('IMON', ch)
-
-                        # Convert currents from microamps to Amperes
-                        iset = iset_microamps * 1e-6
-                        imon = imon_microamps * 1e-6
-
-                        # Get status using the main class method
-                        status_info = self.hv.channel_status(channel=ch)
-                        status = status_info['output']
-                        is_ramping = (status_info['ramping up'] == 'yes' or 
-                                    status_info['ramping down'] == 'yes')
-                        overcurrent = status_info['there was overcurrent'] == 'yes'
-
-                        # Update GUI in main thread
-                        self.root.after(0, lambda c=ch, vs=vset, vm=vmon, ise=iset, 
-                                       im=imon, st=status, ramp=is_ramping, oc=overcurrent: 
-                                       self.update_channel_display(c, vs, vm, ise, im, st, ramp, oc))
-
-                    except Exception as e:
-                        error_msg = str(e)
-                        self.root.after(0, lambda c=ch, err=error_msg: self.log(f"Error reading CH{c}: {err}"))
-
-                # Log completion
-                self.root.after(0, lambda: self.log("Refresh completed"))
+        # Runs now, or right after the cycle already in flight
+        for device in self.devices.connected:
+            device.refresh()
 
-            except Exception as e:
-                error_msg = str(e)
-                self.root.after(0, lambda: self.log(f"Manual refresh error: {error_msg}"))
+    def _on_link(self, device):
+        """A device link went down or came back, the channel rows keep the last good values"""
+        link = device.link
+        if link.up:
+            self.log(f"{device.label} reconnected ({link.reconnects} reconnects)")
+        else:
+            self.log(f"{device.label} {link.describe()}", logging.ERROR)
+        self.set_channel_controls(device, device.online)
+        self.update_device_info()
+
+    def _on_refresh_error(self, device, error):
+        if isinstance(error, ReadAborted):
+            self.log(f"Refresh of {device.label} interrupted by a safety command", logging.WARNING)
+        else:
+            self.log(f"Refresh error on {device.label}: {error}", logging.ERROR)
 
-        threading.Thread(target=refresh_thread, daemon=True).start() 
+    def apply_snapshot(self, device, snapshot):
+        """Show the readings of one refresh cycle of a device"""
+        started = time.perf_counter()
+        if device.recorder is not None and device.recorder.error is not None:
+            self.log(f"Recording error on {device.label}: {device.recorder.error}", logging.ERROR)
+            device.recorder.error = None
+        if self.plot is not None and device in self.plot_offsets:
+            self.plot.add_snapshot(snapshot, self.plot_offsets[device])
+        self.ramps.update(device, snapshot)
+        if self.sequence is not None:
+            self.sequence.update(device, snapshot)
+
+        for reading in snapshot:
+            if reading.errors:
+                self.log(f"Error reading {self.channel_name(device, reading.channel)}: {'; '.join(reading.errors)}", logging.ERROR)
+                continue
+            self.update_channel_display((device, reading.channel), reading.vset, reading.vmon,
+                                        reading.iset, reading.imon, reading.output,
+                                        reading.is_ramping, reading.overcurrent)
+
+        self.update_monitoring_status()
+        self.update_link_info()
+        self.metrics.observe('hv_ui_apply_seconds', time.perf_counter() - started,
+                             device=device.label)
+        self.log(f"Refresh of {device.label} completed ({snapshot.transactions} transactions, "
+                 f"{snapshot.duration * 1000:.0f} ms)", logging.DEBUG)
 
     def all_channels_off(self):
-        """Turn off all channels"""
-        if not self.hv:
+        """Turn off all channels of all devices"""
+        if not self.connected:
             messagebox.showerror("Error", "Not connected to device")
             return
         
         if messagebox.askyesno("Confirm", "Turn OFF all channels?"):
-            for ch in range(self.num_channels):
-                self.turn_off_channel(ch)
+            # Every device's worker sends its OFF ahead of anything queued, in parallel
+            started = time.monotonic()
+            failures = []
+            pending = set(self.devices.emergency_off(
+                on_result=lambda device, results: self._on_all_off(device, results, pending,
+                                                                   failures, started),
+                on_error=lambda device, e: self._on_all_off(device, {'error': e}, pending,
+                                                            failures, started)))
+            self.log(f"All channels OFF sent to {len(pending)} device(s)", logging.WARNING)
+            for device in pending:
+                if getattr(device, 'off_pending', False):
+                    self.log(f"{device.label} {device.link.describe()}, its OFF goes out "
+                             f"as soon as the link is back", logging.ERROR)
+            # No more VSET writes from ramps once the outputs are going off
+            self.ramps.forget(message="all channels off")
+            if self.sequence is not None:
+                for device in self.devices:
+                    self.sequence.forget(device, "all channels off")
+
+    def _on_all_off(self, device, results, pending, failures, started):
+        """Log one device's emergency OFF result, report failures once all answered"""
+        pending.discard(device)
+        elapsed = (time.monotonic() - started) * 1000
+        if 'error' in results:
+            failures.append(f"{device.label}: {results['error']}")
+            self.log(f"All channels OFF failed on {device.label}: {results['error']}", logging.ERROR)
+        else:
+            for ch, result in sorted(results.items()):
+                name = self.channel_name(device, ch)
+                if result['error'] or result['state'] == 'on':
+                    failures.append(f"{name}: {result['error'] or 'still on'}")
+                    self.log(f"Turn OFF {name} failed: {result['error'] or 'still on'}", logging.ERROR)
+                else:
+                    self.log(f"Turn OFF {name}: {result['state']}")
+            self.log(f"{device.label} answered OFF after {elapsed:.0f} ms")
+        if device.connected:
+            device.refresh()
+        if not pending and failures:
+            messagebox.showerror("Error", "Some channels may still be on:\n" + "\n".join(failures))
     
-    def turn_on_channel(self, ch):
+    def turn_on_channel(self, device, ch):
         """Turn on specific channel"""
-        if not self.hv:
+        if not device.connected:
             return
+        name = self.channel_name(device, ch)
 
-        try:
-            # Use the set method directly instead of the property
-            self.hv.channels[ch].set('ON', 0)
-            self.log(f"Turn ON CH{ch}")
-        except Exception as e:
-            self.log(f"Error turning on CH{ch}: {e}")
-            messagebox.showerror("Error", f"Failed to turn on CH{ch}:\n{str(e)}")
+        def on_error(e):
+            self.log(f"Error turning on {name}: {e}", logging.ERROR)
+            messagebox.showerror("Error", f"Failed to turn on {name}:\n{str(e)}")
 
-    def turn_off_channel(self, ch):
+        device.switch(ch, True, on_done=lambda _: self.log(f"Turn ON {name}"), on_error=on_error)
+
+    def turn_off_channel(self, device, ch):
         """Turn off specific channel"""
-        if not self.hv:
+        if not device.connected:
             return
+        name = self.channel_name(device, ch)
 
-        try:
-            # Use the set method directly instead of the property
-            self.hv.channels[ch].set('OFF', 0)
-            self.log(f"Turn OFF CH{ch}")
-        except Exception as e:
-            self.log(f"Error turning off CH{ch}: {e}")
-            messagebox.showerror("Error", f"Failed to turn off CH{ch}:\n{str(e)}")
+        def on_error(e):
+            self.log(f"Error turning off {name}: {e}", logging.ERROR)
+            messagebox.showerror("Error", f"Failed to turn off {name}:\n{str(e)}")
+
+        # OFF is a safety command and jumps ahead of queued writes and reads
+        device.switch(ch, False, on_done=lambda _: self.log(f"Turn OFF {name}"), on_error=on_error)
 
 
     def set_parameter(self):
-        """Set parameter using CAENpy methods"""
-        if not self.hv:
+        """Write the parameter to the selected channel or group and read it back"""
+        if not self.connected:
             messagebox.showerror("Error", "Not connected to device")
             return
 
         try:
-            channel = int(self.channel_var.get())
+            targets = self.selected_targets()
             param = self.param_var.get()
-            value = float(self.value_var.get())
+            # Same limits as the daemon and the profiles, see hv_devices.SETPOINT_LIMITS
+            value = check_setpoint(param, self.value_var.get())
 
-            # Validate ranges
-            if param == "VSET" and (value < 0 or value > 5000):
-                messagebox.showerror("Error", "VSET must be between 0 and 5000V")
-                return
-            if param == "ISET" and (value < 0 or value > 1e-3):
-                messagebox.showerror("Error", "ISET must be between 0 and 1mA")
-                return
-
-            self.log(f"Setting CH{channel} {param} = {value}")
-
-            # Run in thread to avoid GUI freezing
-            def set_param_thread():
-                try:
-                    ch = self.hv.channels[channel]
+            what = self.channel_var.get()
+            self.log(f"Setting {what} {param} = {value}")
 
-                    if param == "ISET":
-                        # Convert Amperes to microamps for ISET
-                        value_microamps = value * 1e6
-                        ch.set(param, value_microamps)
-                    else:
-                        ch.set(param, value)
+            def on_done(results):
+                # Only the written values were read back, no refresh needed
+                errors = []
+                for (device, channel, _), result in sorted(
+                        results.items(), key=lambda item: (item[0][0].label, item[0][1])):
+                    if result['error']:
+                        errors.append(f"{self.channel_name(device, channel)}: {result['error']}")
+                for error in errors:
+                    self.log(f"Error: {error}", logging.ERROR)
+                if errors:
+                    messagebox.showerror("Error", "\n".join(errors[:10]))
+                    return
+                readback = [result['value'] for result in results.values()]
+                if None in readback:
+                    self.log(f"{what} {param} set, not read back yet")
+                else:
+                    self.log(f"{what} {param} set, reads back "
+                             f"{', '.join(sorted({f'{v:g}' for v in readback}))}")
 
-                    self.root.after(0, lambda: self.log(f"Parameter set successfully"))
-                    # Trigger immediate refresh
-                    self.root.after(100, self.refresh_status)
-                except Exception as e:
-                    self.root.after(0, lambda: self.log(f"Error: {e}"))
-                    self.root.after(0, lambda: messagebox.showerror("Error", str(e)))
-
-            threading.Thread(target=set_param_thread, daemon=True).start()
+            bulk_write(targets, [(param, value)], on_done)
 
         except ValueError as e:
             messagebox.showerror("Error", f"Invalid value: {e}")
         except Exception as e:
             messagebox.showerror("Error", str(e))
-            self.log(f"Error: {e}")
+            self.log(f"Error: {e}", logging.ERROR)
 
     
     def ramp_voltage(self):
-        """Ramp voltage using CAENpy ramp_voltage method"""
-        if not self.hv:
+        """Start ramps on the selected channel, or on all channels of its device"""
+        if not self.connected:
             messagebox.showerror("Error", "Not connected to device")
             return
         
         try:
-            channel = int(self.channel_var.get())
-            voltage = float(self.ramp_voltage_var.get())
+            targets = self.selected_targets()
+            voltage = check_setpoint('VSET', self.ramp_voltage_var.get())
             speed = float(self.ramp_speed_var.get())
-            
-            self.log(f"Ramping CH{channel} to {voltage}V at {speed}V/s")
-            
-            def ramp_thread():
-                try:
-                    self.hv.channels[channel].ramp_voltage(voltage, ramp_speed_VperSec=speed)
-                    self.root.after(0, lambda: self.log(f"Voltage ramp completed"))
-                    self.root.after(100, self.refresh_status)
-                except Exception as e:
-                    self.root.after(0, lambda: self.log(f"Ramp error: {e}"))
-                    self.root.after(0, lambda: messagebox.showerror("Error", str(e)))
-            
-            threading.Thread(target=ramp_thread, daemon=True).start()
+            limit = float(self.ramp_limit_var.get()) if self.ramp_limit_var.get().strip() else None
+            if self.ramp_all_var.get():
+                devices = list(dict.fromkeys(device for device, _ in targets))
+                targets = [(device, ch) for device in devices for ch in range(device.num_channels)]
+
+            # The engine follows the ramps from the snapshots, they all run in parallel
+            for device, ch in targets:
+                if self.ramps.find(device, ch) is not None:
+                    self.log(f"{self.channel_name(device, ch)} is already ramping", logging.WARNING)
+                    continue
+                self.ramps.start(device, ch, voltage, speed, imon_limit=limit,
+                                 limit_action=self.ramp_action_var.get())
+                self.log(f"Ramping {self.channel_name(device, ch)} to {voltage}V at {speed}V/s")
+            self.update_ramp_status()
             
         except ValueError as e:
             messagebox.showerror("Error", f"Invalid value: {e}")
         except Exception as e:
             messagebox.showerror("Error", str(e))
+
+    def pause_ramps(self):
+        for ramp in self.ramps.active():
+            self.ramps.pause(ramp)
+
+    def resume_ramps(self):
+        for ramp in self.ramps.active():
+            self.ramps.resume(ramp)
+
+    def abort_ramps(self):
+        self.ramps.abort_all()
+
+    def _on_ramp_progress(self, ramp):
+        self.update_ramp_status()
+
+    def _on_ramp_finished(self, ramp):
+        name = self.channel_name(ramp.device, ramp.channel)
+        if ramp.state == RAMP_DONE:
+            self.log(f"Ramp of {name} reached {ramp.target}V")
+        else:
+            self.log(f"Ramp of {name} {ramp.state}: {ramp.message}",
+                     logging.INFO if ramp.state == RAMP_ABORTED else logging.ERROR)
+        self.update_ramp_status()
+
+    def _on_burst(self, device, burst):
+        self.log(burst.describe() + (f", saved to {burst.path}" if burst.path else ""),
+                 logging.WARNING)
+
+    def open_bursts(self):
+        """Set when a burst is captured"""
+        window = tk.Toplevel(self.root)
+        window.title("Burst Capture")
+        frame = ttk.Frame(window, padding="10")
+        frame.pack(fill="both", expand=True)
+        bursts = self.bursts
+
+        enabled_var = tk.BooleanVar(value=bursts.enabled)
+        ttk.Checkbutton(frame, text="Capture bursts", variable=enabled_var).grid(
+            row=0, column=0, columnspan=3, sticky="w")
+        ttk.Label(frame, text="IMON above:").grid(row=1, column=0, sticky="w", pady=(5,0))
+        imon_var = tk.StringVar(value="" if bursts.imon_threshold is None else
+                                str(bursts.imon_threshold))
+        ttk.Entry(frame, textvariable=imon_var, width=10).grid(row=1, column=1, padx=5, pady=(5,0))
+        ttk.Label(frame, text="A (blank for none)").grid(row=1, column=2, sticky="w", pady=(5,0))
+        overcurrent_var = tk.BooleanVar(value=bursts.overcurrent)
+        ttk.Checkbutton(frame, text="On overcurrent", variable=overcurrent_var).grid(
+            row=2, column=0, columnspan=3, sticky="w", pady=(5,0))
+        ramping_var = tk.BooleanVar(value=bursts.ramping)
+        ttk.Checkbutton(frame, text="On ramp start", variable=ramping_var).grid(
+            row=3, column=0, columnspan=3, sticky="w", pady=(5,0))
+        ttk.Label(frame, text="Capture for:").grid(row=4, column=0, sticky="w", pady=(5,0))
+        post_var = tk.StringVar(value=str(bursts.post_seconds))
+        ttk.Entry(frame, textvariable=post_var, width=10).grid(row=4, column=1, padx=5, pady=(5,0))
+        ttk.Label(frame, text="s after the trigger").grid(row=4, column=2, sticky="w", pady=(5,0))
+        ttk.Label(frame, text="Keep:").grid(row=5, column=0, sticky="w", pady=(5,0))
+        pre_var = tk.StringVar(value=str(bursts.pre_seconds))
+        ttk.Entry(frame, textvariable=pre_var, width=10).grid(row=5, column=1, padx=5, pady=(5,0))
+        ttk.Label(frame, text="s before it").grid(row=5, column=2, sticky="w", pady=(5,0))
+
+        def apply():
+            try:
+                imon = float(imon_var.get()) if imon_var.get().strip() else None
+                post = float(post_var.get())
+                pre = float(pre_var.get())
+            except ValueError as e:
+                messagebox.showerror("Error", f"Invalid value: {e}", parent=window)
+                return
+            bursts.imon_threshold = imon
+            bursts.overcurrent = overcurrent_var.get()
+            bursts.ramping = ramping_var.get()
+            bursts.post_seconds = post
+            bursts.pre_seconds = pre
+            bursts.enabled = enabled_var.get()
+            self.log(f"Burst capture {'on' if bursts.enabled else 'off'}, saved to {BURST_DIR}")
+            window.destroy()
+
+        ttk.Button(frame, text="Apply", command=apply).grid(row=6, column=0, columnspan=3, pady=10)
+
+    def choose_alarm_rules(self):
+        path = filedialog.askopenfilename(title="Open alarm rules",
+                                          filetypes=[("Alarm rules", "*.json"), ("All files", "*")])
+        if path:
+            self.load_alarm_rules(path)
+
+    def load_alarm_rules(self, path):
+        """Replace the alarm rules with those of a JSON file"""
+        try:
+            rules = load_rules(path)
+        except (OSError, ValueError, TypeError) as e:
+            self.log(f"Cannot load alarm rules from {path}: {e}", logging.ERROR)
+            messagebox.showerror("Error", f"Cannot load alarm rules:\n{e}")
+            return
+        self.alarms.set_rules(rules)
+        self.alarm_label.config(text=f"{len(rules)} alarm rules", foreground="black")
+        self.log(f"Loaded {len(rules)} alarm rules from {path}")
+
+    def _on_alarm(self, device, alarms):
+        """Alarms raised by a device worker, which already did its own OFF actions"""
+        dispatch_alarms(alarms, self.devices, self.ramps, self.logger)
+        if self.sequence is not None:
+            for alarm in alarms:
+                if alarm.rule.action != ALARM_LOG:
+                    self.sequence.forget(alarm.device, f"alarm {alarm.rule.name}")
+        self.alarm_label.config(text=f"ALARM: {alarms[-1].message}", foreground="red")
+
+    def run_sequence(self):
+        """Run an IV scan or conditioning recipe from a JSON file"""
+        from hv_sequence import SequenceRunner, load_recipe
+        if not self.connected:
+            messagebox.showerror("Error", "Not connected to device")
+            return
+        if self.sequence is not None and not self.sequence.finished:
+            messagebox.showerror("Error", "A sequence is already running")
+            return
+        path = filedialog.askopenfilename(title="Open recipe",
+                                          filetypes=[("Recipes", "*.json"), ("All files", "*")])
+        if not path:
+            return
+        try:
+            recipe = load_recipe(path)
+            self.sequence = SequenceRunner(recipe, self.devices, self.ramps,
+                                           on_progress=self._on_sequence_progress,
+                                           on_finished=self._on_sequence_finished)
+        except (OSError, ValueError, KeyError) as e:
+            messagebox.showerror("Error", f"Cannot run {os.path.basename(path)}:\n{e}")
+            return
+        self.log(f"Running {recipe['name']}: {len(recipe['steps'])} steps on "
+                 f"{', '.join(recipe['channels'])}")
+        self.sequence.start()
+
+    def stop_sequence(self):
+        if self.sequence is not None:
+            self.sequence.stop()
+
+    def _on_sequence_progress(self, sequence):
+        self.sequence_status_label.config(text=sequence.describe())
+
+    def _on_sequence_finished(self, sequence):
+        from hv_sequence import save_results, DONE as SEQUENCE_DONE
+        name = sequence.recipe['name']
+        if sequence.state == SEQUENCE_DONE:
+            self.log(f"{name} finished, {len(sequence.results)} points")
+        else:
+            self.log(f"{name} aborted at step {sequence.step + 1}: {sequence.message}", logging.ERROR)
+        if len(sequence.results):
+            # Keep what was measured, aborted scans included
+            directory = os.path.join(RECORD_DIR, "sequences")
+            path = os.path.join(directory, re.sub(r'[^A-Za-z0-9_.-]+', '_', name) +
+                                time.strftime("_%Y%m%d_%H%M%S.csv"))
+            try:
+                os.makedirs(directory, exist_ok=True)
+                save_results(path, sequence.results, sequence.recipe)
+                self.log(f"Results saved to {path}")
+            except OSError as e:
+                self.log(f"Could not save the results of {name}: {e}", logging.ERROR)
+
+    def update_ramp_status(self):
+        ramps = self.ramps.active()
+        if not ramps:
+            self.ramp_status_label.config(text="No ramps running")
+            return
+        self.ramp_status_label.config(text="; ".join(ramp.describe() for ramp in ramps))
     
+    def selected_targets(self):
+        """[(device, channel)] of the channel or group picked in the channel combo box"""
+        choice = self.channel_var.get()
+        if choice.startswith(GROUP_PREFIX):
+            return self.groups.resolve(choice[len(GROUP_PREFIX):], self.devices)
+        try:
+            return [self.channel_choices[choice]]
+        except KeyError:
+            raise ValueError("no channel selected")
+
+    def open_groups(self):
+        """Define, change or delete channel groups"""
+        window = tk.Toplevel(self.root)
+        window.title("Channel Groups")
+        frame = ttk.Frame(window, padding="10")
+        frame.pack(fill="both", expand=True)
+
+        listbox = tk.Listbox(frame, height=8, width=40)
+        listbox.grid(row=0, column=0, columnspan=3, sticky="nsew")
+        ttk.Label(frame, text="Name:").grid(row=1, column=0, sticky="w", pady=(5,0))
+        name_var = tk.StringVar()
+        ttk.Entry(frame, textvariable=name_var, width=30).grid(row=1, column=1, columnspan=2,
+                                                               sticky="w", pady=(5,0))
+        ttk.Label(frame, text="Channels:").grid(row=2, column=0, sticky="w", pady=(5,0))
+        channels_var = tk.StringVar()
+        ttk.Entry(frame, textvariable=channels_var, width=30).grid(row=2, column=1, columnspan=2,
+                                                                   sticky="w", pady=(5,0))
+        ttk.Label(frame, text="e.g. D0:0, D0:1, D1:3").grid(row=3, column=1, columnspan=2,
+                                                           sticky="w")
+
+        def fill():
+            listbox.delete(0, "end")
+            for name in sorted(self.groups.groups):
+                listbox.insert("end", f"{name}: {', '.join(self.groups.groups[name])}")
+
+        def selected(event=None):
+            names = sorted(self.groups.groups)
+            if listbox.curselection():
+                name = names[listbox.curselection()[0]]
+                name_var.set(name)
+                channels_var.set(", ".join(self.groups.groups[name]))
+
+        def changed():
+            fill()
+            self.update_channel_choices()
+            try:
+                os.makedirs(RECORD_DIR, exist_ok=True)
+                self.groups.save(CHANNEL_GROUPS)
+            except OSError as e:
+                self.log(f"Cannot save channel groups to {CHANNEL_GROUPS}: {e}", logging.ERROR)
+
+        def save():
+            try:
+                self.groups.define(name_var.get(), channels_var.get().split(","))
+            except ValueError as e:
+                messagebox.showerror("Error", str(e), parent=window)
+                return
+            self.log(f"Channel group {name_var.get().strip()} saved")
+            changed()
+
+        def delete():
+            self.groups.remove(name_var.get().strip())
+            changed()
+
+        listbox.bind("<<ListboxSelect>>", selected)
+        ttk.Button(frame, text="Save", command=save).grid(row=4, column=1, sticky="w", pady=10)
+        ttk.Button(frame, text="Delete", command=delete).grid(row=4, column=2, sticky="w", pady=10)
+        fill()
+
     def quick_set_voltage(self, value):
         """Quick set voltage"""
         self.param_var.set("VSET")
@@ -625,32 +1407,43 @@ class CAENDesktopGUI:
         self.on_param_change()
         self.set_parameter()
     
-    def log(self, message):
-        """Add message to log"""
-        timestamp = time.strftime("%H:%M:%S")
-        self.log_text.insert(tk.END, f"[{timestamp}] {message}\n")
-        self.log_text.see(tk.END)
-        print(f"[{timestamp}] {message}")
-    
+    def log(self, message, level=logging.INFO):
+        """Add message to log, safe to call from any thread"""
+        self.logger.log(level, message)
+
     def clear_log(self):
         """Clear the log"""
-        self.log_text.delete(1.0, tk.END)
+        self.log_panel.clear()
+
+    def on_debug_log_toggle(self):
+        """Show or hide per-update debug messages"""
+        self.logger.setLevel(logging.DEBUG if self.debug_log_var.get() else logging.INFO)
     
     def on_closing(self):
         """Handle window closing"""
         self.monitoring = False
-        if self.hv and hasattr(self.hv, 'close'):
-            self.hv.close()
+        # Closes the devices after any queued OFF commands went out
+        self.devices.stop()
         self.root.destroy()
 
 def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--log-file", help="also write the command log to this file")
+    parser.add_argument("--transport", choices=TRANSPORTS, default="caenpy",
+                        help="device I/O: CAENpy's blocking handle or the shared asyncio loop")
+    parser.add_argument("--alarms", help=f"alarm rules file (default {ALARM_RULES} if it exists)")
+    args = parser.parse_args()
+
+    log_listener = start_logging(log_file=args.log_file)
+
     root = tk.Tk()
-    app = CAENDesktopGUI(root)
+    app = CAENDesktopGUI(root, transport=args.transport, alarm_rules=args.alarms)
     
     # Handle window closing
     root.protocol("WM_DELETE_WINDOW", app.on_closing)
     
     root.mainloop()
+    log_listener.stop()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,228 @@
+"""
+Software interlocks
+
+AlarmEngine checks a list of rules against every snapshot, on the device's
+I/O worker right after the read, so an OFF action goes out in the same
+worker job and alarm reaction time is bounded by the poll period, not by
+the UI.  Each channel keeps O(1) running state (last IMON, smoothed dI/dt,
+consecutive-hit counters), so evaluation costs the same however long the
+history is.
+
+Rules come from a JSON list, e.g.
+
+    [
+        {"kind": "imon_above", "threshold": 5e-6, "action": "ramp_down", "channels": ["D0:0"]},
+        {"kind": "didt_above", "threshold": 1e-7, "action": "log"},
+        {"kind": "vmon_deviation", "threshold": 5, "count": 3, "action": "log"},
+        {"kind": "dropped_out", "action": "all_off"}
+    ]
+
+kinds: imon_above (A), didt_above (A/s), vmon_deviation (|VMON - VSET| in
+V, while on and not ramping), dropped_out (output went off without an OFF
+from this program).  "count" consecutive snapshots must match before the
+rule fires.  An alarm fires once and re-arms when its condition clears.
+
+actions: log, off (the channel), device_off (all channels of the device),
+all_off (every device), ramp_down (to 0 V at "rate" V/s, default 10).
+"""
+import json
+import logging
+import threading
+
+KINDS = ("imon_above", "didt_above", "vmon_deviation", "dropped_out")
+
+ACTION_LOG = "log"
+ACTION_OFF = "off"
+ACTION_DEVICE_OFF = "device_off"
+ACTION_ALL_OFF = "all_off"
+ACTION_RAMP_DOWN = "ramp_down"
+ACTIONS = (ACTION_LOG, ACTION_OFF, ACTION_DEVICE_OFF, ACTION_ALL_OFF, ACTION_RAMP_DOWN)
+
+# Smoothing of dI/dt, weight of the newest difference quotient
+DIDT_WEIGHT = 0.5
+
+RAMP_DOWN_RATE = 10.0
+
+
+class AlarmRule:
+    """One condition checked on every snapshot of the channels it applies to"""
+
+    def __init__(self, kind, threshold=None, action=ACTION_LOG, channels=None, count=1,
+                 rate=RAMP_DOWN_RATE, name=None):
+        if kind not in KINDS:
+            raise ValueError(f"unknown alarm kind {kind!r}")
+        if action not in ACTIONS:
+            raise ValueError(f"unknown alarm action {action!r}")
+        if threshold is None and kind != "dropped_out":
+            raise ValueError(f"{kind} needs a threshold")
+        self.kind = kind
+        self.threshold = None if threshold is None else float(threshold)
+        self.action = action
+        # "D0:1", or "1" for channel 1 of every device; None for all channels
+        self.channels = None if channels is None else {str(spec) for spec in channels}
+        self.count = max(int(count), 1)
+        self.rate = float(rate)
+        self.name = name or (kind if threshold is None else f"{kind} {threshold:g}")
+
+    def applies_to(self, device, channel):
+        return (self.channels is None or str(channel) in self.channels
+                or f"{device.label}:{channel}" in self.channels)
+
+
+class Alarm:
+    """A rule that fired on one channel"""
+
+    def __init__(self, rule, device, channel, timestamp, value, message):
+        self.rule = rule
+        self.device = device
+        self.channel = channel
+        self.timestamp = timestamp
+        self.value = value
+        self.message = message
+        # Filled in by the worker for local actions
+        self.action_error = None
+
+    def to_dict(self):
+        return {'rule': self.rule.name, 'action': self.rule.action,
+                'device': self.device.label, 'channel': self.channel,
+                'time': self.timestamp, 'value': self.value, 'message': self.message,
+                'action_error': self.action_error}
+
+
+class _ChannelState:
+    __slots__ = ('time', 'imon', 'didt', 'was_on', 'hits', 'active')
+
+    def __init__(self):
+        self.time = None
+        self.imon = None
+        self.didt = None
+        self.was_on = False
+        self.hits = {}
+        self.active = set()
+
+
+def load_rules(path):
+    with open(path) as f:
+        return [AlarmRule(**item) for item in json.load(f)]
+
+
+class AlarmEngine:
+    """Rules evaluated per snapshot, safe to use from several device workers"""
+
+    def __init__(self, rules=()):
+        self.rules = list(rules)
+        self._state = {}
+        self._lock = threading.Lock()
+
+    def set_rules(self, rules):
+        """Replace the rules, running state starts over"""
+        with self._lock:
+            self.rules = list(rules)
+            self._state = {}
+
+    def forget(self, device):
+        with self._lock:
+            for key in [key for key in self._state if key[0] is device]:
+                del self._state[key]
+
+    def evaluate(self, device, snapshot, commanded_off=()):
+        """Return the alarms raised by this snapshot
+
+        commanded_off holds the channels this program switched off, an
+        output going off there is not a dropout.
+        """
+        rules = self.rules
+        if not rules:
+            return []
+        alarms = []
+        for reading in snapshot:
+            if reading.errors or reading.status_word is None:
+                continue
+            key = (device, reading.channel)
+            state = self._state.get(key)
+            if state is None:
+                with self._lock:
+                    state = self._state.setdefault(key, _ChannelState())
+            self._update(state, reading, snapshot.timestamp)
+            on = reading.output == 'on'
+            for rule in rules:
+                if not rule.applies_to(device, reading.channel):
+                    continue
+                value, message = self._check(rule, reading, on, state, commanded_off)
+                hits = state.hits.get(rule, 0) + 1 if message else 0
+                state.hits[rule] = hits
+                if hits >= rule.count and rule not in state.active:
+                    state.active.add(rule)
+                    alarms.append(Alarm(rule, device, reading.channel, snapshot.timestamp,
+                                        value, f"{device.label} CH{reading.channel} {message}"))
+                elif not message:
+                    state.active.discard(rule)
+            state.was_on = on
+        return alarms
+
+    def _update(self, state, reading, timestamp):
+        imon = reading.imon
+        if imon is not None and state.imon is not None and timestamp > state.time:
+            slope = (imon - state.imon) / (timestamp - state.time)
+            state.didt = slope if state.didt is None else (
+                DIDT_WEIGHT * slope + (1 - DIDT_WEIGHT) * state.didt)
+        if imon is not None:
+            state.imon, state.time = imon, timestamp
+
+    def _check(self, rule, reading, on, state, commanded_off):
+        """(value, message) when the rule's condition holds, (value, None) otherwise"""
+        if rule.kind == "imon_above":
+            imon = reading.imon
+            if imon is not None and imon > rule.threshold:
+                return imon, f"IMON {imon:.3e} A above {rule.threshold:.3e} A"
+            return imon, None
+        if rule.kind == "didt_above":
+            didt = state.didt
+            if didt is not None and didt > rule.threshold:
+                return didt, f"dI/dt {didt:.3e} A/s above {rule.threshold:.3e} A/s"
+            return didt, None
+        if rule.kind == "vmon_deviation":
+            if not on or reading.is_ramping or None in (reading.vmon, reading.vset):
+                return None, None
+            deviation = abs(reading.vmon - reading.vset)
+            if deviation > rule.threshold:
+                return deviation, (f"VMON {reading.vmon:.1f} V is {deviation:.1f} V "
+                                   f"off VSET {reading.vset:.1f} V")
+            return deviation, None
+        # dropped_out
+        if state.was_on and not on and reading.channel not in commanded_off:
+            return reading.status_word, f"output dropped out (STAT {reading.status_word:#06x})"
+        return None, None
+
+
+def dispatch_alarms(alarms, devices, ramps, logger=None):
+    """Carry out the actions that need more than the device's own worker
+
+    ramp_down starts a RampEngine ramp, all_off turns off every other
+    device as well (the device that raised it already did on its worker).
+    """
+    logger = logger or logging.getLogger("hvgui")
+    for alarm in alarms:
+        rule = alarm.rule
+        level = logging.WARNING if rule.action == ACTION_LOG else logging.ERROR
+        text = f"ALARM {rule.name}: {alarm.message}, action {rule.action}"
+        if alarm.action_error:
+            text += f" FAILED: {alarm.action_error}"
+        logger.log(level, text)
+
+        if rule.action == ACTION_RAMP_DOWN and alarm.device.connected:
+            ramp = ramps.find(alarm.device, alarm.channel)
+            if ramp is not None:
+                ramps.abort(ramp, f"alarm {rule.name}")
+            ramps.start(alarm.device, alarm.channel, 0.0, rule.rate)
+        elif rule.action == ACTION_ALL_OFF:
+            ramps.forget(message=f"alarm {rule.name}")
+            for device in devices.connected:
+                if device is not alarm.device:
+                    device.emergency_off()
+        elif rule.action == ACTION_DEVICE_OFF:
+            ramps.forget(alarm.device, f"alarm {rule.name}")
+        elif rule.action == ACTION_OFF:
+            ramp = ramps.find(alarm.device, alarm.channel)
+            if ramp is not None:
+                ramps.drop(ramp, f"alarm {rule.name}")
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the acquisition loop on simulated supplies
+
+Runs DeviceManager on hv_sim supplies for every combination of channel and
+device counts and reports the poll cycle latency, supply commands per
+second, how late the consumer thread served its timers (the UI stall) and
+the memory growth.  Needs no hardware, and with --seed the simulated
+latencies are the same on every run:
+
+    python hv_bench.py --channels 1,4,8 --devices 1,2,4 --duration 20
+    python hv_bench.py --gui --duration 60 --json before.json
+
+By default the consumer is a headless ServiceLoop; --gui drives the real
+CAENDesktopGUI instead (needs a display) and also times the snapshot
+handling on the Tk thread.
+
+--startup times a cold start instead: importing HVgui in a fresh
+interpreter and, with --gui, building the window and drawing it once.  It
+fails (exit status 1) when the median exceeds --max-startup or when the
+import pulls in one of STARTUP_DEFERRED, which must wait for the window:
+
+    python hv_bench.py --startup --gui --max-startup 0.5
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from hv_devices import PollSettings
+from hv_metrics import LatencyHistogram
+from hv_service import AcquisitionService, ServiceLoop
+
+# How often the stall probe asks the consumer thread to run (seconds)
+PROBE_PERIOD = 0.01
+
+# Modules importing HVgui must not load, they are preloaded after the window is up
+STARTUP_DEFERRED = ("numpy", "CAENpy", "asyncio", "serial", "pyarrow", "h5py")
+
+# Run in a fresh interpreter by time_startup(), argv: gui flag, deferred modules
+STARTUP_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import tkinter as tk
+toolkit = time.perf_counter()
+loaded = set(sys.modules)
+import HVgui
+imported = time.perf_counter()
+result = {'toolkit_s': toolkit - started, 'import_s': imported - toolkit,
+          'deferred_loaded': [m for m in sys.argv[2:] if m in sys.modules and m not in loaded]}
+if sys.argv[1] == "1":
+    root = tk.Tk()
+    app = HVgui.CAENDesktopGUI(root, transport="sim")
+    root.update()
+    result['window_s'] = time.perf_counter() - imported
+    app.on_closing()
+print(json.dumps(result))
+"""
+
+
+def rss_bytes():
+    """Resident memory of this process, 0 if the platform does not tell"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        # Peak rather than current, but it still shows growth
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        return 0
+
+
+class StallProbe:
+    """Timer chain on the consumer thread that measures how late it runs"""
+
+    def __init__(self, call_later, metrics):
+        self.call_later = call_later
+        self.metrics = metrics
+        self.running = False
+        self._due = None
+
+    def start(self):
+        self.running = True
+        self._schedule()
+
+    def stop(self):
+        self.running = False
+
+    def _schedule(self):
+        self._due = time.perf_counter() + PROBE_PERIOD
+        self.call_later(int(PROBE_PERIOD * 1000), self._tick)
+
+    def _tick(self):
+        self.metrics.observe('hv_ui_stall_seconds', max(time.perf_counter() - self._due, 0.0))
+        if self.running:
+            self._schedule()
+
+
+def sim_address(channels, latency, jitter, errors, seed, index):
+    address = f"channels={channels},latency={latency},jitter={jitter},errors={errors}"
+    if seed is not None:
+        address += f",seed={seed + index}"
+    return address
+
+
+def summarize(metrics, duration, rss_start, rss_end, channels, devices):
+    # One histogram over all devices for the percentiles
+    cycle = LatencyHistogram()
+    commands = 0
+    command_errors = 0
+    cycles = []
+    for name, labels, histogram in metrics.items():
+        if name == 'hv_command_seconds':
+            commands += histogram.count
+            command_errors += histogram.errors
+        elif name == 'hv_poll_cycle_seconds':
+            cycles.append(histogram)
+    for histogram in cycles:
+        for i, n in enumerate(histogram.counts):
+            cycle.counts[i] += n
+        cycle.count += histogram.count
+        cycle.sum += histogram.sum
+        cycle.max = max(cycle.max, histogram.max)
+    stall = metrics.histogram('hv_ui_stall_seconds')
+    apply = metrics.histogram('hv_ui_apply_seconds')
+    return {
+        'channels': channels,
+        'devices': devices,
+        'duration': duration,
+        'cycles': cycle.count,
+        'cycle_p50': cycle.percentile(0.5),
+        'cycle_p95': cycle.percentile(0.95),
+        'cycle_p99': cycle.percentile(0.99),
+        'snapshots_per_s': cycle.count / duration,
+        'commands_per_s': commands / duration,
+        'command_errors': command_errors,
+        'stall_p99': stall.percentile(0.99),
+        'stall_max': stall.max,
+        'apply_p99': apply.percentile(0.99),
+        'rss_start_mb': rss_start / 2 ** 20,
+        'memory_growth_mb': (rss_end - rss_start) / 2 ** 20,
+    }
+
+
+def run_headless(channels, devices, args):
+    """One scenario on a ServiceLoop, returns the summary"""
+    loop = ServiceLoop()
+    settings = PollSettings(interval=args.interval, min_interval=args.interval,
+                            ramp_interval=args.interval)
+    service = AcquisitionService(loop, settings, transport="sim")
+    metrics = service.metrics
+    probe = StallProbe(loop.call_later, metrics)
+    thread = threading.Thread(target=loop.run, name="hv-bench-loop", daemon=True)
+    thread.start()
+    for index in range(devices):
+        loop.call_soon(service.connect_device, "USB",
+                       sim_address(channels, args.latency, args.jitter, args.errors,
+                                   args.seed, index))
+    # Let the links open, then start counting from zero
+    time.sleep(args.warmup)
+    loop.call_soon(metrics.reset)
+    loop.call_soon(probe.start)
+    time.sleep(0.05)
+    gc.collect()
+    rss_start = rss_bytes()
+    started = time.perf_counter()
+    time.sleep(args.duration)
+    duration = time.perf_counter() - started
+    gc.collect()
+    rss_end = rss_bytes()
+    loop.call_soon(probe.stop)
+    loop.call_soon(service.shutdown)
+    loop.call_soon(loop.stop)
+    thread.join(timeout=5.0)
+    return summarize(metrics, duration, rss_start, rss_end, channels, devices)
+
+
+def run_gui(channels, devices, args):
+    """One scenario in the real GUI, driven with update() instead of mainloop()"""
+    import tkinter as tk
+    import HVgui
+
+    HVgui.POLL_INTERVAL = HVgui.POLL_MIN_INTERVAL = HVgui.POLL_RAMP_INTERVAL = args.interval
+    root = tk.Tk()
+    app = HVgui.CAENDesktopGUI(root, transport="sim")
+    app.record_var.set(False)
+    metrics = app.metrics
+    probe = StallProbe(root.after, metrics)
+    for index in range(devices):
+        app.port_var.set(sim_address(channels, args.latency, args.jitter, args.errors,
+                                     args.seed, index))
+        app.connect()
+
+    def pump(seconds):
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            root.update()
+            time.sleep(0.001)
+
+    pump(args.warmup)
+    metrics.reset()
+    probe.start()
+    gc.collect()
+    rss_start = rss_bytes()
+    started = time.perf_counter()
+    pump(args.duration)
+    duration = time.perf_counter() - started
+    gc.collect()
+    rss_end = rss_bytes()
+    probe.stop()
+    app.on_closing()
+    return summarize(metrics, duration, rss_start, rss_end, channels, devices)
+
+
+def time_startup(gui=False, runs=5):
+    """Median and worst cold start over runs, each in a fresh interpreter"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (here, env.get('PYTHONPATH')) if p)
+    samples = []
+    deferred_loaded = set()
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, "1" if gui else "0"]
+                                + list(STARTUP_DEFERRED),
+                                env=env, cwd=here, capture_output=True, text=True, check=True)
+        sample = json.loads(output.stdout.strip().splitlines()[-1])
+        sample['total_s'] = sample['import_s'] + sample.get('window_s', 0.0)
+        deferred_loaded.update(sample['deferred_loaded'])
+        samples.append(sample)
+    result = {'runs': runs, 'gui': gui, 'deferred_loaded': sorted(deferred_loaded)}
+    for key in ('toolkit_s', 'import_s', 'window_s', 'total_s'):
+        values = [sample[key] for sample in samples if key in sample]
+        if values:
+            result[key] = statistics.median(values)
+            result[key.replace('_s', '_max_s')] = max(values)
+    return result
+
+
+def check_startup(result, max_startup=None):
+    """Why the startup result is a regression, empty if it is not"""
+    problems = []
+    if result['deferred_loaded']:
+        problems.append(f"importing HVgui loads {', '.join(result['deferred_loaded'])}")
+    if max_startup is not None and result['total_s'] > max_startup:
+        problems.append(f"median startup {result['total_s'] * 1000:.0f} ms exceeds "
+                        f"{max_startup * 1000:.0f} ms")
+    return problems
+
+
+def print_startup(result):
+    print(f"tkinter import {format_ms(result['toolkit_s'])} ms (not counted), "
+          f"HVgui import {format_ms(result['import_s'])} ms "
+          f"(max {format_ms(result['import_max_s'])})")
+    if 'window_s' in result:
+        print(f"window built and drawn {format_ms(result['window_s'])} ms "
+              f"(max {format_ms(result['window_max_s'])})")
+    print(f"startup {format_ms(result['total_s'])} ms, median of {result['runs']} runs")
+
+
+def format_ms(value):
+    return "-" if value is None else f"{value * 1000:.1f}"
+
+
+def print_table(results):
+    header = (f"{'ch':>3} {'dev':>3} {'cycles':>7} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} "
+              f"{'snap/s':>7} {'cmd/s':>7} {'err':>5} {'stall99':>8} {'stallmax':>8} "
+              f"{'apply99':>8} {'mem MB':>7}")
+    print(header)
+    for r in results:
+        print(f"{r['channels']:>3} {r['devices']:>3} {r['cycles']:>7} "
+              f"{format_ms(r['cycle_p50']):>7} {format_ms(r['cycle_p95']):>7} "
+              f"{format_ms(r['cycle_p99']):>7} {r['snapshots_per_s']:>7.1f} "
+              f"{r['commands_per_s']:>7.1f} {r['command_errors']:>5} "
+              f"{format_ms(r['stall_p99']):>8} {format_ms(r['stall_max']):>8} "
+              f"{format_ms(r['apply_p99']):>8} {r['memory_growth_mb']:>+7.2f}")
+
+
+def counts(text):
+    return [int(value) for value in text.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--channels", type=counts, default=[4],
+                        help="comma separated channel counts per device (default 4)")
+    parser.add_argument("--devices", type=counts, default=[1],
+                        help="comma separated device counts (default 1)")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per scenario")
+    parser.add_argument("--warmup", type=float, default=2.0,
+                        help="seconds to let the links open before measuring")
+    parser.add_argument("--interval", type=float, default=0.5, help="poll period in seconds")
+    parser.add_argument("--latency", type=float, default=0.01, help="simulated seconds per command")
+    parser.add_argument("--jitter", type=float, default=0.002, help="simulated latency jitter")
+    parser.add_argument("--errors", type=float, default=0.0, help="share of failing commands")
+    parser.add_argument("--seed", type=int, default=1, help="simulator seed")
+    parser.add_argument("--gui", action="store_true", help="run the Tk GUI as the consumer")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--startup", action="store_true",
+                        help="time a cold start of the GUI instead of the acquisition loop")
+    parser.add_argument("--runs", type=int, default=5, help="cold starts timed by --startup")
+    parser.add_argument("--max-startup", type=float,
+                        help="fail when the median --startup time exceeds this many seconds")
+    args = parser.parse_args()
+
+    if args.startup:
+        result = time_startup(args.gui, args.runs)
+        print_startup(result)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'args': vars(args), 'startup': result}, f, indent=1)
+        problems = check_startup(result, args.max_startup)
+        for problem in problems:
+            print(f"REGRESSION: {problem}")
+        sys.exit(1 if problems else 0)
+
+    logging.getLogger("hvgui").setLevel(logging.WARNING)
+    run = run_gui if args.gui else run_headless
+    results = []
+    for devices in args.devices:
+        for channels in args.channels:
+            print(f"{devices} device(s) x {channels} channel(s)...", flush=True)
+            results.append(run(channels, devices, args))
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
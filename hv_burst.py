@@ -0,0 +1,187 @@
+"""
+Triggered burst capture
+
+The regular poll reads every channel every couple of seconds, too slow to
+see the shape of a breakdown.  A BurstTrigger is checked on every snapshot
+on the device worker; when IMON of a channel crosses a threshold, or its
+STAT shows overcurrent (or ramping, if asked for), the worker stops the
+regular poll for that device and reads only VMON and IMON of that channel,
+back to back, for post_seconds.  The capture runs in slices of
+SLICE_SECONDS so queued setpoint writes get through, and stops at once for
+an OFF command.  The pre-trigger part comes from the device's history ring
+buffer, and the whole burst is saved as a .npz file (arrays time, vmon,
+imon, the JSON string info) under the trigger's directory.  numpy is only imported once a burst is
+saved, a trigger alone does not need it.
+"""
+import json
+import os
+import threading
+import time
+
+# Longest stretch of burst reads before queued writes get a turn (seconds)
+SLICE_SECONDS = 0.2
+
+REASON_IMON = "imon"
+REASON_OVERCURRENT = "overcurrent"
+REASON_RAMPING = "ramping"
+
+
+class BurstTrigger:
+    """When to capture a burst, shared by all devices and safe to use from their workers"""
+
+    def __init__(self, imon_threshold=None, overcurrent=True, ramping=False,
+                 pre_seconds=60.0, post_seconds=2.0, holdoff=30.0, channels=None,
+                 directory=None, enabled=True):
+        self.enabled = enabled
+        # IMON in A above which a burst starts, None for no IMON trigger
+        self.imon_threshold = imon_threshold
+        self.overcurrent = overcurrent
+        self.ramping = ramping
+        # History before the trigger and high rate capture after it
+        self.pre_seconds = pre_seconds
+        self.post_seconds = post_seconds
+        # Least time between two bursts of one channel
+        self.holdoff = holdoff
+        # None for all, else a list of channel numbers
+        self.channels = channels
+        # Bursts are saved under directory/<device>/, None keeps them in memory only
+        self.directory = directory
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def reason(self, reading):
+        """Why this reading triggers a burst, None if it does not"""
+        if self.channels is not None and reading.channel not in self.channels:
+            return None
+        imon = reading.imon
+        if self.imon_threshold is not None and imon is not None and imon > self.imon_threshold:
+            return REASON_IMON
+        if self.overcurrent and reading.overcurrent:
+            return REASON_OVERCURRENT
+        if self.ramping and reading.is_ramping:
+            return REASON_RAMPING
+        return None
+
+    def check(self, device, snapshot):
+        """(channel, reason) of the first channel to capture, or None"""
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        for reading in snapshot:
+            if reading.errors:
+                continue
+            reason = self.reason(reading)
+            if reason is None:
+                continue
+            key = (device, reading.channel)
+            with self._lock:
+                last = self._last.get(key)
+                if last is not None and now - last < self.holdoff:
+                    continue
+                self._last[key] = now
+            return reading.channel, reason
+        return None
+
+    def forget(self, device):
+        with self._lock:
+            for key in [key for key in self._last if key[0] is device]:
+                del self._last[key]
+
+
+class Burst:
+    """One capture: pre-trigger history plus the high rate samples after the trigger"""
+
+    def __init__(self, device, channel, reason, trigger_time, post_seconds):
+        self.device = device
+        self.channel = channel
+        self.reason = reason
+        self.trigger_time = trigger_time
+        self.post_seconds = post_seconds
+        self.end = time.monotonic() + post_seconds
+        # (time, vmon, imon) read after the trigger, on the worker
+        self.samples = []
+        self.pre = None
+        self.error = None
+        self.path = None
+
+    @property
+    def finished(self):
+        return time.monotonic() >= self.end
+
+    def capture(self, hv, give_way):
+        """Read VMON and IMON back to back for one slice, on the worker
+
+        Returns True when the burst is over: post_seconds reached, give_way()
+        true (an OFF is waiting) or a read failed.
+        """
+        slice_end = min(time.monotonic() + SLICE_SECONDS, self.end)
+        while time.monotonic() < slice_end:
+            if give_way():
+                self.error = "stopped for a safety command"
+                return True
+            try:
+                vmon = float(hv.get_single_channel_parameter('VMON', self.channel))
+                # The supply reports currents in microamps
+                imon = float(hv.get_single_channel_parameter('IMON', self.channel)) * 1e-6
+            except Exception as e:
+                self.error = str(e)
+                return True
+            self.samples.append((time.time(), vmon, imon))
+        return self.finished
+
+    @property
+    def rate(self):
+        """Samples per second after the trigger"""
+        if len(self.samples) < 2:
+            return 0.0
+        return (len(self.samples) - 1) / (self.samples[-1][0] - self.samples[0][0])
+
+    def arrays(self):
+        """time, vmon, imon of the pre-trigger history followed by the burst samples"""
+        import numpy as np
+        post = np.array(self.samples, dtype=np.float64).reshape(-1, 3)
+        if self.pre is None:
+            return post[:, 0], post[:, 1], post[:, 2]
+        return (np.concatenate([self.pre['time'], post[:, 0]]),
+                np.concatenate([self.pre['vmon'].astype(np.float64), post[:, 1]]),
+                np.concatenate([self.pre['imon'].astype(np.float64), post[:, 2]]))
+
+    def to_dict(self):
+        return {
+            'device': self.device.label,
+            'channel': self.channel,
+            'reason': self.reason,
+            'trigger_time': self.trigger_time,
+            'pre_samples': 0 if self.pre is None else len(self.pre['time']),
+            'samples': len(self.samples),
+            'rate': self.rate,
+            'error': self.error,
+            'path': self.path,
+        }
+
+    def describe(self):
+        text = (f"{self.device.label} CH{self.channel} burst on {self.reason}: "
+                f"{len(self.samples)} samples at {self.rate:.1f}/s")
+        if self.error:
+            text += f" ({self.error})"
+        return text
+
+    def save(self, directory):
+        """Write the burst to a .npz file in directory, returns its path"""
+        import numpy as np
+        os.makedirs(directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.trigger_time))
+        path = os.path.join(directory, f"{self.device.label}_CH{self.channel}_{stamp}.npz")
+        t, vmon, imon = self.arrays()
+        info = dict(self.to_dict(), idn=self.device.idn, address=self.device.address)
+        info.pop('path')
+        np.savez_compressed(path, time=t, vmon=vmon, imon=imon, info=json.dumps(info))
+        self.path = path
+        return path
+
+
+def load_burst(path):
+    """(info, time, vmon, imon) of a saved burst"""
+    import numpy as np
+    with np.load(path) as data:
+        return json.loads(str(data['info'])), data['time'], data['vmon'], data['imon']
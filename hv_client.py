@@ -0,0 +1,305 @@
+"""
+Client of the acquisition daemon
+
+DaemonClient speaks the JSON lines protocol of hv_service over TCP or a Unix
+socket.  Replies and events are read on a background thread and handed to
+deliver(), so callbacks run on the caller's thread just like DeviceWorker's.
+RemoteDevice wraps one daemon device in the interface of hv_devices.Device,
+which lets the GUI show a supply that another process is polling.
+"""
+import itertools
+import json
+import socket
+import threading
+
+from hv_readout import Snapshot
+from hv_link import LinkHealth, UP, CLOSED
+
+DEFAULT_PORT = 8034
+DEFAULT_ADDRESS = f"localhost:{DEFAULT_PORT}"
+
+
+def open_socket(address, timeout=5.0):
+    """Connect to "host:port" or "unix:/path/to/socket" """
+    if address.startswith("unix:"):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(address[len("unix:"):])
+    else:
+        host, _, port = address.rpartition(":")
+        sock = socket.create_connection((host or "localhost", int(port or DEFAULT_PORT)),
+                                        timeout=timeout)
+    sock.settimeout(None)
+    return sock
+
+
+class DaemonClient:
+    """One connection to the daemon, callbacks are run through deliver(func, *args)"""
+
+    def __init__(self, address, deliver, on_event=None, on_close=None):
+        self.address = address
+        self.deliver = deliver
+        self.on_event = on_event
+        self.on_close = on_close
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._sock = None
+        self._thread = None
+
+    @property
+    def connected(self):
+        return self._sock is not None
+
+    def open(self):
+        """Connect, blocks for at most the socket timeout"""
+        self._sock = open_socket(self.address)
+        self._thread = threading.Thread(target=self._read, args=(self._sock,),
+                                        name="hv-client", daemon=True)
+        self._thread.start()
+
+    def request(self, cmd, on_done=None, on_error=None, **fields):
+        """Send a command, on_done(result) or on_error(error) once it is answered"""
+        request_id = next(self._ids)
+        with self._lock:
+            self._pending[request_id] = (on_done, on_error)
+        try:
+            self._sock.sendall((json.dumps(dict(fields, id=request_id, cmd=cmd)) + "\n").encode())
+        except (OSError, AttributeError) as e:
+            with self._lock:
+                self._pending.pop(request_id, None)
+            if on_error:
+                self.deliver(on_error, ConnectionError(f"daemon connection lost: {e}"))
+
+    def close(self):
+        sock, self._sock = self._sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+    def _read(self, sock):
+        try:
+            for line in sock.makefile('rb'):
+                self._dispatch(json.loads(line))
+        except (OSError, ValueError):
+            pass
+        # Whatever is still waiting will not be answered
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for _, on_error in pending.values():
+            if on_error:
+                self.deliver(on_error, ConnectionError("daemon connection closed"))
+        if self._sock is sock:
+            self._sock = None
+            if self.on_close:
+                self.deliver(self.on_close)
+
+    def _dispatch(self, message):
+        if 'event' in message:
+            if self.on_event:
+                self.deliver(self.on_event, message)
+            return
+        with self._lock:
+            on_done, on_error = self._pending.pop(message.get('id'), (None, None))
+        if 'error' in message:
+            if on_error:
+                self.deliver(on_error, RuntimeError(message['error']))
+        elif on_done:
+            self.deliver(on_done, message.get('result'))
+
+
+class RemoteDevice:
+    """A supply polled by the daemon, with the interface of hv_devices.Device
+
+    index selects the daemon's device, in the order the daemon lists them.
+    """
+
+    def __init__(self, label, address, index, deliver, on_snapshot, on_poll_error, on_link=None):
+        self.label = label
+        self.conn_type = "Daemon"
+        self.daemon_address = address
+        self.index = index
+        self.address = f"{address}/{index}"
+        self.deliver = deliver
+        self.on_snapshot = on_snapshot
+        self.on_poll_error = on_poll_error
+        self.on_link = on_link
+
+        self.idn = None
+        self.num_channels = 0
+        self.connected = False
+        self.history = None
+        # The daemon does the recording
+        self.recorder = None
+        self.fast_poll = set()
+        self.remote_label = None
+        # The daemon's view of its link to the supply
+        self.link = LinkHealth()
+        self._polling = False
+        self._poll_interval = 0.0
+        self.client = DaemonClient(address, deliver, on_event=self._on_event,
+                                   on_close=self._on_close)
+
+    @property
+    def name(self):
+        return f"{self.label} {self.address}"
+
+    @property
+    def online(self):
+        return self.connected and self.link.up
+
+    @property
+    def polling(self):
+        return self._polling
+
+    @property
+    def poll_interval(self):
+        return self._poll_interval
+
+    def connect(self, on_done, on_error):
+        """Open the socket on a helper thread, then pick the device and subscribe"""
+        def opened(_):
+            self.client.request('devices', on_done=found, on_error=on_error)
+
+        def found(devices):
+            from hv_history import HistoryStore
+            if not 0 <= self.index < len(devices):
+                self.client.close()
+                on_error(ValueError(f"the daemon has {len(devices)} devices, no device {self.index}"))
+                return
+            info = devices[self.index]
+            self.remote_label = info['device']
+            self.idn = info['idn']
+            self.num_channels = info['channels']
+            self.link.update(info.get('link') or {'state': UP})
+            self.history = HistoryStore(self.num_channels)
+            self.connected = True
+            self.client.request('subscribe', on_error=on_error)
+            on_done(self)
+
+        def open_client():
+            try:
+                self.client.open()
+            except OSError as e:
+                self.deliver(on_error, e)
+                return
+            self.deliver(opened, None)
+
+        threading.Thread(target=open_client, name="hv-client-open", daemon=True).start()
+
+    def write(self, channel, settings, on_done=None, on_error=None):
+        """Write [(param, value), ...] to one channel in order, currents in Amperes"""
+        remaining = [len(settings)]
+
+        def written(_):
+            remaining[0] -= 1
+            if remaining[0] == 0 and on_done:
+                on_done(None)
+
+        # The daemon serves one client's requests in the order they arrive
+        for param, value in settings:
+            self.client.request('set', on_done=written, on_error=on_error,
+                                device=self.remote_label, channel=channel,
+                                param=param, value=value)
+
+    def hold_voltage(self, channel, on_done=None, on_error=None):
+        """Have the daemon set VSET to VMON, see Device.hold_voltage"""
+        self.client.request('hold', on_done=on_done, on_error=on_error,
+                            device=self.remote_label, channel=channel)
+
+    def write_many(self, writes, on_done=None, on_error=None):
+        """Have the daemon write [(channel, param, value), ...], see Device.write_many"""
+        self._write_request('set_many', writes, on_done, on_error)
+
+    def apply_setpoints(self, writes, on_done=None, on_error=None):
+        """Have the daemon write what differs, see Device.apply_setpoints"""
+        self._write_request('apply_setpoints', writes, on_done, on_error)
+
+    def read_setpoints(self, on_done=None, on_error=None):
+        def done(values):
+            if on_done:
+                on_done({(item['channel'], item['param']): item['value'] for item in values})
+
+        self.client.request('setpoints', on_done=done, on_error=on_error,
+                            device=self.remote_label)
+
+    def _write_request(self, cmd, writes, on_done, on_error):
+        def done(results):
+            if on_done:
+                on_done({(item.pop('channel'), item.pop('param')): item for item in results})
+
+        self.client.request(cmd, on_done=done, on_error=on_error, device=self.remote_label,
+                            writes=[list(write) for write in writes])
+
+    def switch(self, channel, on, on_done=None, on_error=None):
+        self.client.request('on' if on else 'off', on_done=on_done, on_error=on_error,
+                            device=self.remote_label, channel=channel)
+
+    def emergency_off(self, on_done=None, on_error=None):
+        """Have the daemon turn all channels of the device OFF, see Device.emergency_off"""
+        def done(results):
+            result = results[self.remote_label]
+            if 'error' in result:
+                if on_error:
+                    on_error(RuntimeError(result['error']))
+            elif on_done:
+                # JSON object keys are strings
+                on_done({int(ch): value for ch, value in result.items()})
+
+        self.client.request('all_off', on_done=done, on_error=on_error, device=self.remote_label)
+
+    def note_write(self, channel, param, value):
+        pass
+
+    def start_polling(self):
+        """Show the daemon's snapshots, the daemon keeps polling either way"""
+        if self.connected:
+            self._polling = True
+
+    def stop_polling(self):
+        self._polling = False
+
+    def refresh(self):
+        if self.connected:
+            self.client.request('refresh', device=self.remote_label)
+
+    def start_recording(self, directory):
+        pass
+
+    def stop_recording(self):
+        return 0
+
+    def disconnect(self):
+        self.connected = False
+        self._polling = False
+        self.link.set_state(CLOSED)
+        self.client.close()
+
+    def stop(self, timeout=2.0):
+        self.disconnect()
+
+    def _on_event(self, message):
+        if message.get('device') != self.remote_label or not self.connected:
+            return
+        if message['event'] == 'link':
+            self.link.update(message)
+            if self.on_link is not None:
+                self.on_link(self)
+            return
+        if message['event'] != 'snapshot':
+            return
+        snapshot = Snapshot.from_dict(message)
+        self._poll_interval = message['poll_interval']
+        self.history.record(snapshot)
+        if self._polling:
+            self.on_snapshot(self, snapshot)
+
+    def _on_close(self):
+        if self.connected:
+            self.link.lost(f"lost connection to {self.daemon_address}")
+            if self.on_link is not None:
+                self.on_link(self)
+            self.on_poll_error(self, ConnectionError(f"lost connection to {self.daemon_address}"))
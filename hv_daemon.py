@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Headless acquisition daemon for CAEN Desktop HV Power Supplies
+
+Holds the device connections, polls and records them, and serves snapshots
+and commands to local clients (the GUI with connection type "Daemon", or
+anything that speaks JSON lines, see hv_service).  Listens on localhost
+only unless told otherwise.
+
+    python hv_daemon.py --device USB:/dev/ttyACM0 --device Ethernet:192.168.1.100
+"""
+import argparse
+import http.server
+import json
+import logging
+import os
+import queue
+import socketserver
+import threading
+
+from hv_client import DEFAULT_ADDRESS
+from hv_alarm import load_rules
+from hv_burst import BurstTrigger
+from hv_devices import PollSettings, TRANSPORTS
+from hv_log import get_logger, start_logging
+from hv_service import AcquisitionService, ServiceLoop
+
+# Replies and events queued per client before a slow client is dropped
+CLIENT_QUEUE_SIZE = 1000
+
+
+class ClientHandler(socketserver.StreamRequestHandler):
+    """One client connection, requests go to the service loop, output via a writer thread"""
+
+    def setup(self):
+        super().setup()
+        self.outgoing = queue.Queue(maxsize=CLIENT_QUEUE_SIZE)
+        self.writer = threading.Thread(target=self._write, name="hv-daemon-writer", daemon=True)
+        self.writer.start()
+
+    def handle(self):
+        service = self.server.service
+        logger = get_logger()
+        logger.info(f"Client connected {self.client_address or 'local'}")
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                self.send(b'{"id": null, "error": "invalid JSON"}\n')
+                continue
+            service.loop.call_soon(service.handle, request, self.send)
+        logger.info(f"Client disconnected {self.client_address or 'local'}")
+
+    def finish(self):
+        self.server.service.loop.call_soon(self.server.service.unsubscribe, self.send)
+        # Let the writer finish before the stream is closed under it
+        try:
+            self.outgoing.put_nowait(None)
+        except queue.Full:
+            self._shutdown()
+        self.writer.join(timeout=1.0)
+        super().finish()
+
+    def send(self, line):
+        """Queue a line for the client, never blocks the service loop"""
+        try:
+            self.outgoing.put_nowait(line)
+        except queue.Full:
+            # Too slow to keep up with the stream, let it reconnect
+            get_logger().warning(f"Dropping slow client {self.client_address or 'local'}")
+            self.server.service.unsubscribe(self.send)
+            self._shutdown()
+
+    def _write(self):
+        while True:
+            line = self.outgoing.get()
+            if line is None:
+                return
+            try:
+                self.wfile.write(line)
+                self.wfile.flush()
+            except (OSError, ValueError):
+                self._shutdown()
+                return
+
+    def _shutdown(self):
+        try:
+            self.connection.shutdown(2)
+        except OSError:
+            pass
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """GET /metrics for Prometheus"""
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.service.prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, "ThreadingUnixStreamServer"):
+    class UnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+
+def make_server(listen, service):
+    """Server for "host:port" or "unix:/path" """
+    if listen.startswith("unix:"):
+        path = listen[len("unix:"):]
+        if os.path.exists(path):
+            os.unlink(path)
+        server = UnixServer(path, ClientHandler)
+    else:
+        host, _, port = listen.rpartition(":")
+        server = TCPServer((host or "localhost", int(port)), ClientHandler)
+    server.service = service
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--listen", default=DEFAULT_ADDRESS,
+                        help=f"host:port or unix:/path to serve clients on (default {DEFAULT_ADDRESS})")
+    parser.add_argument("--device", action="append", default=[], metavar="TYPE:ADDRESS",
+                        help="supply to open, e.g. USB:/dev/ttyACM0 or Ethernet:192.168.1.100")
+    parser.add_argument("--record-dir", help="record snapshots of every device below this directory")
+    parser.add_argument("--interval", type=float, default=2.0, help="poll period in seconds")
+    parser.add_argument("--transport", choices=TRANSPORTS, default="caenpy",
+                        help="device I/O: CAENpy's blocking handle or the shared asyncio loop")
+    parser.add_argument("--alarms", help="alarm rules file, see hv_alarm")
+    parser.add_argument("--burst-imon", type=float, metavar="AMPS",
+                        help="capture a burst when IMON of a channel exceeds this")
+    parser.add_argument("--burst-ovc", action="store_true",
+                        help="capture a burst when a channel reports overcurrent")
+    parser.add_argument("--burst-seconds", type=float, default=2.0,
+                        help="length of the high rate capture after a trigger (default 2)")
+    parser.add_argument("--metrics-listen", metavar="HOST:PORT",
+                        help="serve Prometheus metrics over HTTP at /metrics")
+    parser.add_argument("--log-file", help="also write the log to this file")
+    parser.add_argument("--debug", action="store_true", help="log debug messages")
+    args = parser.parse_args()
+
+    listener = start_logging(logging.DEBUG if args.debug else logging.INFO, args.log_file)
+    loop = ServiceLoop()
+    record_dir = args.record_dir and os.path.expanduser(args.record_dir)
+    bursts = None
+    if args.burst_imon is not None or args.burst_ovc:
+        bursts = BurstTrigger(imon_threshold=args.burst_imon, overcurrent=args.burst_ovc,
+                              post_seconds=args.burst_seconds,
+                              directory=record_dir and os.path.join(record_dir, "bursts"))
+    service = AcquisitionService(loop, PollSettings(interval=args.interval),
+                                 record_dir=record_dir, transport=args.transport,
+                                 alarm_rules=load_rules(args.alarms) if args.alarms else (),
+                                 bursts=bursts)
+    for spec in args.device:
+        conn_type, _, address = spec.partition(":")
+        loop.call_soon(service.connect_device, conn_type, address)
+
+    server = make_server(args.listen, service)
+    threading.Thread(target=server.serve_forever, name="hv-daemon-server", daemon=True).start()
+    get_logger().info(f"Serving on {args.listen}")
+    metrics_server = None
+    if args.metrics_listen:
+        host, _, port = args.metrics_listen.rpartition(":")
+        metrics_server = http.server.ThreadingHTTPServer((host or "localhost", int(port)),
+                                                         MetricsHandler)
+        metrics_server.daemon_threads = True
+        metrics_server.service = service
+        threading.Thread(target=metrics_server.serve_forever, name="hv-daemon-metrics",
+                         daemon=True).start()
+        get_logger().info(f"Metrics on http://{args.metrics_listen}/metrics")
+    try:
+        loop.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+        service.shutdown()
+        listener.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,788 @@
+"""
+Several CAEN desktop supplies in one process
+
+Every Device has its own DeviceWorker, so each serial/TCP link is served by
+one thread and the links are polled concurrently, each by its own
+PollScheduler.  Opening a link runs on the worker under a CONNECT_TIMEOUT
+watchdog, and a link that stops answering is reopened with backoff (see
+hv_link).  DeviceManager keeps the devices in display order and hands
+out the short labels (D0, D1, ...) used to name their channels.
+
+The device library, asyncio and numpy (history, recorder, rollups, bursts)
+are imported where they are first needed, so importing this module costs
+next to nothing and the GUI window comes up before any of them load.
+"""
+import math
+import os
+import re
+import time
+
+from hv_readout import (BatchedReader, TieredReader, ChannelReading, ReadAborted,
+                        CURRENT_PARAMETERS, SLOW_PARAMETERS)
+from hv_worker import DeviceWorker, PRIORITY_SAFETY, PRIORITY_WRITE, PRIORITY_READ
+from hv_poll import PollScheduler
+from hv_link import (LinkHealth, CONNECT_TIMEOUT, CYCLE_TIMEOUT, LOST_AFTER,
+                     UP, RECONNECTING, CLOSED)
+from hv_metrics import InstrumentedSupply
+from hv_alarm import ACTION_OFF, ACTION_DEVICE_OFF, ACTION_ALL_OFF
+from hv_client import RemoteDevice
+from hv_sim import SimulatedSupply
+
+
+# Device handle implementations, see open_supply()
+TRANSPORTS = ("caenpy", "asyncio", "sim")
+
+# Resolution of the setpoints, a read back within it counts as written (currents in A)
+WRITE_TOLERANCE = {'VSET': 0.1, 'MAXV': 1.0, 'RUP': 1.0, 'RDW': 1.0, 'ISET': 0.05e-6}
+
+# Range a setpoint may be written with, whoever asks: GUI, daemon client or profile
+SETPOINT_LIMITS = {'VSET': (0.0, 5000.0), 'ISET': (0.0, 1e-3), 'MAXV': (0.0, 5000.0),
+                   'RUP': (0.0, 500.0), 'RDW': (0.0, 500.0)}
+
+# How the limits are shown, in the units of SETPOINT_LIMITS
+LIMIT_UNITS = {'VSET': "V", 'ISET': "A", 'MAXV': "V", 'RUP': "V/s", 'RDW': "V/s"}
+
+
+def open_supply(conn_type, address, transport="caenpy"):
+    """Open a supply over USB (serial port) or Ethernet (IP address)
+
+    transport "asyncio" serves the link from the shared hv_transport loop,
+    with per-command timeouts, instead of CAENpy's blocking handle.
+    Transport "sim" opens an hv_sim.SimulatedSupply, the address holds its options.
+    """
+    if transport == "sim":
+        return SimulatedSupply(address)
+    if transport == "asyncio":
+        from hv_transport import AsyncSupply
+        return AsyncSupply(conn_type, address)
+    # Import the CAEN Desktop HV library
+    from CAENpy.CAENDesktopHighVoltagePowerSupply import CAENDesktopHighVoltagePowerSupply
+    if conn_type == "USB":
+        return CAENDesktopHighVoltagePowerSupply(port=address)
+    return CAENDesktopHighVoltagePowerSupply(ip=address)
+
+
+def set_channels(hv, param, value, channels, num_channels):
+    """Set param to the same value on several channels, value in supply units
+
+    All channels go out as one broadcast SET if the firmware takes it,
+    otherwise one command per channel.  Returns {channel: error message or None}.
+    """
+    channels = list(channels)
+    if len(channels) == num_channels > 1:
+        try:
+            # CH set to the number of channels addresses all of them, like the batched reads
+            if param in ('ON', 'OFF'):
+                response = hv.query(CMD='SET', PAR=param, CH=num_channels)
+            else:
+                response = hv.query(CMD='SET', PAR=param, CH=num_channels, VAL=value)
+            if 'CMD:OK' in response:
+                return {ch: None for ch in channels}
+        except Exception:
+            pass
+    errors = {}
+    for ch in channels:
+        try:
+            hv.channels[ch].set(param, value)
+            errors[ch] = None
+        except Exception as e:
+            errors[ch] = str(e)
+    return errors
+
+
+def all_channels_off(hv, num_channels):
+    """Turn every channel OFF, with one broadcast command if the firmware takes it
+
+    Returns {channel: error message or None}.
+    """
+    return set_channels(hv, 'OFF', 0, range(num_channels), num_channels)
+
+
+def check_setpoint(param, value):
+    """value as a float if it may be written to param, raises ValueError if not"""
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError(f"{param} must be a finite number, not {value}")
+    if param in SETPOINT_LIMITS:
+        low, high = SETPOINT_LIMITS[param]
+        if not low <= value <= high:
+            raise ValueError(f"{param} must be between {low:g} and {high:g} {LIMIT_UNITS[param]}")
+    return value
+
+
+def readback_error(param, written, value):
+    """Message if a read back setpoint differs from the written one, else None"""
+    if value is None:
+        return None
+    tolerance = max(WRITE_TOLERANCE.get(param, 0.0), abs(written) * 1e-3)
+    if abs(value - written) > tolerance:
+        return f"{param} reads back {value:g} instead of {written:g}"
+    return None
+
+
+def off_state(status_word):
+    """'off', 'ramping down', 'on' or 'unknown' for a STAT word read after OFF"""
+    if status_word is None:
+        return 'unknown'
+    if not status_word & 1:
+        return 'off'
+    if status_word & 4:
+        return 'ramping down'
+    return 'on'
+
+
+class PollSettings:
+    """Polling periods shared by all devices (seconds)"""
+
+    def __init__(self, interval=2.0, min_interval=0.5, max_interval=10.0,
+                 ramp_interval=0.5, setpoint_period=30.0):
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        # Faster period used while any channel of the device is ramping
+        self.ramp_interval = ramp_interval
+        # How often setpoints are read back when nothing was written
+        self.setpoint_period = setpoint_period
+
+
+class Device:
+    """One supply with its own I/O worker, readout, history and poll scheduler"""
+
+    def __init__(self, label, conn_type, address, deliver, call_later, cancel,
+                 settings, on_snapshot, on_poll_error, transport="caenpy",
+                 alarms=None, on_alarm=None, on_link=None, metrics=None,
+                 bursts=None, on_burst=None):
+        self.label = label
+        self.conn_type = conn_type
+        self.address = address
+        self.transport = transport
+        self.settings = settings
+        self.on_snapshot = on_snapshot
+        self.on_poll_error = on_poll_error
+        self.alarms = alarms
+        self.on_alarm = on_alarm
+        # on_link(device) after every change of link.state
+        self.on_link = on_link
+        # Shared hv_metrics.Metrics, None to leave the link uninstrumented
+        self.metrics = metrics
+        # Shared hv_burst.BurstTrigger, on_burst(device, burst) after each capture
+        self.bursts = bursts
+        self.on_burst = on_burst
+        self.deliver = deliver
+        self.call_later = call_later
+        self.cancel = cancel
+
+        self.idn = None
+        self.num_channels = 0
+        self.connected = False
+        self.reader = None
+        self.history = None
+        self.recorder = None
+        # Ramp engines and sequences working on this device, they want the ramp interval
+        self.fast_poll = set()
+        # Channels switched off by this program, only touched on the worker thread
+        self.commanded_off = set()
+        self.link = LinkHealth()
+        # The hv_burst.Burst being captured, regular polling pauses meanwhile
+        self.burst = None
+        self._want_polling = False
+        self._open_generation = 0
+        self._watchdog = None
+        self._reconnect_handle = None
+        # (on_done, on_error) of emergency OFFs waiting for a lost link to come back
+        self._pending_off = []
+
+        self.worker = DeviceWorker(deliver, name=f"hv-io-{label}")
+        self.poller = PollScheduler(call_later, cancel, self._poll_cycle,
+                                    interval=settings.interval,
+                                    min_interval=settings.min_interval,
+                                    max_interval=settings.max_interval)
+
+    @property
+    def name(self):
+        return f"{self.label} {self.address}"
+
+    @property
+    def record_dir_name(self):
+        """Directory name for this device's recordings, derived from its address"""
+        return re.sub(r'[^A-Za-z0-9_.-]+', '_', self.address).strip('_') or self.label
+
+    @property
+    def online(self):
+        """True while the link answers, False while it is being reopened"""
+        return self.connected and self.link.up
+
+    def connect(self, on_done, on_error):
+        """Open the link on the worker thread, on_done(self) once idn and channels are known
+
+        on_error(TimeoutError) if that takes longer than CONNECT_TIMEOUT,
+        the GUI never waits for the open itself.
+        """
+        def connected(info):
+            from hv_history import HistoryStore
+            self.idn, self.num_channels = info
+            self.history = HistoryStore(self.num_channels)
+            self.connected = True
+            self.poller.reset()
+            self.link.set_state(UP)
+            on_done(self)
+
+        self._open(connected, on_error)
+
+    def _open(self, on_done, on_error):
+        """Open the link on the worker with a watchdog, results come back on our thread"""
+        self._open_generation += 1
+        generation = self._open_generation
+
+        def read_device_info(hv):
+            num_channels = hv.channels_count
+            reader = TieredReader(BatchedReader(hv, num_channels),
+                                  slow_period=self.settings.setpoint_period)
+            return hv.idn, num_channels, reader
+
+        def opened(info):
+            if generation != self._open_generation:
+                return
+            self._cancel_watchdog()
+            idn, num_channels, self.reader = info
+            on_done((idn, num_channels))
+
+        def failed(error):
+            if generation != self._open_generation:
+                return
+            self._cancel_watchdog()
+            on_error(error)
+
+        def timed_out():
+            self._watchdog = None
+            if generation != self._open_generation:
+                return
+            # The worker is stuck in the open, leave it behind
+            self._open_generation += 1
+            self._replace_worker()
+            on_error(TimeoutError(f"no answer from {self.address} within {CONNECT_TIMEOUT:g} s"))
+
+        def open_handle():
+            hv = open_supply(self.conn_type, self.address, self.transport)
+            return hv if self.metrics is None else InstrumentedSupply(hv, self.metrics, self.label)
+
+        self._start_watchdog(CONNECT_TIMEOUT, timed_out)
+        self.worker.open(open_handle, read_device_info, on_done=opened, on_error=failed)
+
+    def _start_watchdog(self, seconds, func):
+        self._cancel_watchdog()
+        self._watchdog = self.call_later(int(seconds * 1000), func)
+
+    def _cancel_watchdog(self):
+        if self._watchdog is not None:
+            self.cancel(self._watchdog)
+            self._watchdog = None
+
+    def _replace_worker(self):
+        """Give up a worker that may be blocked on the link and start a fresh one"""
+        old = self.worker
+        self.worker = DeviceWorker(self.deliver, name=f"hv-io-{self.label}")
+        # Closes the old handle whenever its blocked call returns
+        old.stop(timeout=0)
+
+    def _link_lost(self, reason):
+        """Drop a link that stopped answering and start reopening it"""
+        if not self.connected or not self.link.up:
+            return
+        self.poller.reset()
+        self._cancel_watchdog()
+        self._replace_worker()
+        self.reader = None
+        self.link.lost(reason)
+        self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        delay = self.link.next_delay()
+        self._reconnect_handle = self.call_later(int(delay * 1000), self._reconnect)
+        if self.on_link is not None:
+            self.on_link(self)
+
+    def _reconnect(self):
+        self._reconnect_handle = None
+        if not self.connected:
+            return
+
+        def reconnected(info):
+            idn, num_channels = info
+            if num_channels != self.num_channels:
+                # Another supply answers at this address, do not drive it blindly
+                failed(ValueError(f"found {num_channels} channels instead of {self.num_channels}"))
+                return
+            self.idn = idn
+            self.link.reconnected()
+            # Ahead of the first poll: the worker runs PRIORITY_SAFETY jobs first
+            pending, self._pending_off = self._pending_off, []
+            for on_done, on_error in pending:
+                self.emergency_off(on_done, on_error)
+            if self.on_link is not None:
+                self.on_link(self)
+            if self._want_polling:
+                self.poller.start()
+
+        def failed(error):
+            if not self.connected:
+                return
+            self.link.last_error = str(error)
+            self._schedule_reconnect()
+
+        self.link.set_state(RECONNECTING)
+        self._open(reconnected, failed)
+
+    def submit(self, priority, func, on_done=None, on_error=None):
+        self.worker.submit(priority, func, on_done=on_done, on_error=on_error)
+
+    def write(self, channel, settings, on_done=None, on_error=None):
+        """Write [(param, value), ...] to one channel in order, currents in Amperes"""
+        def write_settings(hv):
+            for param, value in settings:
+                # The supply takes currents in microamps
+                hv.channels[channel].set(param, value * 1e6 if param in CURRENT_PARAMETERS else value)
+                self.note_write(channel, param, value)
+
+        self.submit(PRIORITY_WRITE, write_settings, on_done, on_error)
+
+    def hold_voltage(self, channel, on_done=None, on_error=None):
+        """Set VSET to VMON read just before, stopping a ramp where it is; on_done(volts)"""
+        def hold(hv):
+            vmon = float(hv.get_single_channel_parameter('VMON', channel))
+            hv.channels[channel].set('VSET', vmon)
+            self.note_write(channel, 'VSET', vmon)
+            return vmon
+
+        self.submit(PRIORITY_WRITE, hold, on_done, on_error)
+
+    def write_many(self, writes, on_done=None, on_error=None):
+        """Write [(channel, param, value), ...] setpoints in one job and read them back
+
+        A value going to every channel is sent as one broadcast SET, and only
+        the parameters written are read back, one broadcast each, instead of
+        a full refresh.  on_done({(channel, param): {'value': ..., 'error': ...}})
+        with the read back value (None if it could not be read) and the write
+        or mismatch error, if any.
+        """
+        requested = self._setpoints(writes)
+        self.submit(PRIORITY_WRITE, lambda hv: self._write_setpoints(hv, requested),
+                    on_done, on_error)
+
+    def apply_setpoints(self, writes, on_done=None, on_error=None):
+        """Like write_many, but write only the setpoints that differ from the supply's
+
+        The requested setpoints are read once, one broadcast per parameter,
+        and the results carry 'changed': False for those already in place.
+        """
+        requested = self._setpoints(writes)
+
+        def apply(hv):
+            current = self.reader.read_back(list(requested))
+            changes = {key: value for key, value in requested.items()
+                       if current.get(key) is None or readback_error(key[1], value, current[key])}
+            results = {key: {'value': current[key], 'error': None, 'changed': False}
+                       for key in requested if key not in changes}
+            for key, result in self._write_setpoints(hv, changes).items():
+                results[key] = dict(result, changed=True)
+            return results
+
+        self.submit(PRIORITY_WRITE, apply, on_done, on_error)
+
+    def read_setpoints(self, on_done=None, on_error=None):
+        """on_done({(channel, param): value}) with every setpoint read from the supply"""
+        num_channels = self.num_channels
+        self.submit(PRIORITY_READ, lambda hv: self.reader.read_back(
+            [(ch, param) for param in SLOW_PARAMETERS for ch in range(num_channels)]),
+            on_done, on_error)
+
+    @staticmethod
+    def _setpoints(writes):
+        """{(channel, param): value} of [(channel, param, value)], the last value counts"""
+        for _, param, _ in writes:
+            if param not in SLOW_PARAMETERS:
+                raise ValueError(f"{param} cannot be written")
+        return {(channel, param): check_setpoint(param, value) for channel, param, value in writes}
+
+    def _write_setpoints(self, hv, requested):
+        """Write {(channel, param): value} and read back what was written, on the worker"""
+        # Same parameter and value on several channels: one set_channels() call
+        batches = {}
+        for (channel, param), value in requested.items():
+            batches.setdefault((param, value), []).append(channel)
+        results = {}
+        for (param, value), channels in batches.items():
+            # The supply takes currents in microamps
+            raw = value * 1e6 if param in CURRENT_PARAMETERS else value
+            for channel, error in set_channels(hv, param, raw, channels, self.num_channels).items():
+                results[(channel, param)] = {'value': None, 'error': error}
+                if error is None:
+                    self.note_write(channel, param, value)
+        written = [key for key, result in results.items() if result['error'] is None]
+        if written:
+            for (channel, param), value in self.reader.read_back(written).items():
+                results[(channel, param)] = {
+                    'value': value,
+                    'error': readback_error(param, requested[(channel, param)], value),
+                }
+        return results
+
+    def switch(self, channel, on, on_done=None, on_error=None):
+        """Turn a channel ON or OFF, OFF is queued as a safety command"""
+        def set_output(hv):
+            if on:
+                self.commanded_off.discard(channel)
+            else:
+                self.commanded_off.add(channel)
+            hv.channels[channel].set('ON' if on else 'OFF', 0)
+
+        self.submit(PRIORITY_WRITE if on else PRIORITY_SAFETY, set_output, on_done, on_error)
+
+    def emergency_off(self, on_done=None, on_error=None):
+        """Turn all channels OFF ahead of everything queued and read back STAT
+
+        on_done({channel: {'error': ..., 'state': ...}}), state as off_state().
+        While the link is being reopened the worker has no handle, so the OFF
+        waits and goes out first thing once it is back; see off_pending.
+        """
+        if self.connected and not self.link.up:
+            self._pending_off.append((on_done, on_error))
+            return
+        num_channels = self.num_channels
+
+        def turn_off(hv):
+            self.commanded_off.update(range(num_channels))
+            errors = all_channels_off(hv, num_channels)
+            readings = [ChannelReading(ch) for ch in range(num_channels)]
+            try:
+                words = BatchedReader(hv, num_channels).read_parameter('STAT', readings)
+            except Exception:
+                words = [None] * num_channels
+            return {ch: {'error': errors[ch],
+                         'state': off_state(None if words[ch] is None else int(words[ch]))}
+                    for ch in range(num_channels)}
+
+        self.submit(PRIORITY_SAFETY, turn_off, on_done, on_error)
+
+    @property
+    def off_pending(self):
+        """True while an emergency OFF waits for the link to come back"""
+        return bool(self._pending_off)
+
+    def note_write(self, channel, param, value):
+        """Record a setpoint write, must be called from the worker thread"""
+        if self.reader is not None:
+            self.reader.note_write(channel, param, value)
+
+    @property
+    def polling(self):
+        return self.poller.running
+
+    @property
+    def poll_interval(self):
+        return self.poller.current_interval
+
+    def start_polling(self):
+        """Poll periodically, from the next reconnect on while the link is down"""
+        self._want_polling = True
+        if self.online:
+            self.poller.start()
+
+    def stop_polling(self):
+        self._want_polling = False
+        self.poller.stop()
+
+    def refresh(self):
+        """Read all channels now, or right after the cycle in flight"""
+        if self.online:
+            self.poller.trigger()
+
+    def start_recording(self, directory):
+        if self.recorder is None:
+            from hv_recorder import SnapshotRecorder
+            from hv_rollup import RollupStore
+            metadata = {'label': self.label, 'conn_type': self.conn_type,
+                        'address': self.address, 'idn': self.idn,
+                        'channels': self.num_channels}
+            directory = os.path.join(directory, self.record_dir_name)
+            self.recorder = SnapshotRecorder(directory, metadata=metadata,
+                                             rollup=RollupStore(directory))
+            self.recorder.start()
+
+    def stop_recording(self):
+        """Close the recorder, returns the number of records it wrote"""
+        if self.recorder is None:
+            return 0
+        recorder, self.recorder = self.recorder, None
+        recorder.close()
+        return recorder.records_written
+
+    def disconnect(self):
+        """Stop polling and recording and release the link"""
+        self.connected = False
+        self._stop_link()
+        self.poller.reset()
+        self.stop_recording()
+        self.worker.close()
+        self.reader = None
+
+    def stop(self, timeout=2.0, after_queued=False):
+        """End the worker thread, e.g. when the application closes
+
+        after_queued lets the worker send the writes still queued first,
+        see DeviceWorker.stop().
+        """
+        self.connected = False
+        self._stop_link()
+        self.poller.stop()
+        self.stop_recording()
+        self.worker.stop(timeout, after_queued=after_queued)
+
+    def _stop_link(self):
+        self._open_generation += 1
+        self._cancel_watchdog()
+        if self._reconnect_handle is not None:
+            self.cancel(self._reconnect_handle)
+            self._reconnect_handle = None
+        self.link.set_state(CLOSED)
+        pending, self._pending_off = self._pending_off, []
+        for _, on_error in pending:
+            if on_error is not None:
+                on_error(ConnectionError(f"{self.label} closed before its link came back, "
+                                         f"OFF was not sent"))
+
+    def _poll_cycle(self, done):
+        """Queue one readout on the worker, behind any OFF or setpoint writes"""
+        if self.burst is not None:
+            # The link is busy with the burst, the next cycle comes after it
+            done()
+            return
+        reader = self.reader
+        worker = self.worker
+        queued = time.perf_counter()
+
+        def read(hv):
+            snapshot = reader.read_snapshot(abort=self.worker.safety_pending)
+            alarms = []
+            if self.alarms is not None:
+                # Right here on the worker, an OFF action does not wait for the UI
+                alarms = self.alarms.evaluate(self, snapshot, self.commanded_off)
+                for alarm in alarms:
+                    self._act_on_alarm(hv, alarm)
+            trigger = None
+            if self.bursts is not None and self.link.up:
+                trigger = self.bursts.check(self, snapshot)
+            return snapshot, alarms, trigger
+
+        def stalled():
+            self._watchdog = None
+            self._link_lost(f"no answer for {CYCLE_TIMEOUT:g} s")
+
+        def on_done(result):
+            snapshot, alarms, trigger = result
+            if worker is not self.worker:
+                return
+            self._cancel_watchdog()
+            self._observe_cycle(queued, snapshot.duration)
+            if alarms and self.on_alarm is not None:
+                self.on_alarm(self, alarms)
+            if not self.link.record_cycle(snapshot):
+                # Keep the last good values on display rather than a row of errors
+                self._cycle_failed(RuntimeError(f"no readings: {self.link.last_error}"), done)
+                return
+            if self.connected:
+                self.history.record(snapshot)
+                if self.recorder is not None:
+                    self.recorder.submit(snapshot)
+                # Spend the bandwidth saved on setpoints on faster monitors during ramps
+                ramping = bool(self.fast_poll) or any(reading.is_ramping for reading in snapshot)
+                self.poller.interval = (self.settings.ramp_interval if ramping
+                                        else self.settings.interval)
+                self.on_snapshot(self, snapshot)
+                if trigger is not None and self.burst is None:
+                    self._start_burst(*trigger, snapshot.timestamp)
+            done()
+
+        def on_error(e):
+            if worker is not self.worker:
+                return
+            self._cancel_watchdog()
+            self._observe_cycle(queued, None)
+            if isinstance(e, ReadAborted):
+                if self.connected:
+                    self.on_poll_error(self, e)
+                done()
+                return
+            self.link.record_failure(e)
+            self._cycle_failed(e, done)
+
+        self._start_watchdog(CYCLE_TIMEOUT, stalled)
+        worker.submit(PRIORITY_READ, read, on_done=on_done, on_error=on_error)
+
+    def _start_burst(self, channel, reason, timestamp):
+        """Spend the link on VMON/IMON of one channel for the post-trigger window"""
+        from hv_burst import Burst
+        burst = Burst(self, channel, reason, timestamp, self.bursts.post_seconds)
+        self.burst = burst
+        worker = self.worker
+
+        def next_slice():
+            worker.submit(PRIORITY_READ, lambda hv: burst.capture(hv, worker.safety_pending),
+                          on_done=sliced, on_error=failed)
+
+        def sliced(over):
+            if over or worker is not self.worker or not self.connected:
+                self._finish_burst(burst)
+            else:
+                next_slice()
+
+        def failed(error):
+            burst.error = str(error)
+            self._finish_burst(burst)
+
+        next_slice()
+
+    def _finish_burst(self, burst):
+        if self.burst is burst:
+            self.burst = None
+        if self.history is not None:
+            # Views into the ring buffer, copied before they can be overwritten
+            window = self.history.window(burst.channel, burst.trigger_time - self.bursts.pre_seconds,
+                                         burst.trigger_time)
+            burst.pre = {name: values.copy() for name, values in window.items()}
+        if self.bursts.directory is not None:
+            try:
+                burst.save(os.path.join(self.bursts.directory, self.record_dir_name))
+            except OSError as e:
+                burst.error = f"not saved: {e}"
+        if self.on_burst is not None:
+            self.on_burst(self, burst)
+
+    def _observe_cycle(self, queued, read_time):
+        """Record the read time and the whole cycle, read_time None for a failed read"""
+        if self.metrics is None:
+            return
+        failed = read_time is None
+        if not failed:
+            self.metrics.observe('hv_poll_read_seconds', read_time, device=self.label)
+        self.metrics.observe('hv_poll_cycle_seconds', time.perf_counter() - queued, failed,
+                             device=self.label)
+
+    def _cycle_failed(self, error, done):
+        if self.connected:
+            self.on_poll_error(self, error)
+        if self.link.consecutive_failures >= LOST_AFTER:
+            self._link_lost(f"{LOST_AFTER} failed reads: {self.link.last_error}")
+        else:
+            done()
+
+    def _act_on_alarm(self, hv, alarm):
+        """Carry out the part of an alarm's action that this device can do itself"""
+        action = alarm.rule.action
+        try:
+            if action == ACTION_OFF:
+                self.commanded_off.add(alarm.channel)
+                hv.channels[alarm.channel].set('OFF', 0)
+            elif action in (ACTION_DEVICE_OFF, ACTION_ALL_OFF):
+                self.commanded_off.update(range(self.num_channels))
+                errors = [error for error in all_channels_off(hv, self.num_channels).values() if error]
+                if errors:
+                    alarm.action_error = "; ".join(errors)
+        except Exception as e:
+            alarm.action_error = str(e)
+
+
+class DeviceManager:
+    """The supplies driven by this process, each on its own link and worker"""
+
+    def __init__(self, deliver, call_later, cancel, settings=None, on_snapshot=None,
+                 on_poll_error=None, transport="caenpy", alarms=None, on_alarm=None,
+                 on_link=None, metrics=None, bursts=None, on_burst=None):
+        self.deliver = deliver
+        self.call_later = call_later
+        self.cancel = cancel
+        self.settings = settings or PollSettings()
+        self.on_snapshot = on_snapshot
+        self.on_poll_error = on_poll_error
+        self.transport = transport
+        # Shared by all devices, see hv_alarm
+        self.alarms = alarms
+        self.on_alarm = on_alarm
+        self.on_link = on_link
+        self.metrics = metrics
+        # Shared by all devices, see hv_burst
+        self.bursts = bursts
+        self.on_burst = on_burst
+        self.devices = []
+        self._next_label = 0
+
+    def __iter__(self):
+        return iter(self.devices)
+
+    def __len__(self):
+        return len(self.devices)
+
+    @property
+    def connected(self):
+        return [device for device in self.devices if device.connected]
+
+    def add(self, conn_type, address, device_id=None):
+        """Create a device for a link, connect() it to open the link
+
+        conn_type "Daemon" attaches to device number device_id of a running
+        hv_daemon at address instead of opening the supply directly.
+        """
+        label = f"D{self._next_label}"
+        if conn_type == "Daemon":
+            device = RemoteDevice(label, address, device_id or 0, self.deliver,
+                                  self.on_snapshot, self.on_poll_error, self.on_link)
+        else:
+            device = Device(label, conn_type, address, self.deliver,
+                            self.call_later, self.cancel, self.settings,
+                            self.on_snapshot, self.on_poll_error, self.transport,
+                            self.alarms, self.on_alarm, self.on_link, self.metrics,
+                            self.bursts, self.on_burst)
+        for other in self.devices:
+            if other.address == device.address:
+                raise ValueError(f"{device.address} is already in use by {other.label}")
+        self._next_label += 1
+        self.devices.append(device)
+        return device
+
+    def remove(self, device):
+        """Disconnect a device and end its worker"""
+        device.disconnect()
+        if self.alarms is not None:
+            self.alarms.forget(device)
+        if self.bursts is not None:
+            self.bursts.forget(device)
+        # The worker ends on its own once the writes queued before are sent
+        device.stop(timeout=0, after_queued=True)
+        self.devices.remove(device)
+
+    def find(self, label):
+        for device in self.devices:
+            if device.label == label:
+                return device
+        return None
+
+    def emergency_off(self, on_result, on_error):
+        """Turn every channel of every device OFF, all devices at once
+
+        Each device's worker runs its OFF ahead of anything queued, so the
+        devices go off in parallel.  on_result(device, results) and
+        on_error(device, error) are called as the devices answer.
+        """
+        devices = self.connected
+        for device in devices:
+            device.emergency_off(on_done=lambda results, d=device: on_result(d, results),
+                                 on_error=lambda e, d=device: on_error(d, e))
+        return devices
+
+    def channels(self):
+        """(device, channel) of every connected channel in display order"""
+        return [(device, ch) for device in self.connected for ch in range(device.num_channels)]
+
+    def stop(self):
+        for device in self.devices:
+            device.stop()
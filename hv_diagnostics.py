@@ -0,0 +1,88 @@
+"""
+Diagnostics panel
+
+A table of the hv_metrics histograms (count, errors, p50/p95/p99 and max
+latency per device, command and channel), refreshed every couple of
+seconds, with an export of the Prometheus text format.
+"""
+from tkinter import ttk, filedialog
+
+# Seconds between table updates
+REFRESH_PERIOD = 2.0
+
+COLUMNS = (
+    ('metric', "Metric", 170),
+    ('device', "Device", 60),
+    ('command', "Command", 110),
+    ('channel', "CH", 40),
+    ('count', "Count", 70),
+    ('errors', "Errors", 60),
+    ('p50', "p50", 70),
+    ('p95', "p95", 70),
+    ('p99', "p99", 70),
+    ('max', "Max", 70),
+)
+
+
+def format_seconds(value):
+    if value is None:
+        return ""
+    if value < 1e-3:
+        return f"{value * 1e6:.0f} us"
+    if value < 1:
+        return f"{value * 1e3:.1f} ms"
+    return f"{value:.2f} s"
+
+
+class DiagnosticsPanel(ttk.Frame):
+    """Latency table of a Metrics registry"""
+
+    def __init__(self, master, metrics):
+        super().__init__(master)
+        self.metrics = metrics
+        self._after = None
+
+        buttons = ttk.Frame(self)
+        buttons.pack(fill="x", padx=5, pady=5)
+        ttk.Button(buttons, text="Export Prometheus...",
+                   command=self.export).pack(side="left", padx=2)
+        ttk.Button(buttons, text="Reset", command=self.reset).pack(side="left", padx=2)
+
+        self.table = ttk.Treeview(self, columns=[key for key, _, _ in COLUMNS],
+                                  show="headings")
+        for key, title, width in COLUMNS:
+            self.table.heading(key, text=title)
+            self.table.column(key, width=width, anchor="e" if key not in
+                              ('metric', 'device', 'command') else "w")
+        self.table.pack(fill="both", expand=True, padx=5, pady=5)
+        self.update_table()
+
+    def update_table(self):
+        """Show the current metrics and schedule the next update"""
+        self.table.delete(*self.table.get_children())
+        for row in self.metrics.rows():
+            self.table.insert("", "end", values=(
+                row['metric'], row.get('device', ""), row.get('command', ""),
+                row.get('channel', ""), row['count'], row['errors'],
+                format_seconds(row['p50']), format_seconds(row['p95']),
+                format_seconds(row['p99']), format_seconds(row['max'])))
+        self._after = self.after(int(REFRESH_PERIOD * 1000), self.update_table)
+
+    def reset(self):
+        self.metrics.reset()
+        self.after_cancel(self._after)
+        self.update_table()
+
+    def export(self):
+        path = filedialog.asksaveasfilename(title="Export metrics", defaultextension=".prom",
+                                            filetypes=[("Prometheus text", "*.prom"),
+                                                       ("All files", "*")])
+        if path:
+            with open(path, 'w') as f:
+                f.write(self.metrics.prometheus())
+
+    def destroy(self):
+        if self._after is not None:
+            self.after_cancel(self._after)
+            self._after = None
+        super().destroy()
@@ -0,0 +1,68 @@
+"""
+Display model for the channel status table
+
+DisplayModel remembers the options last applied to every widget and only
+calls configure for the ones whose text or style actually changed, so a
+refresh where nothing moved costs no Tk calls at all.
+"""
+
+# Status column text and background, in order of precedence
+STATUS_STYLES = {
+    'overcurrent': ("OVERCUR", "red"),
+    'ramping': ("RAMPING", "yellow"),
+    'on': ("ON", "lightgreen"),
+    'off': ("OFF", "lightgray"),
+}
+
+
+def channel_cells(vset, vmon, iset, imon, status, is_ramping, overcurrent):
+    """Formatted text and style of each cell of a channel row, None values are left alone"""
+    cells = {}
+    if vset is not None:
+        cells['vset'] = {'text': f"{vset:.1f}"}
+    if vmon is not None:
+        cells['vmon'] = {'text': f"{vmon:.1f}"}
+    if iset is not None:
+        cells['iset'] = {'text': f"{iset:.2e}"}
+    if imon is not None:
+        cells['imon'] = {'text': f"{imon:.2e}"}
+
+    if overcurrent:
+        text, background = STATUS_STYLES['overcurrent']
+    elif is_ramping:
+        text, background = STATUS_STYLES['ramping']
+    elif status == "on":
+        text, background = STATUS_STYLES['on']
+    else:
+        text, background = STATUS_STYLES['off']
+    cells['status'] = {'text': text, 'background': background}
+    return cells
+
+
+class DisplayModel:
+    """Last rendered options per widget, only changes are sent to Tk"""
+
+    def __init__(self):
+        self._rendered = {}
+        self.updates = 0
+        self.skipped = 0
+
+    def set(self, widget, **options):
+        """Configure widget with the options that differ from what it shows"""
+        rendered = self._rendered.setdefault(widget, {})
+        changed = {key: value for key, value in options.items() if rendered.get(key) != value}
+        if not changed:
+            self.skipped += 1
+            return False
+        widget.config(**changed)
+        rendered.update(changed)
+        self.updates += 1
+        return True
+
+    def forget(self, widgets=None):
+        """Drop the remembered state of widgets, of all of them if None, e.g. once destroyed"""
+        if widgets is None:
+            self._rendered.clear()
+            return
+        for widget in widgets:
+            self._rendered.pop(widget, None)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Export of recorded readings to CSV, Parquet or HDF5
+
+Reads the segment files written by hv_recorder, one data directory per
+device, and writes the records of a time window and set of channels:
+
+    python hv_export.py ~/hv_data/_dev_ttyACM0 -o run.parquet --start "2024-05-01 08:00"
+    python hv_export.py ~/hv_data/* -o run.h5 --channels 0,1
+
+The segments are memory-mapped and streamed in chunks of CHUNK_SIZE
+records, so memory stays bounded and a multi-day run exports at disk
+speed.  Every file carries the device metadata (idn, address, MAXV/RUP/RDW
+per channel) and the export window: as "# key: value" lines at the top of
+a CSV, in the Parquet schema metadata, and as attributes of the HDF5
+groups.  Devices are named after their directories, with _2, _3, ... added
+when two directories have the same name.  Parquet needs pyarrow and HDF5
+needs h5py.
+"""
+import argparse
+import csv
+import json
+import os
+import time
+
+import numpy as np
+
+from hv_recorder import RECORD_DTYPE, load_index, iter_records
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+FORMATS = ("csv", "parquet", "hdf5")
+
+# Records per chunk read and written
+CHUNK_SIZE = 262144
+
+COLUMNS = RECORD_DTYPE.names
+
+TIME_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d")
+
+
+def parse_time(text):
+    """Epoch seconds of a local "YYYY-mm-dd[ HH:MM[:SS]]" or of a number, None if blank"""
+    if text is None or not str(text).strip():
+        return None
+    text = str(text).strip()
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    for fmt in TIME_FORMATS:
+        try:
+            return time.mktime(time.strptime(text, fmt))
+        except ValueError:
+            continue
+    raise ValueError(f"cannot read time {text!r}, use YYYY-mm-dd HH:MM:SS")
+
+
+def format_for(path):
+    """Export format from the file extension"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".parquet", ".pq"):
+        return "parquet"
+    if ext in (".h5", ".hdf5", ".hdf"):
+        return "hdf5"
+    return "csv"
+
+
+def device_name(directory):
+    return os.path.basename(os.path.normpath(directory))
+
+
+def device_names(directories):
+    """Unique device names of the directories, a repeated base name gets _2, _3, ..."""
+    names = []
+    for directory in directories:
+        base = name = device_name(directory)
+        suffix = 2
+        while name in names:
+            name = f"{base}_{suffix}"
+            suffix += 1
+        names.append(name)
+    return names
+
+
+def metadata(directories, t0=None, t1=None, channels=None):
+    """What the export file says about its contents"""
+    devices = {}
+    for name, directory in zip(device_names(directories), directories):
+        index = load_index(directory)
+        settings = {}
+        for segment in index['segments']:
+            # Later segments know newer settings
+            for ch, values in (segment.get('settings') or {}).items():
+                settings.setdefault(ch, {}).update(values)
+        segments = index['segments']
+        devices[name] = {
+            'directory': os.path.abspath(directory),
+            'device': index.get('device'),
+            'settings': settings,
+            'start': segments[0]['start'] if segments else None,
+            'end': segments[-1].get('end') if segments else None,
+        }
+    return {
+        'exported': time.time(),
+        'start': t0,
+        'end': t1,
+        'channels': None if channels is None else sorted(channels),
+        'columns': {'vmon': "V", 'vset': "V", 'imon': "A", 'iset': "A", 'time': "s since epoch"},
+        'devices': devices,
+    }
+
+
+def export(directories, path, fmt=None, t0=None, t1=None, channels=None,
+           chunk_size=CHUNK_SIZE, progress=None):
+    """Write the records of the given device directories, returns the number of rows
+
+    progress(rows) is called after every chunk, e.g. to update a GUI.
+    """
+    fmt = fmt or format_for(path)
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown export format {fmt!r}")
+    if fmt == "parquet" and pyarrow is None:
+        raise RuntimeError("pyarrow is needed for Parquet export")
+    if fmt == "hdf5" and h5py is None:
+        raise RuntimeError("h5py is needed for HDF5 export")
+    channels = None if channels is None else set(channels)
+    info = metadata(directories, t0, t1, channels)
+    writer = {"csv": _export_csv, "parquet": _export_parquet, "hdf5": _export_hdf5}[fmt]
+
+    def chunks(directory):
+        return iter_records(directory, t0, t1, channels, chunk_size)
+
+    # Write next to the target and rename, an aborted export leaves no half file behind
+    tmp = path + ".part"
+    try:
+        rows = writer(directories, tmp, info, chunks, progress)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return rows
+
+
+def _export_csv(directories, path, info, chunks, progress):
+    rows = 0
+    with open(path, 'w', newline='') as f:
+        for key, value in info.items():
+            f.write(f"# {key}: {json.dumps(value)}\n")
+        csv.writer(f).writerow(("device",) + COLUMNS)
+        for name, directory in zip(device_names(directories), directories):
+            # The device name goes into the row format, so rows need no string columns
+            prefix = name.replace(",", "_").replace("%", "%%") + ","
+            for chunk in chunks(directory):
+                table = np.column_stack([chunk[name].astype(np.float64) for name in COLUMNS])
+                np.savetxt(f, table, delimiter=",",
+                           fmt=[prefix + "%.6f", "%d", "%d", "%.8g", "%.8g", "%.8g", "%.8g"])
+                rows += len(chunk)
+                if progress:
+                    progress(rows)
+    return rows
+
+
+def _export_parquet(directories, path, info, chunks, progress):
+    schema = pyarrow.schema(
+        [('device', pyarrow.string())]
+        + [(name, pyarrow.from_numpy_dtype(RECORD_DTYPE[name])) for name in COLUMNS],
+        metadata={b'hv': json.dumps(info).encode()})
+    rows = 0
+    with pyarrow.parquet.ParquetWriter(path, schema, compression='zstd') as writer:
+        for name, directory in zip(device_names(directories), directories):
+            for chunk in chunks(directory):
+                columns = [pyarrow.array([name] * len(chunk), pyarrow.string())]
+                columns += [pyarrow.array(np.ascontiguousarray(chunk[column]))
+                            for column in COLUMNS]
+                writer.write_table(pyarrow.Table.from_arrays(columns, schema=schema))
+                rows += len(chunk)
+                if progress:
+                    progress(rows)
+    return rows
+
+
+def _export_hdf5(directories, path, info, chunks, progress):
+    rows = 0
+    with h5py.File(path, 'w') as f:
+        f.attrs['hv'] = json.dumps({key: value for key, value in info.items() if key != 'devices'})
+        for name, directory in zip(device_names(directories), directories):
+            group = f.create_group(name)
+            group.attrs['hv'] = json.dumps(info['devices'][name])
+            dataset = group.create_dataset('records', shape=(0,), maxshape=(None,),
+                                           dtype=RECORD_DTYPE, chunks=(16384,),
+                                           compression='gzip', compression_opts=1)
+            for chunk in chunks(directory):
+                start = len(dataset)
+                dataset.resize((start + len(chunk),))
+                dataset[start:] = chunk
+                rows += len(chunk)
+                if progress:
+                    progress(rows)
+    return rows
+
+
+def channel_list(text):
+    """Channels from "0,1,3", None if blank"""
+    if text is None or not text.strip():
+        return None
+    return [int(ch) for ch in text.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("directories", nargs="+", help="recording directories, one per device")
+    parser.add_argument("-o", "--output", required=True, help="file to write")
+    parser.add_argument("--format", choices=FORMATS, help="default: from the file extension")
+    parser.add_argument("--start", help="first time to export, YYYY-mm-dd HH:MM:SS or epoch")
+    parser.add_argument("--end", help="last time to export")
+    parser.add_argument("--channels", help="comma separated channels, default all")
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    rows = export(args.directories, args.output, args.format, parse_time(args.start),
+                  parse_time(args.end), channel_list(args.channels))
+    print(f"{rows} records written to {args.output} in {time.monotonic() - started:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
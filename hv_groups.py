@@ -0,0 +1,105 @@
+"""
+Channel groups and bulk setpoint writes
+
+A group is a named list of channels, written as in recipes ("D0:1", or "1"
+for channel 1 of the first device), kept in a JSON object such as
+
+    {"detector A": ["D0:0", "D0:1"], "guard rings": ["D0:2", "D1:2"]}
+
+The group ALL always stands for every connected channel.  bulk_write()
+applies [(param, value), ...] to all channels of a group with one
+Device.write_many() job per device, so the devices are written in
+parallel, a value common to all channels of a device goes out as one
+broadcast SET, and only the written parameters are read back.
+"""
+import json
+
+from hv_devices import check_setpoint
+
+ALL = "all"
+
+
+class ChannelGroups:
+    """Named channel lists, resolved against the connected devices when used"""
+
+    def __init__(self, groups=None):
+        self.groups = {}
+        for name, specs in (groups or {}).items():
+            self.define(name, specs)
+
+    def names(self):
+        return [ALL] + sorted(self.groups)
+
+    def define(self, name, specs):
+        """Add or replace a group, raises ValueError for a malformed channel"""
+        name = name.strip()
+        if not name or name == ALL:
+            raise ValueError(f"invalid group name {name!r}")
+        specs = [str(spec).strip() for spec in specs if str(spec).strip()]
+        if not specs:
+            raise ValueError(f"group {name!r} has no channels")
+        for spec in specs:
+            if not spec.rpartition(":")[2].isdigit():
+                raise ValueError(f"invalid channel {spec!r}, use e.g. D0:1")
+        self.groups[name] = specs
+
+    def remove(self, name):
+        self.groups.pop(name, None)
+
+    def resolve(self, name, devices):
+        """[(device, channel)] of a group, raises ValueError for unknown or absent channels"""
+        from hv_sequence import resolve_channel
+        if name == ALL:
+            return devices.channels()
+        if name not in self.groups:
+            raise ValueError(f"no channel group {name!r}")
+        targets = []
+        for spec in self.groups[name]:
+            target = resolve_channel(spec, devices)
+            if target not in targets:
+                targets.append(target)
+        return targets
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.groups, f, indent=1)
+
+
+def bulk_write(targets, settings, on_done):
+    """Write settings [(param, value)] to every (device, channel) in targets
+
+    on_done(results) once all devices answered, results maps (device,
+    channel, param) to {'value': read back value, 'error': message or None}.
+    Raises ValueError before writing anything if a value is out of range.
+    """
+    settings = [(param, check_setpoint(param, value)) for param, value in settings]
+    by_device = {}
+    for device, channel in targets:
+        by_device.setdefault(device, []).append(channel)
+    results = {}
+    pending = set(by_device)
+    if not pending:
+        on_done(results)
+        return
+
+    def answered(device, device_results):
+        for (channel, param), result in device_results.items():
+            results[(device, channel, param)] = result
+        pending.discard(device)
+        if not pending:
+            on_done(results)
+
+    def failed(device, channels, error):
+        answered(device, {(channel, param): {'value': None, 'error': str(error)}
+                          for channel in channels for param, _ in settings})
+
+    for device, channels in by_device.items():
+        writes = [(channel, param, value) for param, value in settings for channel in channels]
+        device.write_many(writes,
+                          on_done=lambda r, d=device: answered(d, r),
+                          on_error=lambda e, d=device, c=channels: failed(d, c, e))
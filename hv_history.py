@@ -0,0 +1,113 @@
+"""
+In-memory history of channel readings
+
+Every channel keeps fixed-capacity, preallocated NumPy ring buffers for the
+timestamp, VMON, IMON, VSET, ISET and the STAT word, so memory stays constant
+however long the GUI runs.  Each sample is written twice, at i and at
+i + capacity, which keeps the most recent samples one contiguous slice:
+appends are O(1) and any time window comes back as views, without copying.
+"""
+import numpy as np
+
+# Roughly 4.5 days at the default 2 s poll period, about 10 MB per channel
+DEFAULT_CAPACITY = 200_000
+
+# Stored quantities and their dtypes
+FIELDS = (
+    ('time', np.float64),
+    ('vmon', np.float32),
+    ('imon', np.float32),
+    ('vset', np.float32),
+    ('iset', np.float32),
+    ('status', np.uint16),
+)
+
+
+class ChannelHistory:
+    """Ring buffers holding the latest readings of one channel"""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self._arrays = {}
+        for name, dtype in FIELDS:
+            fill = 0 if np.issubdtype(dtype, np.integer) else np.nan
+            self._arrays[name] = np.full(2 * capacity, fill, dtype=dtype)
+        # Next write position in [0, capacity) and number of valid samples
+        self._head = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, t, vmon, imon, vset, iset, status):
+        """Add one sample, overwriting the oldest once the buffer is full"""
+        lower = self._head
+        upper = lower + self.capacity
+        values = (t, vmon, imon, vset, iset, status)
+        for (name, _), value in zip(FIELDS, values):
+            if value is None:
+                value = 0 if name == 'status' else np.nan
+            array = self._arrays[name]
+            array[lower] = value
+            array[upper] = value
+        self._head = (lower + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def _span(self):
+        """Slice of the doubled buffers holding the stored samples, oldest first"""
+        stop = self._head + self.capacity
+        return slice(stop - self._count, stop)
+
+    def field(self, name):
+        """View of one quantity over everything stored"""
+        return self._arrays[name][self._span()]
+
+    def window(self, t0=None, t1=None):
+        """Views of all quantities for samples with t0 <= time <= t1
+
+        The views share memory with the ring buffers, they stay valid until
+        the samples they cover are overwritten.
+        """
+        span = self._span()
+        times = self._arrays['time'][span]
+        start = 0 if t0 is None else int(np.searchsorted(times, t0, side='left'))
+        stop = len(times) if t1 is None else int(np.searchsorted(times, t1, side='right'))
+        window = slice(span.start + start, span.start + stop)
+        return {name: self._arrays[name][window] for name, _ in FIELDS}
+
+    def latest(self):
+        """Most recent sample as a dict, None if nothing was recorded"""
+        if not self._count:
+            return None
+        index = self._head + self.capacity - 1
+        return {name: self._arrays[name][index].item() for name, _ in FIELDS}
+
+    def clear(self):
+        self._head = 0
+        self._count = 0
+
+
+class HistoryStore:
+    """Histories of all channels of one supply, fed with refresh snapshots"""
+
+    def __init__(self, num_channels, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.channels = [ChannelHistory(capacity) for _ in range(num_channels)]
+
+    def __len__(self):
+        return len(self.channels)
+
+    def __getitem__(self, channel):
+        return self.channels[channel]
+
+    def record(self, snapshot):
+        """Append every channel reading of a snapshot"""
+        for reading in snapshot:
+            if reading.channel >= len(self.channels):
+                continue
+            self.channels[reading.channel].append(
+                snapshot.timestamp, reading.vmon, reading.imon,
+                reading.vset, reading.iset, reading.status_word)
+
+    def window(self, channel, t0=None, t1=None):
+        return self.channels[channel].window(t0, t1)
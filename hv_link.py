@@ -0,0 +1,153 @@
+"""
+Link health and reconnection of the supply links
+
+LinkHealth follows one device's link: its state, the smoothed cycle and
+per-transaction latency, the share of failed reads and the reconnect
+attempts.  A link counts as lost after LOST_AFTER poll cycles in a row
+without a single good reading, or when one cycle gets no answer for
+CYCLE_TIMEOUT seconds; Device then reopens it with exponential backoff
+between RECONNECT_MIN and RECONNECT_MAX seconds, keeping the last good
+snapshot on display in the meantime.
+"""
+import random
+import time
+
+# Link states
+CONNECTING = "connecting"
+UP = "up"
+LOST = "lost"
+RECONNECTING = "reconnecting"
+CLOSED = "closed"
+
+# Seconds an open (handle, idn, channel count) may take
+CONNECT_TIMEOUT = 10.0
+
+# Seconds one poll cycle may go without an answer
+CYCLE_TIMEOUT = 15.0
+
+# Failed poll cycles in a row before the link is given up and reopened
+LOST_AFTER = 3
+
+# Reconnect backoff (seconds)
+RECONNECT_MIN = 1.0
+RECONNECT_MAX = 60.0
+
+# Weight of the newest cycle in the smoothed latency and error rate
+SMOOTHING = 0.2
+
+
+class LinkHealth:
+    """State and quality of one device link, updated on the consumer thread"""
+
+    def __init__(self):
+        self.state = CONNECTING
+        self.since = time.time()
+        # time.time() of the last cycle that returned good readings
+        self.last_ok = None
+        self.latency = None
+        self.transaction_latency = None
+        self.error_rate = 0.0
+        self.cycles = 0
+        self.failed_cycles = 0
+        self.consecutive_failures = 0
+        self.reconnects = 0
+        self.attempts = 0
+        self.last_error = None
+        self.next_retry = None
+
+    @property
+    def up(self):
+        return self.state == UP
+
+    def set_state(self, state):
+        if state != self.state:
+            self.state = state
+            self.since = time.time()
+
+    def record_cycle(self, snapshot):
+        """Account for one finished poll cycle, returns True if it read anything"""
+        self.cycles += 1
+        channels = len(snapshot)
+        bad = sum(1 for reading in snapshot if reading.errors or reading.status_word is None)
+        self.error_rate += SMOOTHING * ((bad / channels if channels else 1.0) - self.error_rate)
+        if channels and bad == channels:
+            self.failed_cycles += 1
+            self.consecutive_failures += 1
+            self.last_error = "; ".join(snapshot[0].errors) or "no readings"
+            return False
+        self.consecutive_failures = 0
+        self.last_ok = snapshot.timestamp
+        self.latency = self._smooth(self.latency, snapshot.duration)
+        if snapshot.transactions:
+            self.transaction_latency = self._smooth(self.transaction_latency,
+                                                    snapshot.duration / snapshot.transactions)
+        return True
+
+    def record_failure(self, error):
+        """Account for a poll cycle that raised instead of returning a snapshot"""
+        self.cycles += 1
+        self.failed_cycles += 1
+        self.consecutive_failures += 1
+        self.error_rate += SMOOTHING * (1.0 - self.error_rate)
+        self.last_error = str(error)
+
+    def lost(self, reason):
+        self.set_state(LOST)
+        self.last_error = reason
+        self.consecutive_failures = 0
+
+    def next_delay(self):
+        """Seconds to wait before the next reconnect attempt, doubling per attempt"""
+        delay = min(RECONNECT_MIN * 2 ** self.attempts, RECONNECT_MAX)
+        self.attempts += 1
+        # Links on the same hub should not all retry at the same instant
+        delay *= random.uniform(0.8, 1.0)
+        self.next_retry = time.time() + delay
+        return delay
+
+    def reconnected(self):
+        self.set_state(UP)
+        self.reconnects += 1
+        self.attempts = 0
+        self.next_retry = None
+
+    def to_dict(self):
+        return {
+            'state': self.state,
+            'since': self.since,
+            'last_ok': self.last_ok,
+            'latency': self.latency,
+            'transaction_latency': self.transaction_latency,
+            'error_rate': self.error_rate,
+            'cycles': self.cycles,
+            'failed_cycles': self.failed_cycles,
+            'reconnects': self.reconnects,
+            'attempts': self.attempts,
+            'last_error': self.last_error,
+            'next_retry': self.next_retry,
+        }
+
+    def update(self, data):
+        """Take over a to_dict() result, e.g. one sent by the daemon"""
+        for key, value in data.items():
+            if key in self.to_dict():
+                setattr(self, key, value)
+
+    def describe(self):
+        if self.state == UP:
+            text = "link up"
+            if self.latency is not None:
+                text += f", {self.latency * 1000:.0f} ms/cycle"
+            if self.error_rate >= 0.01:
+                text += f", {self.error_rate:.0%} errors"
+            return text
+        text = f"link {self.state}"
+        if self.next_retry is not None and self.state != CLOSED:
+            text += f", retry in {max(self.next_retry - time.time(), 0):.1f} s"
+        if self.last_error:
+            text += f" ({self.last_error})"
+        return text
+
+    @staticmethod
+    def _smooth(average, value):
+        return value if average is None else average + SMOOTHING * (value - average)
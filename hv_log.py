@@ -0,0 +1,89 @@
+"""
+Logging for the HV GUI and the daemon
+
+Messages go through the standard logging module.  stdout and the optional
+log file are written by a QueueListener thread, so logging never waits for
+the console or the disk.  The Command Log widget is fed by LogPanel, which
+buffers lines and inserts them in one batch per frame, keeping at most
+max_lines so the widget does not slow down over long runs.
+"""
+import collections
+import logging
+import logging.handlers
+import queue
+import sys
+
+LOGGER_NAME = "hvgui"
+
+# Lines kept in the Command Log widget
+MAX_LINES = 2000
+
+LOG_FORMAT = "[%(asctime)s] %(message)s"
+TIME_FORMAT = "%H:%M:%S"
+
+
+def get_logger():
+    return logging.getLogger(LOGGER_NAME)
+
+
+def start_logging(level=logging.INFO, log_file=None):
+    """Write log records to stdout, and to log_file if given, from a background thread
+
+    Returns the QueueListener, stop() it on exit to flush what is queued.
+    """
+    logger = get_logger()
+    logger.setLevel(level)
+    formatter = logging.Formatter(LOG_FORMAT, TIME_FORMAT)
+
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if log_file:
+        handlers.append(logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=10 * 1024 * 1024, backupCount=5))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    listener = logging.handlers.QueueListener(records, *handlers)
+    listener.start()
+    return listener
+
+
+class LogPanel(logging.Handler):
+    """Logging handler showing records in a Tk text widget, bounded and batched"""
+
+    def __init__(self, text, max_lines=MAX_LINES, interval_ms=100):
+        super().__init__()
+        self.text = text
+        self.max_lines = max_lines
+        self.interval_ms = interval_ms
+        self.setFormatter(logging.Formatter(LOG_FORMAT, TIME_FORMAT))
+        # Appended from any thread, drained on the Tk thread
+        self._pending = collections.deque(maxlen=max_lines)
+        self._lines = 0
+        self.text.after(self.interval_ms, self._flush)
+
+    def emit(self, record):
+        try:
+            self._pending.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+    def clear(self):
+        self._pending.clear()
+        self.text.delete("1.0", "end")
+        self._lines = 0
+
+    def _flush(self):
+        if self._pending:
+            lines = []
+            while self._pending:
+                lines.append(self._pending.popleft())
+            self.text.insert("end", "\n".join(lines) + "\n")
+            self._lines += len(lines)
+            if self._lines > self.max_lines:
+                # Line n of the widget starts at index "n.0"
+                self.text.delete("1.0", f"{self._lines - self.max_lines + 1}.0")
+                self._lines = self.max_lines
+            self.text.see("end")
+        self.text.after(self.interval_ms, self._flush)
@@ -0,0 +1,217 @@
+"""
+Latency metrics of the supply links and the poll loop
+
+Every transaction on a supply handle goes through InstrumentedSupply, which
+times it into a LatencyHistogram per device, command ("MON VMON", "SET
+VSET", ...) and channel ("all" for the broadcast form).  The poll loop adds
+the read time and the end-to-end time of each cycle, the GUI the time it
+spends applying a snapshot.
+
+Histograms use fixed power-of-two buckets from 100 us to about 26 s, so
+recording is a clock read, a bisect and two additions, cheap enough to leave
+on all the time.  Each histogram is only written from one thread (the
+device's worker, or the UI/service thread); readers may see a count one
+observation ahead of the sum, which is fine for display and scraping.
+Percentiles are interpolated within the buckets.
+
+Metrics.prometheus() renders everything in the Prometheus text format.
+"""
+import bisect
+import threading
+import time
+
+# Upper bounds of the histogram buckets (seconds), the last bucket is +Inf
+BUCKETS = tuple(1e-4 * 2 ** i for i in range(19))
+
+# Metric names and their help texts
+HELP = {
+    'hv_command_seconds': "Duration of one command to a supply",
+    'hv_poll_read_seconds': "Time the device worker spent reading one snapshot",
+    'hv_poll_cycle_seconds': "Poll cycle from queueing the read to its delivery",
+    'hv_ui_apply_seconds': "Time the UI spent showing one snapshot",
+}
+
+
+class LatencyHistogram:
+    """Counts of observations per latency bucket, plus errors"""
+
+    __slots__ = ('counts', 'count', 'sum', 'max', 'errors')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.errors = 0
+
+    def observe(self, seconds, error=False):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if error:
+            self.errors += 1
+
+    def percentile(self, fraction):
+        """Estimated latency below which fraction of the observations fall"""
+        counts = list(self.counts)
+        total = sum(counts)
+        if not total:
+            return None
+        rank = fraction * total
+        seen = 0
+        for i, n in enumerate(counts):
+            if n and seen + n >= rank:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / n, self.max)
+            seen += n
+        return self.max
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    @property
+    def error_rate(self):
+        return self.errors / self.count if self.count else 0.0
+
+
+class Metrics:
+    """Histograms by metric name and labels, shared by all devices"""
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name, **labels):
+        """The histogram for name and labels, created on first use"""
+        key = (name, tuple(labels.items()))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, LatencyHistogram())
+        return histogram
+
+    def observe(self, name, seconds, error=False, **labels):
+        self.histogram(name, **labels).observe(seconds, error)
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+
+    def items(self):
+        """[(name, labels, histogram)] sorted by name and labels"""
+        with self._lock:
+            items = list(self._histograms.items())
+        return [(name, dict(labels), histogram)
+                for (name, labels), histogram in sorted(items, key=lambda item: item[0])]
+
+    def rows(self):
+        """Summary per histogram as dicts, e.g. for JSON or a table"""
+        return [dict(labels, metric=name, count=h.count, errors=h.errors,
+                     error_rate=h.error_rate, mean=h.mean, max=h.max,
+                     p50=h.percentile(0.5), p95=h.percentile(0.95), p99=h.percentile(0.99))
+                for name, labels, h in self.items()]
+
+    def prometheus(self):
+        """All histograms in the Prometheus text exposition format"""
+        lines = []
+        described = set()
+        for name, labels, h in self.items():
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+            label_text = ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+            prefix = label_text + "," if label_text else ""
+            counts = list(h.counts)
+            cumulative = 0
+            for bound, n in zip(BUCKETS, counts):
+                cumulative += n
+                lines.append(f'{name}_bucket{{{prefix}le="{bound:g}"}} {cumulative}')
+            cumulative += counts[-1]
+            lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {cumulative}')
+            lines.append(f"{name}_sum{{{label_text}}} {h.sum:.9g}")
+            lines.append(f"{name}_count{{{label_text}}} {cumulative}")
+        errors = [(name, labels, h) for name, labels, h in self.items() if h.errors]
+        if errors:
+            lines.append("# HELP hv_errors_total Observations that ended in an error")
+            lines.append("# TYPE hv_errors_total counter")
+            for name, labels, h in errors:
+                label_text = ",".join(f'{key}="{_escape(value)}"'
+                                      for key, value in dict(labels, metric=name).items())
+                lines.append(f"hv_errors_total{{{label_text}}} {h.errors}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class InstrumentedSupply:
+    """Supply handle wrapper that times every transaction into metrics"""
+
+    def __init__(self, hv, metrics, device):
+        self._hv = hv
+        self._metrics = metrics
+        self._device = device
+        self.channels = [_InstrumentedChannel(self, channel, ch)
+                         for ch, channel in enumerate(hv.channels)]
+
+    def _timed(self, command, channel, func, *args, **kwargs):
+        histogram = self._metrics.histogram('hv_command_seconds', device=self._device,
+                                            command=command, channel=channel)
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            histogram.observe(time.perf_counter() - start, True)
+            raise
+        histogram.observe(time.perf_counter() - start)
+        return result
+
+    def query(self, CMD, PAR, CH=None, **kwargs):
+        # CH set to the number of channels addresses all of them
+        channel = "all" if CH is not None and CH == len(self.channels) else str(CH)
+        return self._timed(f"{CMD} {PAR}", channel, self._hv.query,
+                           CMD=CMD, PAR=PAR, CH=CH, **kwargs)
+
+    def get_single_channel_parameter(self, param, channel):
+        return self._timed(f"MON {param}", str(channel),
+                           self._hv.get_single_channel_parameter, param, channel)
+
+    def set_single_channel_parameter(self, param, channel, value):
+        return self._timed(f"SET {param}", str(channel),
+                           self._hv.set_single_channel_parameter, param, channel, value)
+
+    def close(self):
+        if hasattr(self._hv, 'close'):
+            self._hv.close()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        # idn, channels_count and the like may talk to the supply as well
+        return self._timed(name, "-", getattr, self._hv, name)
+
+
+class _InstrumentedChannel:
+    def __init__(self, supply, channel, ch):
+        self._supply = supply
+        self._channel = channel
+        self._ch = str(ch)
+
+    def set(self, param, value):
+        return self._supply._timed(f"SET {param}", self._ch, self._channel.set, param, value)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        # e.g. channel_status, a property that reads the supply
+        value = self._supply._timed(name, self._ch, getattr, self._channel, name)
+        if callable(value):
+            return lambda *args, **kwargs: self._supply._timed(name, self._ch, value,
+                                                               *args, **kwargs)
+        return value
@@ -0,0 +1,292 @@
+"""
+Live strip chart of VMON and IMON
+
+The chart keeps, per channel and quantity, the minimum and maximum of the
+samples falling in each pixel column of the time window.  New samples only
+touch the newest column, and a redraw moves the coordinates of one canvas
+line per trace, so the cost of a tick depends on the plot width and not on
+how much history there is.  The full history is only binned again, with
+vectorized NumPy, when the window or the plot size changes; the part of a
+long window older than the in-memory history comes from the recorded
+hv_rollup buckets.
+"""
+import tkinter as tk
+from tkinter import ttk
+
+import numpy as np
+
+# Selectable time windows (label, seconds)
+WINDOWS = (
+    ("1 min", 60),
+    ("10 min", 600),
+    ("1 h", 3600),
+    ("6 h", 6 * 3600),
+    ("24 h", 24 * 3600),
+    ("7 d", 7 * 86400),
+    ("30 d", 30 * 86400),
+)
+
+CHANNEL_COLORS = ("blue", "red", "green", "orange", "purple", "brown", "magenta", "cyan")
+
+# Plotted quantities (history field, axis title, label format)
+QUANTITIES = (
+    ('vmon', "VMON (V)", "{:.1f}"),
+    ('imon', "IMON (A)", "{:.2e}"),
+)
+
+MARGIN_LEFT = 70
+MARGIN_RIGHT = 10
+MARGIN_TOP = 10
+PANEL_GAP = 25
+
+
+def data_range(columns):
+    """Lowest and highest value over (lo, hi) column pairs, padded if flat"""
+    if columns:
+        lo = np.concatenate([c[0] for c in columns])
+        hi = np.concatenate([c[1] for c in columns])
+        if not np.isnan(lo).all():
+            lo, hi = float(np.nanmin(lo)), float(np.nanmax(hi))
+            if hi - lo <= abs(hi) * 1e-9:
+                pad = abs(hi) * 0.05 or 1e-9
+                lo, hi = lo - pad, hi + pad
+            return lo, hi
+    return 0.0, 1.0
+
+
+class DecimatedTrace:
+    """Minimum and maximum of one quantity per pixel column of a time window"""
+
+    def __init__(self, columns, seconds_per_column):
+        self.columns = columns
+        self.seconds_per_column = seconds_per_column
+        self.lo = np.full(columns, np.nan)
+        self.hi = np.full(columns, np.nan)
+        # Absolute index of the newest column, columns are time // seconds_per_column
+        self.last_bin = None
+
+    def add(self, t, value):
+        """Fold one sample into its column"""
+        b = int(t // self.seconds_per_column)
+        self._advance(b)
+        if value is None or np.isnan(value) or b <= self.last_bin - self.columns:
+            return
+        i = b % self.columns
+        if not value >= self.lo[i]:
+            self.lo[i] = value
+        if not value <= self.hi[i]:
+            self.hi[i] = value
+
+    def load(self, times, values, highs=None):
+        """Rebuild all columns from arrays of samples sorted by time
+
+        highs, if given, are the maxima of samples that stand for a range,
+        e.g. rollup buckets with their minima in values.
+        """
+        self.lo[:] = np.nan
+        self.hi[:] = np.nan
+        self.last_bin = None
+        if not len(times):
+            return
+        bins = (times // self.seconds_per_column).astype(np.int64)
+        self.last_bin = int(bins[-1])
+        if highs is None:
+            highs = values
+        keep = (bins > self.last_bin - self.columns) & ~np.isnan(values)
+        bins, values, highs = bins[keep], values[keep], highs[keep]
+        if not len(bins):
+            return
+        starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+        index = bins[starts] % self.columns
+        self.lo[index] = np.minimum.reduceat(values, starts)
+        self.hi[index] = np.maximum.reduceat(highs, starts)
+
+    def ordered(self, end_bin):
+        """Column minima and maxima, oldest first, for the window ending at end_bin"""
+        self._advance(end_bin)
+        order = np.arange(end_bin - self.columns + 1, end_bin + 1) % self.columns
+        return self.lo[order], self.hi[order]
+
+    def _advance(self, b):
+        if self.last_bin is None:
+            self.last_bin = b
+            return
+        if b <= self.last_bin:
+            return
+        # Columns that scrolled in are empty until samples land in them
+        if b - self.last_bin >= self.columns:
+            self.lo[:] = np.nan
+            self.hi[:] = np.nan
+        else:
+            cleared = np.arange(self.last_bin + 1, b + 1) % self.columns
+            self.lo[cleared] = np.nan
+            self.hi[cleared] = np.nan
+        self.last_bin = b
+
+
+class StripChart(ttk.Frame):
+    """VMON and IMON strip chart of several channel histories
+
+    series is a list of (name, ChannelHistory), one line per series and quantity.
+    archives, if given, holds per series None or a function (t0, t1,
+    max_points=...) returning hv_rollup rows, used for times before the history.
+    """
+
+    def __init__(self, parent, series, archives=None):
+        super().__init__(parent)
+        self.series = series
+        self.archives = archives or [None] * len(series)
+        self.traces = {}
+        self.items = {}
+        self.latest_time = None
+        for _, channel_history in series:
+            latest = channel_history.latest()
+            if latest is not None:
+                self.latest_time = max(self.latest_time or 0.0, latest['time'])
+        self._redraw_pending = False
+        self._rebuild_pending = False
+
+        controls = ttk.Frame(self)
+        controls.pack(fill="x")
+        ttk.Label(controls, text="Window:").pack(side="left")
+        self.window_var = tk.StringVar(value=WINDOWS[1][0])
+        window_combo = ttk.Combobox(controls, textvariable=self.window_var, width=8,
+                                    values=[label for label, _ in WINDOWS], state="readonly")
+        window_combo.pack(side="left", padx=5)
+        window_combo.bind("<<ComboboxSelected>>", lambda e: self.schedule_rebuild())
+
+        self.channel_vars = []
+        for name, _ in self.series:
+            var = tk.BooleanVar(value=True)
+            ttk.Checkbutton(controls, text=name, variable=var,
+                            command=self.schedule_redraw).pack(side="left", padx=3)
+            self.channel_vars.append(var)
+
+        self.canvas = tk.Canvas(self, background="white", height=320, highlightthickness=0)
+        self.canvas.pack(fill="both", expand=True)
+        self.canvas.bind("<Configure>", lambda e: self.schedule_rebuild())
+        self.schedule_rebuild()
+
+    @property
+    def window_seconds(self):
+        return dict(WINDOWS)[self.window_var.get()]
+
+    def add_snapshot(self, snapshot, first_series=0):
+        """Fold a snapshot into the traces and queue a redraw
+
+        Channel ch of the snapshot is series first_series + ch.
+        """
+        self.latest_time = max(self.latest_time or 0.0, snapshot.timestamp)
+        if self.traces:
+            for reading in snapshot:
+                for name, _, _ in QUANTITIES:
+                    trace = self.traces.get((first_series + reading.channel, name))
+                    if trace is not None:
+                        trace.add(snapshot.timestamp, getattr(reading, name))
+        self.schedule_redraw()
+
+    def schedule_redraw(self):
+        if not self._redraw_pending:
+            self._redraw_pending = True
+            self.after_idle(self.redraw)
+
+    def schedule_rebuild(self):
+        if not self._rebuild_pending:
+            self._rebuild_pending = True
+            self.after_idle(self.rebuild)
+
+    def rebuild(self):
+        """Bin the history again for a new window or plot size"""
+        self._rebuild_pending = False
+        columns = max(self.canvas.winfo_width() - MARGIN_LEFT - MARGIN_RIGHT, 10)
+        seconds_per_column = self.window_seconds / columns
+        self.canvas.delete("all")
+        self.traces = {}
+        self.items = {}
+
+        t0 = None if self.latest_time is None else self.latest_time - self.window_seconds
+        for ch, (_, channel_history) in enumerate(self.series):
+            window = channel_history.window(t0)
+            if len(window['time']) and self.latest_time is None:
+                self.latest_time = float(window['time'][-1])
+            rows = None
+            archive = self.archives[ch]
+            if archive is not None and t0 is not None and (
+                    not len(window['time']) or window['time'][0] > t0 + seconds_per_column):
+                end = float(window['time'][0]) if len(window['time']) else self.latest_time
+                rows = archive(t0, end, max_points=columns)
+                rows = rows[rows['time'] < end]
+            color = CHANNEL_COLORS[ch % len(CHANNEL_COLORS)]
+            for name, _, _ in QUANTITIES:
+                trace = DecimatedTrace(columns, seconds_per_column)
+                values = window[name].astype(np.float64)
+                if rows is not None and len(rows):
+                    trace.load(np.concatenate([rows['time'], window['time']]),
+                               np.concatenate([rows[f"{name}_min"], values]),
+                               np.concatenate([rows[f"{name}_max"], values]))
+                else:
+                    trace.load(window['time'], values)
+                self.traces[(ch, name)] = trace
+                self.items[(ch, name)] = self.canvas.create_line(0, 0, 0, 0, fill=color,
+                                                                 state="hidden")
+        self.items['axes'] = []
+        self.redraw()
+
+    def redraw(self):
+        """Move the trace lines to the current columns, O(plot width)"""
+        self._redraw_pending = False
+        if not self.traces or self.latest_time is None:
+            return
+        width = self.canvas.winfo_width()
+        height = self.canvas.winfo_height()
+        panel_height = (height - MARGIN_TOP - PANEL_GAP * len(QUANTITIES)) / len(QUANTITIES)
+        if panel_height < 10:
+            return
+        for item in self.items['axes']:
+            self.canvas.delete(item)
+        self.items['axes'] = []
+
+        visible = [ch for ch, var in enumerate(self.channel_vars) if var.get()]
+        for panel, (name, title, fmt) in enumerate(QUANTITIES):
+            top = MARGIN_TOP + panel * (panel_height + PANEL_GAP)
+            columns = {}
+            for ch in range(len(self.channel_vars)):
+                trace = self.traces[(ch, name)]
+                columns[ch] = trace.ordered(int(self.latest_time // trace.seconds_per_column))
+
+            lo, hi = data_range([columns[ch] for ch in visible])
+            scale = panel_height / (hi - lo)
+
+            for ch in range(len(self.channel_vars)):
+                item = self.items[(ch, name)]
+                col_lo, col_hi = columns[ch]
+                valid = np.flatnonzero(~np.isnan(col_lo))
+                if ch not in visible or not len(valid):
+                    self.canvas.itemconfigure(item, state="hidden")
+                    continue
+                # Two points per column, its minimum and its maximum
+                x = np.repeat(valid + MARGIN_LEFT, 2)
+                y = np.empty(2 * len(valid))
+                y[0::2] = top + (hi - col_lo[valid]) * scale
+                y[1::2] = top + (hi - col_hi[valid]) * scale
+                points = np.column_stack((x, y)).ravel()
+                if len(points) < 4:
+                    points = np.r_[points, points]
+                self.canvas.coords(item, *points.tolist())
+                self.canvas.itemconfigure(item, state="normal")
+
+            axes = self.items['axes']
+            axes.append(self.canvas.create_rectangle(MARGIN_LEFT, top, width - MARGIN_RIGHT,
+                                                     top + panel_height, outline="gray"))
+            axes.append(self.canvas.create_text(MARGIN_LEFT - 4, top, anchor="ne",
+                                                text=fmt.format(hi), font=("TkDefaultFont", 8)))
+            axes.append(self.canvas.create_text(MARGIN_LEFT - 4, top + panel_height, anchor="se",
+                                                text=fmt.format(lo), font=("TkDefaultFont", 8)))
+            axes.append(self.canvas.create_text(MARGIN_LEFT + 4, top + 2, anchor="nw",
+                                                text=title, font=("TkDefaultFont", 8, "bold")))
+            axes.append(self.canvas.create_text(MARGIN_LEFT, top + panel_height + 2, anchor="nw",
+                                                text=f"-{self.window_var.get()}",
+                                                font=("TkDefaultFont", 8)))
+            axes.append(self.canvas.create_text(width - MARGIN_RIGHT, top + panel_height + 2,
+                                                anchor="ne", text="now",
+                                                font=("TkDefaultFont", 8)))
@@ -0,0 +1,136 @@
+"""
+Polling scheduler for the channel monitor
+
+At most one poll cycle is in flight at a time.  The next cycle is scheduled
+when the previous one has finished, so a slow link stretches the period
+instead of piling up reads, and requests that arrive while a cycle is running
+are coalesced into a single follow-up cycle.  The period adapts to the
+measured cycle latency so polling never takes more than a set share of the
+link time.
+"""
+import time
+
+
+class PollScheduler:
+    """Run poll cycles one at a time with an interval adapted to their latency"""
+
+    def __init__(self, call_later, cancel, run_cycle, interval=2.0,
+                 min_interval=0.5, max_interval=10.0, max_load=0.5):
+        # call_later(ms, func) -> handle and cancel(handle), e.g. Tk's after/after_cancel.
+        # run_cycle(done) starts a cycle and calls done() from the same thread when finished.
+        self.call_later = call_later
+        self.cancel = cancel
+        self.run_cycle = run_cycle
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        # Largest fraction of the time the link may spend on polling
+        self.max_load = max_load
+
+        self.latency = None
+        self.cycles = 0
+        self.coalesced = 0
+        self._running = False
+        self._handle = None
+        self._in_flight = False
+        self._pending = False
+        self._forced = False
+        self._started_at = 0.0
+        self._generation = 0
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def busy(self):
+        return self._in_flight
+
+    @property
+    def current_interval(self):
+        """Period actually used, the configured one stretched to the link latency"""
+        interval = self.interval
+        if self.latency is not None:
+            interval = max(interval, self.latency / self.max_load)
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def start(self):
+        """Start periodic polling, does nothing if it already runs"""
+        if self._running:
+            return
+        self._running = True
+        if not self._in_flight:
+            self._schedule(0)
+
+    def stop(self):
+        """Stop periodic polling, a cycle in flight is allowed to finish"""
+        self._running = False
+        self._pending = False
+        self._cancel_tick()
+
+    def trigger(self):
+        """Run a cycle as soon as possible, coalesced with one already running"""
+        if self._in_flight:
+            if self._pending:
+                self.coalesced += 1
+            self._pending = True
+            return
+        self._cancel_tick()
+        self._begin()
+
+    def reset(self):
+        """Forget the measured latency and any cycle in flight, e.g. after reconnecting"""
+        self.stop()
+        self._generation += 1
+        self._in_flight = False
+        self.latency = None
+
+    def _schedule(self, delay):
+        self._cancel_tick()
+        self._handle = self.call_later(int(delay * 1000), self._tick)
+
+    def _cancel_tick(self):
+        if self._handle is not None:
+            self.cancel(self._handle)
+            self._handle = None
+
+    def _tick(self):
+        self._handle = None
+        forced, self._forced = self._forced, False
+        if not self._running and not forced:
+            return
+        if self._in_flight:
+            # Only reachable through a stale timer, the finishing cycle reschedules
+            self.coalesced += 1
+            self._pending = True
+            return
+        self._begin()
+
+    def _begin(self):
+        self._in_flight = True
+        self._started_at = time.monotonic()
+        generation = self._generation
+        try:
+            self.run_cycle(lambda: self._done(generation))
+        except Exception:
+            self._in_flight = False
+            raise
+
+    def _done(self, generation):
+        if generation != self._generation or not self._in_flight:
+            return
+        self._in_flight = False
+        self.cycles += 1
+        elapsed = time.monotonic() - self._started_at
+        # Exponential average so one slow cycle does not swing the period
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency += 0.3 * (elapsed - self.latency)
+
+        if self._pending:
+            self._pending = False
+            self._forced = True
+            self._schedule(0)
+        elif self._running:
+            self._schedule(max(self.current_interval - elapsed, 0))
@@ -0,0 +1,129 @@
+"""
+Setpoint profiles
+
+A profile is a named set of VSET/ISET/RUP/RDW/MAXV values per channel,
+kept in one JSON file per supply, named after its idn:
+
+    {"idn": "CAEN DT8034N, SN:1234", "on_connect": "stand A",
+     "profiles": {"stand A": {"0": {"VSET": 100, "ISET": 1e-05}, "1": {...}}}}
+
+Currents are in Amperes.  apply_profile() uses Device.apply_setpoints(),
+so only the setpoints that differ from the supply's are written; a profile
+named in "on_connect" is applied whenever the supply connects.
+"""
+import json
+import os
+import re
+
+from hv_readout import SLOW_PARAMETERS
+from hv_devices import check_setpoint
+
+
+def profile_file(directory, idn):
+    """File holding the profiles of the supply with this idn"""
+    name = re.sub(r'[^A-Za-z0-9_.-]+', "_", idn or "unknown").strip("_")
+    return os.path.join(directory, f"{name}.json")
+
+
+def parse_profile(data):
+    """{channel: {param: value}} of a profile as stored, raises ValueError if malformed"""
+    settings = {}
+    for channel, values in data.items():
+        if not str(channel).isdigit():
+            raise ValueError(f"invalid channel {channel!r}")
+        for param, value in values.items():
+            if param not in SLOW_PARAMETERS:
+                raise ValueError(f"{param} is not a setpoint")
+            settings.setdefault(int(channel), {})[param] = float(value)
+    return settings
+
+
+def profile_writes(settings, num_channels):
+    """[(channel, param, value)] of a profile
+
+    Raises ValueError for absent channels and for values out of range.
+    """
+    writes = []
+    for channel, values in sorted(settings.items()):
+        if not 0 <= channel < num_channels:
+            raise ValueError(f"the supply has no channel {channel}")
+        writes += [(channel, param, check_setpoint(param, value))
+                   for param, value in values.items()]
+    return writes
+
+
+class ProfileStore:
+    """Profiles of every supply, one file per idn in directory"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _load(self, idn):
+        path = profile_file(self.directory, idn)
+        if not os.path.exists(path):
+            return {'idn': idn, 'on_connect': None, 'profiles': {}}
+        with open(path) as f:
+            return json.load(f)
+
+    def _save(self, data):
+        os.makedirs(self.directory, exist_ok=True)
+        path = profile_file(self.directory, data['idn'])
+        with open(path + ".tmp", 'w') as f:
+            json.dump(data, f, indent=1)
+        os.replace(path + ".tmp", path)
+
+    def names(self, idn):
+        return sorted(self._load(idn)['profiles'])
+
+    def get(self, idn, name):
+        """{channel: {param: value}} of a profile"""
+        profiles = self._load(idn)['profiles']
+        if name not in profiles:
+            raise ValueError(f"no profile {name!r} for {idn}")
+        return parse_profile(profiles[name])
+
+    def put(self, idn, name, settings):
+        """Store settings {channel: {param: value}} under name"""
+        name = name.strip()
+        if not name:
+            raise ValueError("a profile needs a name")
+        data = self._load(idn)
+        data['profiles'][name] = {str(channel): dict(values)
+                                  for channel, values in sorted(settings.items())}
+        self._save(data)
+
+    def delete(self, idn, name):
+        data = self._load(idn)
+        data['profiles'].pop(name, None)
+        if data.get('on_connect') == name:
+            data['on_connect'] = None
+        self._save(data)
+
+    def on_connect(self, idn):
+        """Name of the profile to apply when the supply connects, or None"""
+        return self._load(idn).get('on_connect')
+
+    def set_on_connect(self, idn, name):
+        data = self._load(idn)
+        if name is not None and name not in data['profiles']:
+            raise ValueError(f"no profile {name!r} for {idn}")
+        data['on_connect'] = name
+        self._save(data)
+
+
+def capture(readings):
+    """Profile settings {channel: {param: value}} of Device.read_setpoints() results"""
+    settings = {}
+    for (channel, param), value in readings.items():
+        if value is not None:
+            settings.setdefault(channel, {})[param] = value
+    return settings
+
+
+def apply_profile(device, settings, on_done, on_error=None):
+    """Bring the device to the profile settings, writing only what differs
+
+    on_done(results) with Device.apply_setpoints() results.
+    """
+    device.apply_setpoints(profile_writes(settings, device.num_channels),
+                           on_done=on_done, on_error=on_error)
@@ -0,0 +1,294 @@
+"""
+Closed-loop voltage ramps
+
+RampEngine runs any number of ramps at once, on any channels of any
+devices.  Nothing blocks: a ramp programs RUP/RDW and VSET through the
+device's write queue and is then followed from the snapshots the poller
+already produces, so ramps cost no extra link traffic beyond their writes.
+Rates the supply's ramp generator cannot do are stepped in software, one
+VSET per snapshot.
+
+While a ramp runs, its device polls at the ramp interval.  Every snapshot
+updates VMON/IMON progress, checks the optional IMON limit (hold the
+voltage, or abort) and detects the end of the ramp.  Pausing, aborting or
+holding sets VSET to VMON, which stops the supply's ramp where it is: for
+a hardware ramp VMON is read on the worker right before that write, as the
+ramp generator may be far past the last snapshot; a software ramp holds at
+the last snapshot's VMON, its VSET being only one step ahead.
+"""
+import time
+
+# RUP/RDW range of the desktop supplies' ramp generator (V/s)
+HW_MIN_RATE = 1.0
+HW_MAX_RATE = 500.0
+
+# |VMON - target| below which a ramp counts as arrived (V)
+SETTLE_TOLERANCE = 1.0
+
+# A held ramp continues once IMON falls below this fraction of the limit
+HOLD_RELEASE = 0.9
+
+# Smallest software VSET step worth a write (V)
+MIN_STEP = 0.1
+
+# Ramp states
+RUNNING = "running"
+PAUSED = "paused"
+HOLDING = "holding"
+DONE = "done"
+ABORTED = "aborted"
+FAILED = "failed"
+
+FINISHED_STATES = (DONE, ABORTED, FAILED)
+
+# What to do when IMON reaches the limit
+LIMIT_HOLD = "hold"
+LIMIT_ABORT = "abort"
+
+
+class Ramp:
+    """One channel's ramp to a target voltage"""
+
+    def __init__(self, device, channel, target, rate, imon_limit=None, limit_action=LIMIT_HOLD):
+        self.device = device
+        self.channel = channel
+        self.target = target
+        self.rate = rate
+        self.imon_limit = imon_limit
+        self.limit_action = limit_action
+        # Slower than the ramp generator can go: step VSET from the snapshots
+        self.software = rate < HW_MIN_RATE
+        self.state = RUNNING
+        self.message = ""
+        self.vmon = None
+        self.imon = None
+        self.start_voltage = None
+        self.setpoint = None
+        self._t0 = None
+
+    @property
+    def finished(self):
+        return self.state in FINISHED_STATES
+
+    @property
+    def progress(self):
+        """Fraction of the way from the start voltage to the target, 0 to 1"""
+        if self.vmon is None or self.start_voltage is None:
+            return 0.0
+        span = self.target - self.start_voltage
+        if abs(span) < SETTLE_TOLERANCE:
+            return 1.0
+        return min(max((self.vmon - self.start_voltage) / span, 0.0), 1.0)
+
+    def to_dict(self):
+        return {
+            'device': self.device.label,
+            'channel': self.channel,
+            'target': self.target,
+            'rate': self.rate,
+            'imon_limit': self.imon_limit,
+            'limit_action': self.limit_action,
+            'software': self.software,
+            'state': self.state,
+            'message': self.message,
+            'vmon': self.vmon,
+            'imon': self.imon,
+            'progress': self.progress,
+        }
+
+    def describe(self):
+        vmon = "?" if self.vmon is None else f"{self.vmon:.1f}"
+        text = f"{self.device.label} CH{self.channel} {vmon}/{self.target:g} V {self.progress:.0%} {self.state}"
+        if self.message:
+            text += f" ({self.message})"
+        return text
+
+
+class RampEngine:
+    """Ramps followed from device snapshots, all methods run on the caller's thread
+
+    on_progress(ramp) is called after every snapshot of a ramping channel and
+    on every state change, on_finished(ramp) once a ramp is done, aborted or failed.
+    """
+
+    def __init__(self, on_progress=None, on_finished=None, clock=time.monotonic):
+        self.on_progress = on_progress
+        self.on_finished = on_finished
+        self.clock = clock
+        self.ramps = {}
+
+    def active(self, device=None):
+        return [ramp for ramp in self.ramps.values()
+                if device is None or ramp.device is device]
+
+    def find(self, device, channel):
+        return self.ramps.get((device, channel))
+
+    def start(self, device, channel, target, rate, imon_limit=None, limit_action=LIMIT_HOLD):
+        """Start ramping a channel to target volts at rate V/s, returns the Ramp"""
+        if rate <= 0:
+            raise ValueError("ramp rate must be positive")
+        if limit_action not in (LIMIT_HOLD, LIMIT_ABORT):
+            raise ValueError(f"unknown IMON limit action {limit_action!r}")
+        if (device, channel) in self.ramps:
+            raise ValueError(f"{device.label} CH{channel} is already ramping")
+
+        ramp = Ramp(device, channel, target, rate, imon_limit, limit_action)
+        self.ramps[(device, channel)] = ramp
+        self._set_fast_poll(device)
+        hw_rate = min(max(rate, HW_MIN_RATE), HW_MAX_RATE)
+        if ramp.software:
+            # VSET is stepped from the next snapshot, starting at VMON
+            settings = [('RUP', hw_rate), ('RDW', hw_rate)]
+        else:
+            ramp.setpoint = target
+            settings = [('RUP', hw_rate), ('RDW', hw_rate), ('VSET', target)]
+        device.write(channel, settings, on_error=lambda e: self._fail(ramp, e))
+        device.refresh()
+        return ramp
+
+    def pause(self, ramp):
+        """Stop at the present voltage until resume()"""
+        if ramp.state in (RUNNING, HOLDING):
+            ramp.state = PAUSED
+            self._hold_here(ramp)
+            self._report(ramp)
+
+    def resume(self, ramp):
+        if ramp.state in (PAUSED, HOLDING):
+            ramp.state = RUNNING
+            ramp.message = ""
+            self._restart(ramp)
+            self._report(ramp)
+
+    def abort(self, ramp, message="aborted"):
+        """Stop at the present voltage and end the ramp"""
+        if ramp.finished:
+            return
+        self._hold_here(ramp)
+        self._finish(ramp, ABORTED, message)
+
+    def abort_all(self, device=None):
+        for ramp in self.active(device):
+            self.abort(ramp)
+
+    def forget(self, device=None, message="device disconnected"):
+        """Drop ramps without writing to the device, e.g. once it went away"""
+        for ramp in self.active(device):
+            self.drop(ramp, message)
+
+    def drop(self, ramp, message):
+        """End a ramp without writing to the device, e.g. after the channel was turned off"""
+        self._finish(ramp, ABORTED, message)
+
+    def update(self, device, snapshot):
+        """Follow the ramps of device with a new snapshot"""
+        now = self.clock()
+        for ramp in self.active(device):
+            if ramp.channel >= len(snapshot):
+                continue
+            reading = snapshot[ramp.channel]
+            if reading.errors or reading.vmon is None:
+                continue
+            ramp.vmon, ramp.imon = reading.vmon, reading.imon
+            if ramp.start_voltage is None:
+                ramp.start_voltage = reading.vmon
+                ramp._t0 = now
+            self._step(ramp, reading, now)
+            if not ramp.finished:
+                self._report(ramp)
+
+    def _step(self, ramp, reading, now):
+        over_limit = (ramp.imon_limit is not None and ramp.imon is not None
+                      and ramp.imon >= ramp.imon_limit)
+        if ramp.state == RUNNING and over_limit:
+            message = f"IMON {ramp.imon:.2e} A reached the {ramp.imon_limit:.2e} A limit"
+            if ramp.limit_action == LIMIT_ABORT:
+                self.abort(ramp, message)
+                return
+            ramp.state = HOLDING
+            ramp.message = message
+            self._hold_here(ramp)
+            return
+        if ramp.state == HOLDING and ramp.imon is not None and ramp.imon < ramp.imon_limit * HOLD_RELEASE:
+            ramp.state = RUNNING
+            ramp.message = ""
+            self._restart(ramp)
+            return
+        if ramp.state != RUNNING:
+            return
+
+        # Only a snapshot taken after the final VSET went out can show the arrival
+        final_written = ramp.setpoint == ramp.target
+        if ramp.software:
+            direction = 1.0 if ramp.target >= ramp.start_voltage else -1.0
+            setpoint = ramp.start_voltage + direction * ramp.rate * (now - ramp._t0)
+            setpoint = min(setpoint, ramp.target) if direction > 0 else max(setpoint, ramp.target)
+            if setpoint != ramp.setpoint and (ramp.setpoint is None or setpoint == ramp.target
+                                              or abs(setpoint - ramp.setpoint) >= MIN_STEP):
+                self._write_vset(ramp, setpoint)
+
+        arrived = abs(reading.vmon - ramp.target) <= SETTLE_TOLERANCE
+        if arrived and final_written and not reading.is_ramping:
+            self._finish(ramp, DONE)
+
+    def _restart(self, ramp):
+        """Continue towards the target from where the channel is now"""
+        if ramp.software:
+            ramp.start_voltage = ramp.vmon
+            ramp._t0 = self.clock()
+        else:
+            self._write_vset(ramp, ramp.target)
+        ramp.device.refresh()
+
+    def _hold_here(self, ramp):
+        """Set VSET to where the channel is, which stops the supply's ramp"""
+        if ramp.software and ramp.vmon is not None:
+            # VSET is the last small step, the last snapshot is where the channel is
+            self._write_vset(ramp, ramp.vmon)
+            return
+
+        # The ramp generator may be far past the last snapshot: hold at VMON read on the worker
+        def held(vmon):
+            # A resume queued its VSET behind the hold, keep its target
+            if ramp.state != RUNNING:
+                ramp.setpoint = vmon
+
+        ramp.device.hold_voltage(ramp.channel, on_done=held,
+                                 on_error=lambda e: self._hold_failed(ramp, e))
+
+    def _hold_failed(self, ramp, error):
+        """The hold of an aborted ramp failed too, say so rather than look stopped"""
+        if not ramp.finished:
+            self._fail(ramp, error)
+            return
+        ramp.message = f"{ramp.message}, could not hold the voltage: {error}"
+        self._report(ramp)
+
+    def _write_vset(self, ramp, value):
+        ramp.setpoint = value
+        ramp.device.write(ramp.channel, [('VSET', value)], on_error=lambda e: self._fail(ramp, e))
+
+    def _fail(self, ramp, error):
+        self._finish(ramp, FAILED, str(error))
+
+    def _finish(self, ramp, state, message=""):
+        if ramp.finished:
+            return
+        ramp.state = state
+        ramp.message = message
+        self.ramps.pop((ramp.device, ramp.channel), None)
+        self._set_fast_poll(ramp.device)
+        self._report(ramp)
+        if self.on_finished:
+            self.on_finished(ramp)
+
+    def _set_fast_poll(self, device):
+        if self.active(device):
+            device.fast_poll.add(self)
+        else:
+            device.fast_poll.discard(self)
+
+    def _report(self, ramp):
+        if self.on_progress:
+            self.on_progress(ramp)
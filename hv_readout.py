@@ -0,0 +1,342 @@
+"""
+Batched channel readout for CAEN desktop HV power supplies
+
+The desktop protocol addresses every channel of a board at once when CH is
+set to the number of channels, e.g. "$BD:00,CMD:MON,CH:4,PAR:VMON" is
+answered with "#BD:00,CMD:OK,VAL:v0;v1;v2;v3".  BatchedReader uses that to
+read one parameter of all channels in a single transaction and only falls
+back to per-channel reads when the firmware rejects the broadcast form.
+"""
+import time
+
+# Parameters read on every refresh cycle (STAT is always read as well)
+MONITOR_PARAMETERS = ("VSET", "VMON", "ISET", "IMON")
+
+# Monitors that move on their own, read on every cycle by TieredReader
+FAST_PARAMETERS = ("VMON", "IMON")
+
+# Setpoints and limits that only change when written, read on the slow tier
+SLOW_PARAMETERS = ("VSET", "ISET", "MAXV", "RUP", "RDW")
+
+# Parameters the supply reports in microamps, converted to Amperes on read
+CURRENT_PARAMETERS = ("ISET", "IMON")
+
+# Meaning of STAT bits 1..13, bit 0 is the output state
+STATUS_FLAGS = (
+    "ramping up",
+    "ramping down",
+    "there was overcurrent",
+    "there was overvoltage",
+    "there was undervoltage",
+    "maxv protection",
+    "tripped",
+    "over power",
+    "over temperature",
+    "disabled",
+    "kill",
+    "interlock",
+    "calibration error",
+)
+
+
+def decode_status(word):
+    """Decode a STAT word into the same dict layout as CAENpy's channel_status"""
+    status = {'output': 'on' if word & 1 else 'off'}
+    for bit, name in enumerate(STATUS_FLAGS, start=1):
+        status[name] = 'yes' if word & (1 << bit) else 'no'
+    return status
+
+
+class ReadAborted(Exception):
+    """Raised when a snapshot read gives way to a more urgent command"""
+
+
+class ChannelReading:
+    """Values read from one channel during one refresh cycle"""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.values = {}
+        self.status_word = None
+        self.errors = []
+
+    @property
+    def vset(self):
+        return self.values.get('VSET')
+
+    @property
+    def vmon(self):
+        return self.values.get('VMON')
+
+    @property
+    def iset(self):
+        return self.values.get('ISET')
+
+    @property
+    def imon(self):
+        return self.values.get('IMON')
+
+    @property
+    def status(self):
+        if self.status_word is None:
+            return None
+        return decode_status(self.status_word)
+
+    @property
+    def output(self):
+        return 'on' if self.status_word is not None and self.status_word & 1 else 'off'
+
+    @property
+    def is_ramping(self):
+        return self.status_word is not None and bool(self.status_word & 0b110)
+
+    @property
+    def overcurrent(self):
+        return self.status_word is not None and bool(self.status_word & 0b1000)
+
+
+class Snapshot:
+    """Readings of all channels taken in one refresh cycle"""
+
+    def __init__(self, timestamp, channels, transactions=0, duration=0.0):
+        self.timestamp = timestamp
+        self.channels = channels
+        self.transactions = transactions
+        self.duration = duration
+
+    def __iter__(self):
+        return iter(self.channels)
+
+    def __getitem__(self, channel):
+        return self.channels[channel]
+
+    def __len__(self):
+        return len(self.channels)
+
+    def to_dict(self):
+        """Plain dict form for JSON, currents in Amperes"""
+        return {
+            'time': self.timestamp,
+            'transactions': self.transactions,
+            'duration': self.duration,
+            'channels': [
+                {
+                    'channel': reading.channel,
+                    'values': reading.values,
+                    'status': reading.status_word,
+                    'errors': reading.errors,
+                }
+                for reading in self.channels
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild a snapshot from to_dict() output"""
+        readings = []
+        for item in data['channels']:
+            reading = ChannelReading(item['channel'])
+            reading.values = item['values']
+            reading.status_word = item['status']
+            reading.errors = item['errors']
+            readings.append(reading)
+        return cls(data['time'], readings, data['transactions'], data['duration'])
+
+
+class BatchedReader:
+    """Read parameters of all channels with as few transactions as possible"""
+
+    def __init__(self, hv, num_channels):
+        self.hv = hv
+        self.num_channels = num_channels
+        # Parameters the firmware refused to read in broadcast form
+        self._unbatched = set()
+        self._transactions = 0
+        self._abort = None
+
+    def read_snapshot(self, parameters=MONITOR_PARAMETERS, abort=None):
+        """Read the given parameters plus STAT for every channel
+
+        abort is polled between transactions; when it returns True the read
+        stops with ReadAborted so that e.g. an OFF command is not kept waiting.
+        """
+        start = time.monotonic()
+        self._transactions = 0
+        self._abort = abort
+        readings = [ChannelReading(ch) for ch in range(self.num_channels)]
+
+        for param in parameters:
+            for reading, value in zip(readings, self.read_parameter(param, readings)):
+                if value is not None:
+                    reading.values[param] = value
+
+        for reading, value in zip(readings, self.read_parameter('STAT', readings)):
+            if value is not None:
+                reading.status_word = int(value)
+
+        return Snapshot(time.time(), readings, self._transactions,
+                        time.monotonic() - start)
+
+    def read_parameter(self, param, readings):
+        """Return one value per channel, None where the read failed"""
+        values = None
+        if param not in self._unbatched and self.num_channels > 1:
+            values = self._read_all(param)
+        if values is None:
+            values = self._read_each(param, readings)
+
+        if param in CURRENT_PARAMETERS:
+            # The supply reports currents in microamps
+            values = [v * 1e-6 if v is not None else None for v in values]
+        return values
+
+    def read_channels(self, param, channels):
+        """{channel: value} of param for some channels, None where the read failed
+
+        More than one channel is read with one broadcast, as in read_parameter.
+        """
+        self._abort = None
+        readings = [ChannelReading(ch) for ch in channels]
+        values = None
+        if len(readings) > 1 and param not in self._unbatched:
+            values = self._read_all(param)
+            if values is not None:
+                values = [values[reading.channel] for reading in readings]
+        if values is None:
+            values = self._read_each(param, readings)
+        if param in CURRENT_PARAMETERS:
+            values = [v * 1e-6 if v is not None else None for v in values]
+        return {reading.channel: value for reading, value in zip(readings, values)}
+
+    def _check_abort(self):
+        if self._abort is not None and self._abort():
+            raise ReadAborted()
+
+    def _read_all(self, param):
+        """Read param of every channel in one transaction, None if not possible"""
+        self._check_abort()
+        try:
+            self._transactions += 1
+            response = self.hv.query(CMD='MON', PAR=param, CH=self.num_channels)
+        except Exception:
+            # Link trouble rather than an unsupported command: retry next cycle
+            return None
+
+        fields = response.split('VAL:')
+        if 'CMD:OK' not in response or len(fields) != 2:
+            self._unbatched.add(param)
+            return None
+        try:
+            values = [float(v) for v in fields[1].strip().split(';')]
+        except ValueError:
+            self._unbatched.add(param)
+            return None
+        if len(values) != self.num_channels:
+            self._unbatched.add(param)
+            return None
+        return values
+
+    def _read_each(self, param, readings):
+        """Read param one channel at a time, recording per-channel errors"""
+        values = []
+        for reading in readings:
+            self._check_abort()
+            try:
+                self._transactions += 1
+                values.append(float(self.hv.get_single_channel_parameter(param, reading.channel)))
+            except Exception as e:
+                reading.errors.append(f"{param}: {e}")
+                values.append(None)
+        return values
+
+
+class SetpointCache:
+    """Last known setpoints per channel, kept up to date by slow reads and writes"""
+
+    def __init__(self, num_channels):
+        self.num_channels = num_channels
+        self._values = {}
+        # (channel, param) pairs that need a read before the cache is trusted
+        self._stale = {(ch, param) for ch in range(num_channels) for param in SLOW_PARAMETERS}
+
+    def get(self, channel, param):
+        return self._values.get((channel, param))
+
+    def update(self, channel, param, value):
+        """Store a value read back from the supply"""
+        self._values[(channel, param)] = value
+        self._stale.discard((channel, param))
+
+    def write(self, channel, param, value):
+        """Store a value just written, it is read back once on the next cycle"""
+        self._values[(channel, param)] = value
+        self._stale.add((channel, param))
+
+    def invalidate(self):
+        """Force every setpoint to be read again"""
+        self._stale = {(ch, param) for ch in range(self.num_channels) for param in SLOW_PARAMETERS}
+
+    def stale_parameters(self):
+        return {param for _, param in self._stale}
+
+
+class TieredReader:
+    """Read monitors on every cycle and setpoints only now and then or after a write
+
+    VMON, IMON and STAT are read each cycle.  VSET, ISET, MAXV, RUP and RDW
+    are read every slow_period seconds, or on the next cycle after a write
+    went through note_write; in between they are served from a SetpointCache.
+    All methods must be called from the device worker thread.
+    """
+
+    def __init__(self, reader, slow_period=30.0):
+        self.reader = reader
+        self.slow_period = slow_period
+        self.cache = SetpointCache(reader.num_channels)
+        self._last_slow = None
+
+    @property
+    def num_channels(self):
+        return self.reader.num_channels
+
+    def read_snapshot(self, abort=None):
+        now = time.monotonic()
+        if self._last_slow is None or now - self._last_slow >= self.slow_period:
+            self.cache.invalidate()
+        slow = [p for p in SLOW_PARAMETERS if p in self.cache.stale_parameters()]
+
+        snapshot = self.reader.read_snapshot(FAST_PARAMETERS + tuple(slow), abort)
+        if len(slow) == len(SLOW_PARAMETERS):
+            self._last_slow = now
+
+        for reading in snapshot:
+            for param in SLOW_PARAMETERS:
+                if param in reading.values:
+                    self.cache.update(reading.channel, param, reading.values[param])
+                else:
+                    value = self.cache.get(reading.channel, param)
+                    if value is not None:
+                        reading.values[param] = value
+        return snapshot
+
+    def read_back(self, written):
+        """Read (channel, param) setpoints now, e.g. just written, one transaction per parameter
+
+        Returns {(channel, param): value or None} and refreshes the cache, so
+        the next cycle need not read these setpoints again.
+        """
+        channels = {}
+        for channel, param in written:
+            channels.setdefault(param, []).append(channel)
+        values = {}
+        for param, chs in channels.items():
+            for channel, value in self.reader.read_channels(param, chs).items():
+                values[(channel, param)] = value
+                if value is not None:
+                    self.cache.update(channel, param, value)
+        return values
+
+    def note_write(self, channel, param, value):
+        """Record a setpoint written to the supply (currents in Amperes)"""
+        if param in SLOW_PARAMETERS:
+            self.cache.write(channel, param, value)
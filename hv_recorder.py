@@ -0,0 +1,271 @@
+"""
+Streaming on-disk record of channel readings
+
+SnapshotRecorder converts refresh snapshots into fixed-size binary records
+and appends them to segment files from its own thread, in batches, with an
+fsync after every batch.  Segments rotate by size and age.  index.json in
+the data directory lists the segments and the record layout; a segment is a
+plain array of RECORD_DTYPE and can be memory-mapped as is.  The index also
+holds the device's identity ('device') and, per segment, the last known
+channel settings (MAXV, RUP, RDW) that the records themselves do not carry.
+Given an hv_rollup.RollupStore, the same thread keeps its rollups up to
+date.  A crash loses at most the last unflushed batch, a torn trailing
+record is ignored on read.
+"""
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+FORMAT_VERSION = 1
+
+# One record per channel per snapshot, little endian and unpadded
+RECORD_DTYPE = np.dtype([
+    ('time', '<f8'),
+    ('channel', '<u2'),
+    ('status', '<u2'),
+    ('vmon', '<f8'),
+    ('imon', '<f8'),
+    ('vset', '<f8'),
+    ('iset', '<f8'),
+])
+
+INDEX_FILE = "index.json"
+
+# Per-channel settings kept in the index, the records hold VSET and ISET
+SETTING_PARAMETERS = ("MAXV", "RUP", "RDW")
+
+_TIMEOUT = object()
+
+
+def snapshot_records(snapshot):
+    """Convert a snapshot into an array of records"""
+    records = np.zeros(len(snapshot), dtype=RECORD_DTYPE)
+    for i, reading in enumerate(snapshot):
+        records[i] = (
+            snapshot.timestamp,
+            reading.channel,
+            reading.status_word or 0,
+            np.nan if reading.vmon is None else reading.vmon,
+            np.nan if reading.imon is None else reading.imon,
+            np.nan if reading.vset is None else reading.vset,
+            np.nan if reading.iset is None else reading.iset,
+        )
+    return records
+
+
+def load_index(directory):
+    """Return the index of a data directory, an empty one if there is none"""
+    try:
+        with open(os.path.join(directory, INDEX_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'format': FORMAT_VERSION, 'dtype': RECORD_DTYPE.descr, 'segments': []}
+
+
+def open_segment(path):
+    """Memory-map the complete records of a segment file"""
+    count = os.path.getsize(path) // RECORD_DTYPE.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode='r', shape=(count,))
+
+
+def iter_records(directory, t0=None, t1=None, channels=None, chunk_size=65536):
+    """Yield arrays of records with t0 <= time <= t1, in time order and bounded in size"""
+    for segment in load_index(directory)['segments']:
+        if t0 is not None and segment.get('end') is not None and segment['end'] < t0:
+            continue
+        if t1 is not None and segment['start'] > t1:
+            continue
+        records = open_segment(os.path.join(directory, segment['file']))
+        start = 0 if t0 is None else int(np.searchsorted(records['time'], t0, side='left'))
+        stop = len(records) if t1 is None else int(np.searchsorted(records['time'], t1, side='right'))
+        for i in range(start, stop, chunk_size):
+            chunk = records[i:min(i + chunk_size, stop)]
+            if channels is not None:
+                chunk = chunk[np.isin(chunk['channel'], list(channels))]
+            if len(chunk):
+                yield chunk
+
+
+class SnapshotRecorder:
+    """Append snapshots to rotating binary segment files from a background thread"""
+
+    def __init__(self, directory, flush_interval=5.0, max_bytes=256 * 1024 * 1024,
+                 max_age=24 * 3600, queue_size=10000, metadata=None, rollup=None):
+        self.directory = directory
+        # hv_rollup.RollupStore fed with every batch, None for raw records only
+        self.rollup = rollup
+        # Device identity stored in the index, e.g. idn and address
+        self.metadata = metadata
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.records_written = 0
+        self.dropped = 0
+        self.error = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._file = None
+        self._segment = None
+        self._opened_at = 0.0
+        self._settings = {}
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="hv-recorder", daemon=True)
+        self._thread.start()
+
+    def submit(self, snapshot):
+        """Queue a snapshot for writing, never blocks the caller"""
+        try:
+            self._queue.put_nowait(snapshot)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout=5.0):
+        """Write what is queued, close the segment and stop the thread"""
+        if self._thread is None:
+            return
+        while True:
+            try:
+                self._queue.put_nowait(None)
+                break
+            except queue.Full:
+                # Never block the caller, make room by dropping the oldest snapshot
+                try:
+                    self._queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                item = _TIMEOUT
+            if item is not None and item is not _TIMEOUT:
+                batch.append(snapshot_records(item))
+                self._note_settings(item)
+            if item is None or time.monotonic() >= deadline:
+                if batch:
+                    records = np.concatenate(batch)
+                    self._write(records)
+                    self._roll_up(records)
+                    batch = []
+                deadline = time.monotonic() + self.flush_interval
+            if item is None:
+                self._close_segment()
+                if self.rollup is not None:
+                    try:
+                        self.rollup.close()
+                    except OSError as e:
+                        self.error = e
+                return
+
+    def _write(self, records):
+        size = None
+        try:
+            if self._file is None or self._needs_rotation():
+                self._close_segment()
+                self._open_segment(float(records['time'][0]))
+            # Everything before is flushed, so this is the size on disk
+            size = self._file.tell()
+            self._file.write(records.tobytes())
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._segment['end'] = float(records['time'][-1])
+            self.records_written += len(records)
+        except OSError as e:
+            # Keep acquiring, the caller can show the error
+            self.error = e
+            if size is not None:
+                self._drop_torn_write(size)
+
+    def _drop_torn_write(self, size):
+        """Cut the segment back to its last complete batch and close it
+
+        A partial record would shift every record appended after it, so the
+        next batch starts a new segment instead.
+        """
+        path = os.path.join(self.directory, self._segment['file'])
+        try:
+            self._file.close()
+        except OSError:
+            pass
+        self._file = None
+        try:
+            os.truncate(path, size)
+            self._save_segment_end()
+        except OSError:
+            pass
+
+    def _roll_up(self, records):
+        if self.rollup is None:
+            return
+        try:
+            self.rollup.add(records)
+            self.rollup.flush()
+        except OSError as e:
+            self.error = e
+
+    def _note_settings(self, snapshot):
+        for reading in snapshot:
+            for param in SETTING_PARAMETERS:
+                value = reading.values.get(param)
+                if value is not None:
+                    self._settings.setdefault(str(reading.channel), {})[param] = value
+
+    def _needs_rotation(self):
+        return (self._file.tell() >= self.max_bytes or
+                time.monotonic() - self._opened_at >= self.max_age)
+
+    def _open_segment(self, start_time):
+        name = time.strftime("hv_%Y%m%d_%H%M%S", time.localtime(start_time)) + ".bin"
+        index = load_index(self.directory)
+        existing = {segment['file'] for segment in index['segments']}
+        suffix = 1
+        while name in existing:
+            name = f"{name[:-4].split('.')[0]}.{suffix}.bin"
+            suffix += 1
+        self._segment = {'file': name, 'start': start_time, 'end': None,
+                         'settings': dict(self._settings)}
+        index['segments'].append(self._segment)
+        if self.metadata is not None:
+            index['device'] = self.metadata
+        self._save_index(index)
+        self._file = open(os.path.join(self.directory, name), 'ab')
+        self._opened_at = time.monotonic()
+
+    def _close_segment(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        self._save_segment_end()
+
+    def _save_segment_end(self):
+        index = load_index(self.directory)
+        for segment in index['segments']:
+            if segment['file'] == self._segment['file']:
+                segment['end'] = self._segment['end']
+                segment['settings'] = dict(self._settings)
+        self._save_index(index)
+
+    def _save_index(self, index):
+        # Write and rename so a crash never leaves a truncated index
+        path = os.path.join(self.directory, INDEX_FILE)
+        with open(path + ".tmp", 'w') as f:
+            json.dump(index, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
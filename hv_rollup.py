@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Multi-resolution rollups of recorded readings
+
+Next to the raw segments, the recorder keeps for every channel the count
+and the minimum, maximum, mean and standard deviation of VMON and IMON per
+10 s, 1 min and 1 h bucket, one file per resolution (rollup_60s.bin, ...)
+holding a plain array of ROLLUP_DTYPE.  Each batch of records costs one
+vectorized pass per resolution whatever the length of the run; only the
+open bucket of each channel is kept in memory and a bucket is appended to
+its file once it is complete.  read_rollup() picks the finest resolution
+that gives at most max_points buckets, so a month of leakage current
+comes back as about 720 hourly rows without touching the raw data:
+
+    python hv_rollup.py ~/hv_data/_dev_ttyACM0 --channel 0 --days 30
+    python hv_rollup.py ~/hv_data/_dev_ttyACM0 --rebuild
+
+--rebuild computes the rollups of recordings made before they existed.
+"""
+import argparse
+import glob
+import os
+import re
+import time
+
+import numpy as np
+
+from hv_recorder import iter_records
+
+# Bucket lengths in seconds, finest first.  Nothing finer than 10 s: at the
+# usual poll periods a 1 s level would be bigger than the raw records.
+RESOLUTIONS = (10, 60, 3600)
+
+QUANTITIES = ('vmon', 'imon')
+
+STATISTICS = ('min', 'max', 'mean', 'std')
+
+# One bucket of one channel, time is the start of the bucket
+ROLLUP_DTYPE = np.dtype(
+    [('time', '<f8'), ('channel', '<u2'), ('count', '<u4')]
+    + [(f"{quantity}_{statistic}", '<f8') for quantity in QUANTITIES for statistic in STATISTICS])
+
+# Most buckets read_rollup() returns when it chooses the resolution
+DEFAULT_POINTS = 2000
+
+
+def rollup_file(directory, resolution):
+    return os.path.join(directory, f"rollup_{resolution}s.bin")
+
+
+def available_resolutions(directory):
+    """Resolutions with a rollup file in directory, finest first"""
+    found = []
+    for path in glob.glob(os.path.join(directory, "rollup_*s.bin")):
+        match = re.fullmatch(r"rollup_(\d+)s\.bin", os.path.basename(path))
+        if match:
+            found.append(int(match.group(1)))
+    return sorted(found)
+
+
+def aggregate(records, resolution):
+    """Rollup rows of recorder records per bucket and channel, sorted by channel and time
+
+    Records with a failed VMON or IMON read are left out.
+    """
+    records = records[~(np.isnan(records['vmon']) | np.isnan(records['imon']))]
+    if not len(records):
+        return np.zeros(0, dtype=ROLLUP_DTYPE)
+    buckets = np.floor(records['time'] / resolution) * resolution
+    order = np.lexsort((buckets, records['channel']))
+    buckets = buckets[order]
+    channels = records['channel'][order]
+    starts = np.flatnonzero(np.r_[True, (buckets[1:] != buckets[:-1]) |
+                                        (channels[1:] != channels[:-1])])
+    counts = np.diff(np.r_[starts, len(buckets)])
+
+    rows = np.zeros(len(starts), dtype=ROLLUP_DTYPE)
+    rows['time'] = buckets[starts]
+    rows['channel'] = channels[starts]
+    rows['count'] = counts
+    for quantity in QUANTITIES:
+        values = records[quantity][order].astype(np.float64)
+        # Shifted by the first value of the bucket, so the variance keeps its precision
+        first = values[starts]
+        shifted = values - np.repeat(first, counts)
+        mean = np.add.reduceat(shifted, starts) / counts
+        square = np.add.reduceat(shifted * shifted, starts) / counts
+        rows[f"{quantity}_min"] = np.minimum.reduceat(values, starts)
+        rows[f"{quantity}_max"] = np.maximum.reduceat(values, starts)
+        rows[f"{quantity}_mean"] = first + mean
+        rows[f"{quantity}_std"] = np.sqrt(np.maximum(square - mean * mean, 0.0))
+    return rows
+
+
+def combine(a, b):
+    """Rows for the union of two sets of samples of the same buckets"""
+    na = a['count'].astype(np.float64)
+    nb = b['count'].astype(np.float64)
+    n = na + nb
+    rows = a.copy()
+    rows['count'] = a['count'] + b['count']
+    for quantity in QUANTITIES:
+        mean_a, mean_b = a[f"{quantity}_mean"], b[f"{quantity}_mean"]
+        delta = mean_b - mean_a
+        m2 = (a[f"{quantity}_std"] ** 2 * na + b[f"{quantity}_std"] ** 2 * nb
+              + delta * delta * na * nb / n)
+        rows[f"{quantity}_mean"] = mean_a + delta * nb / n
+        rows[f"{quantity}_std"] = np.sqrt(m2 / n)
+        rows[f"{quantity}_min"] = np.minimum(a[f"{quantity}_min"], b[f"{quantity}_min"])
+        rows[f"{quantity}_max"] = np.maximum(a[f"{quantity}_max"], b[f"{quantity}_max"])
+    return rows
+
+
+class RollupStore:
+    """Rollups of one recording directory, fed with batches of recorder records
+
+    Used from the recorder thread only.  Complete buckets are appended to
+    the files by flush(), close() also writes the open ones; a bucket
+    continued after a restart then appears twice and read_rollup() merges it.
+    """
+
+    def __init__(self, directory, resolutions=RESOLUTIONS):
+        self.directory = directory
+        self.resolutions = resolutions
+        # Per resolution: open bucket per channel (one-row arrays) and complete rows to write
+        self._open = {resolution: {} for resolution in resolutions}
+        self._complete = {resolution: [] for resolution in resolutions}
+
+    def add(self, records):
+        """Fold records (RECORD_DTYPE, in time order) into the buckets"""
+        if not len(records):
+            return
+        # Failed reads count too: time has moved on for every channel
+        now = float(records['time'].max())
+        for resolution in self.resolutions:
+            rows = aggregate(records, resolution)
+            open_buckets = self._open[resolution]
+            complete = self._complete[resolution]
+            # Rows of each channel, none if every read of the batch failed
+            bounds = np.flatnonzero(np.r_[True, rows['channel'][1:] != rows['channel'][:-1],
+                                          True]) if len(rows) else []
+            for start, stop in zip(bounds[:-1], bounds[1:]):
+                channel_rows = rows[start:stop]
+                channel = int(channel_rows['channel'][0])
+                previous = open_buckets.get(channel)
+                if previous is not None:
+                    if previous['time'][0] == channel_rows['time'][0]:
+                        channel_rows = channel_rows.copy()
+                        channel_rows[:1] = combine(previous, channel_rows[:1])
+                    else:
+                        complete.append(previous)
+                complete.append(channel_rows[:-1])
+                open_buckets[channel] = channel_rows[-1:].copy()
+            # Records come in time order, so a bucket ending before now is complete.
+            # Left open until its channel reads again (it may keep failing), it would
+            # be appended flushes later and break the time order of the file
+            for channel, previous in list(open_buckets.items()):
+                if previous['time'][0] + resolution <= now:
+                    complete.append(previous)
+                    del open_buckets[channel]
+
+    def flush(self):
+        """Append the complete buckets to the files"""
+        os.makedirs(self.directory, exist_ok=True)
+        for resolution in self.resolutions:
+            complete = self._complete[resolution]
+            if not complete:
+                continue
+            rows = np.concatenate(complete)
+            self._complete[resolution] = []
+            if not len(rows):
+                continue
+            rows = rows[np.argsort(rows['time'], kind='stable')]
+            with open(rollup_file(self.directory, resolution), 'ab') as f:
+                f.write(rows.tobytes())
+
+    def close(self):
+        """Write the open buckets too"""
+        for resolution in self.resolutions:
+            self._complete[resolution].extend(self._open[resolution].values())
+            self._open[resolution] = {}
+        self.flush()
+
+
+def open_rollup(path):
+    """Memory-map the complete rows of a rollup file"""
+    count = os.path.getsize(path) // ROLLUP_DTYPE.itemsize if os.path.exists(path) else 0
+    if count == 0:
+        return np.zeros(0, dtype=ROLLUP_DTYPE)
+    return np.memmap(path, dtype=ROLLUP_DTYPE, mode='r', shape=(count,))
+
+
+def choose_resolution(resolutions, seconds, max_points=DEFAULT_POINTS):
+    """Finest resolution giving at most max_points buckets over seconds, else the coarsest"""
+    for resolution in resolutions:
+        if seconds / resolution <= max_points:
+            return resolution
+    return resolutions[-1]
+
+
+def read_rollup(directory, channel, t0=None, t1=None, resolution=None, max_points=DEFAULT_POINTS):
+    """Rollup rows of one channel with t0 <= time <= t1, in time order
+
+    resolution None picks one with choose_resolution().  Returns an empty
+    array when there are no rollups.
+    """
+    resolutions = available_resolutions(directory)
+    if not resolutions:
+        return np.zeros(0, dtype=ROLLUP_DTYPE)
+    if resolution is None:
+        start = t0
+        if start is None:
+            coarsest = open_rollup(rollup_file(directory, resolutions[-1]))
+            start = float(coarsest['time'][0]) if len(coarsest) else time.time()
+        resolution = choose_resolution(resolutions, (t1 or time.time()) - start, max_points)
+    rows = open_rollup(rollup_file(directory, resolution))
+    # Rows are appended in time order per flush, allow one bucket of overlap between flushes
+    start = 0 if t0 is None else int(np.searchsorted(rows['time'], t0 - resolution, side='left'))
+    stop = len(rows) if t1 is None else int(np.searchsorted(rows['time'], t1 + resolution,
+                                                            side='right'))
+    rows = rows[start:stop]
+    keep = rows['channel'] == channel
+    if t0 is not None:
+        keep &= rows['time'] >= t0 - resolution
+    if t1 is not None:
+        keep &= rows['time'] <= t1
+    rows = np.array(rows[keep])
+    rows = rows[np.argsort(rows['time'], kind='stable')]
+    return _merge_duplicates(rows)
+
+
+def _merge_duplicates(rows):
+    """Combine rows of the same bucket, written before and after a restart"""
+    if len(rows) < 2 or not np.any(rows['time'][1:] == rows['time'][:-1]):
+        return rows
+    merged = [rows[:1]]
+    for i in range(1, len(rows)):
+        if rows['time'][i] == merged[-1]['time'][0]:
+            merged[-1] = combine(merged[-1], rows[i:i + 1])
+        else:
+            merged.append(rows[i:i + 1])
+    return np.concatenate(merged)
+
+
+def rebuild(directory, resolutions=RESOLUTIONS):
+    """Compute the rollups of a recording directory from its segments, returns the records read"""
+    for resolution in available_resolutions(directory):
+        os.remove(rollup_file(directory, resolution))
+    store = RollupStore(directory, resolutions)
+    records = 0
+    for chunk in iter_records(directory):
+        store.add(chunk)
+        store.flush()
+        records += len(chunk)
+    store.close()
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("directory", help="recording directory of one device")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="compute the rollups again from the recorded segments")
+    parser.add_argument("--channel", type=int, default=0)
+    parser.add_argument("--days", type=float, default=1.0, help="how far back to read")
+    parser.add_argument("--resolution", type=int, help="bucket length in seconds, default automatic")
+    parser.add_argument("-o", "--output", help="write the rows as CSV instead of a summary")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        started = time.monotonic()
+        records = rebuild(args.directory)
+        print(f"{records} records rolled up in {time.monotonic() - started:.1f} s")
+        return
+    started = time.monotonic()
+    rows = read_rollup(args.directory, args.channel, time.time() - args.days * 86400,
+                       resolution=args.resolution)
+    elapsed = time.monotonic() - started
+    if args.output:
+        np.savetxt(args.output, np.column_stack([rows[name].astype(np.float64)
+                                                 for name in ROLLUP_DTYPE.names]),
+                   delimiter=",", header=",".join(ROLLUP_DTYPE.names), comments="",
+                   fmt=["%.3f", "%d", "%d"] + ["%.8g"] * (len(ROLLUP_DTYPE.names) - 3))
+    print(f"{len(rows)} buckets of CH{args.channel} read in {elapsed * 1000:.1f} ms")
+    if len(rows):
+        print(f"IMON mean {rows['imon_mean'].mean():.4e} A, "
+              f"min {rows['imon_min'].min():.4e} A, max {rows['imon_max'].max():.4e} A")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+"""
+IV scans and conditioning recipes
+
+A recipe is a JSON file listing voltage steps for a set of channels:
+
+    {
+        "name": "IV scan",
+        "channels": ["D0:0", "D0:1"],
+        "rate": 10,
+        "compliance": 1e-5,
+        "settle": {"window": 5, "tolerance": 0.02, "min_time": 2, "timeout": 60},
+        "samples": 10,
+        "scan": {"start": 0, "stop": 1000, "step": 50},
+        "final_voltage": 0
+    }
+
+Instead of "scan", "steps" lists the voltages, either as numbers or as
+{"voltage": 500, "hold": 600, "samples": 20} for conditioning plateaus;
+"voltage" may also map channels to their own voltage.
+
+SequenceRunner moves all channels to each step with the RampEngine, waits
+until IMON is stable over the last "window" snapshots (spread within
+"tolerance" of the mean, or "abs_tolerance" A) or "timeout" s pass,
+dwells "hold" s and averages "samples" snapshots into one result row per
+channel.  Everything is taken from the poller's snapshot stream, which
+runs at the ramp interval while a sequence is active, so the scan issues
+no reads of its own.  IMON at or above "compliance" aborts the sequence and
+ramps the channels to "final_voltage" (null leaves them where they are).
+"""
+import collections
+import csv
+import json
+
+import numpy as np
+
+from hv_ramp import LIMIT_ABORT, DONE as RAMP_DONE
+from hv_devices import check_setpoint
+
+# One row per channel and step
+RESULT_DTYPE = np.dtype([
+    ('step', '<i4'),
+    ('time', '<f8'),
+    ('device', 'U8'),
+    ('channel', '<u2'),
+    ('voltage', '<f8'),
+    ('vmon', '<f8'),
+    ('vmon_std', '<f8'),
+    ('imon', '<f8'),
+    ('imon_std', '<f8'),
+    ('samples', '<u2'),
+    ('settled', '?'),
+    ('settle_time', '<f8'),
+])
+
+SETTLE_DEFAULTS = {'window': 5, 'tolerance': 0.02, 'abs_tolerance': 1e-9,
+                   'min_time': 2.0, 'timeout': 60.0}
+
+# Runner states
+IDLE = "idle"
+RAMPING = "ramping"
+SETTLING = "settling"
+HOLDING = "holding"
+SAMPLING = "sampling"
+DONE = "done"
+ABORTED = "aborted"
+
+
+def load_recipe(path):
+    with open(path) as f:
+        return parse_recipe(json.load(f))
+
+
+def _number(value, what):
+    """float(value), ValueError naming the recipe field if it is not a number"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{what} must be a number, not {value!r}") from None
+
+
+def parse_settle(data):
+    """Settle criteria of a recipe with the defaults filled in, raises ValueError"""
+    if not isinstance(data, dict):
+        raise ValueError("settle must be an object such as {\"window\": 5}")
+    unknown = set(data) - set(SETTLE_DEFAULTS)
+    if unknown:
+        raise ValueError(f"unknown settle setting {sorted(unknown)[0]!r}")
+    settle = dict(SETTLE_DEFAULTS, **data)
+    window = _number(settle['window'], "settle window")
+    if window != int(window) or window < 1:
+        raise ValueError(f"settle window must be a whole number of snapshots >= 1, not {window:g}")
+    settle['window'] = int(window)
+    for key in ('tolerance', 'abs_tolerance', 'min_time', 'timeout'):
+        settle[key] = _number(settle[key], f"settle {key}")
+        if not settle[key] >= 0:
+            raise ValueError(f"settle {key} must not be negative")
+    return settle
+
+
+def parse_recipe(data):
+    """Check a recipe and expand it to a list of steps, raises ValueError"""
+    if not data.get('channels'):
+        raise ValueError("the recipe lists no channels")
+    if ('scan' in data) == ('steps' in data):
+        raise ValueError("the recipe needs either 'scan' or 'steps'")
+    rate = float(data.get('rate', 10.0))
+    if rate <= 0:
+        raise ValueError("rate must be positive")
+    settle = parse_settle(data.get('settle', {}))
+    samples = int(data.get('samples', 10))
+
+    if 'scan' in data:
+        scan = data['scan']
+        start, stop, step = float(scan['start']), float(scan['stop']), abs(float(scan['step']))
+        if step == 0:
+            raise ValueError("scan step must not be 0")
+        count = int(np.floor(abs(stop - start) / step + 1e-9)) + 1
+        voltages = list(start + np.sign(stop - start) * step * np.arange(count))
+        if voltages[-1] != stop:
+            voltages.append(stop)
+        steps = [{'voltage': float(v)} for v in voltages]
+    else:
+        steps = [item if isinstance(item, dict) else {'voltage': item} for item in data['steps']]
+
+    expanded = []
+    for item in steps:
+        if 'voltage' not in item:
+            raise ValueError(f"step {item} has no voltage")
+        expanded.append({
+            'voltage': check_setpoint('VSET', _number(item['voltage'], "step voltage")),
+            'hold': float(item.get('hold', 0.0)),
+            'samples': max(int(item.get('samples', samples)), 1),
+        })
+
+    compliance = data.get('compliance')
+    final_voltage = data.get('final_voltage', 0.0)
+    return {
+        'name': data.get('name', "sequence"),
+        'channels': [str(spec) for spec in data['channels']],
+        'rate': rate,
+        'compliance': None if compliance is None else float(compliance),
+        'settle': settle,
+        'steps': expanded,
+        'final_voltage': (None if final_voltage is None else
+                          check_setpoint('VSET', _number(final_voltage, "final_voltage"))),
+    }
+
+
+def resolve_channel(spec, devices):
+    """(device, channel) of "D0:1", or "1" for the first connected device"""
+    label, _, channel = spec.rpartition(":")
+    connected = devices.connected
+    device = devices.find(label) if label else (connected[0] if connected else None)
+    if device is None or not device.connected:
+        raise ValueError(f"no connected device for channel {spec!r}")
+    channel = int(channel)
+    if not 0 <= channel < device.num_channels:
+        raise ValueError(f"{device.label} has no channel {channel}")
+    return device, channel
+
+
+def save_results(path, results, recipe=None):
+    """Write result rows as CSV, with the recipe in a comment line"""
+    with open(path, 'w', newline='') as f:
+        if recipe is not None:
+            f.write(f"# recipe: {json.dumps(recipe)}\n")
+        writer = csv.writer(f)
+        writer.writerow(RESULT_DTYPE.names)
+        for row in results:
+            writer.writerow([row[name] for name in RESULT_DTYPE.names])
+
+
+class SequenceRunner:
+    """Runs one parsed recipe, driven by update() with every device snapshot
+
+    on_progress(runner) is called on every state change and result row,
+    on_finished(runner) once the sequence is done or aborted.
+    """
+
+    def __init__(self, recipe, devices, ramps, on_progress=None, on_finished=None):
+        self.recipe = recipe
+        self.ramps = ramps
+        self.on_progress = on_progress
+        self.on_finished = on_finished
+        self.channels = [resolve_channel(spec, devices) for spec in recipe['channels']]
+        self.state = IDLE
+        self.message = ""
+        self.step = -1
+        self.results = np.zeros(0, dtype=RESULT_DTYPE)
+        self._rows = []
+        self._ramps = []
+        self._phase_start = None
+        self._settle = (False, 0.0)
+        self._imon = {}
+        self._samples = {}
+
+    @property
+    def finished(self):
+        return self.state in (DONE, ABORTED)
+
+    @property
+    def devices(self):
+        return {device for device, _ in self.channels}
+
+    def rows(self):
+        """Result rows as dicts, e.g. for JSON"""
+        return [{name: row[name].item() for name in RESULT_DTYPE.names} for row in self.results]
+
+    def describe(self):
+        steps = len(self.recipe['steps'])
+        text = f"{self.recipe['name']}: step {min(self.step + 1, steps)}/{steps} {self.state}"
+        if self.message:
+            text += f" ({self.message})"
+        return text
+
+    def start(self):
+        for device in self.devices:
+            device.fast_poll.add(self)
+        self._next_step()
+
+    def stop(self, message="stopped"):
+        """Abort the sequence and bring the channels to the final voltage"""
+        self._abort(message)
+
+    def forget(self, device, message="device disconnected"):
+        """Abort without writing, once a device went away"""
+        if not self.finished and device in self.devices:
+            self._finish(ABORTED, message)
+
+    def update(self, device, snapshot):
+        """Follow the sequence with a new snapshot of device"""
+        if self.finished or device not in self.devices:
+            return
+        now = snapshot.timestamp
+        readings = {}
+        for dev, ch in self.channels:
+            if dev is device and ch < len(snapshot):
+                reading = snapshot[ch]
+                if not reading.errors and reading.vmon is not None and reading.imon is not None:
+                    readings[(dev, ch)] = reading
+
+        compliance = self.recipe['compliance']
+        for (dev, ch), reading in readings.items():
+            if compliance is not None and reading.imon >= compliance:
+                self._abort(f"{dev.label} CH{ch} IMON {reading.imon:.2e} A reached "
+                            f"the {compliance:.2e} A compliance")
+                return
+
+        if self.state == RAMPING:
+            if not all(ramp.finished for ramp in self._ramps):
+                return
+            failed = [ramp for ramp in self._ramps if ramp.state != RAMP_DONE]
+            if failed:
+                self._abort(f"ramp of {failed[0].device.label} CH{failed[0].channel} "
+                            f"{failed[0].state}: {failed[0].message}")
+                return
+            self._enter(SETTLING)
+            self._imon = {key: collections.deque(maxlen=self.recipe['settle']['window'])
+                          for key in self.channels}
+        if self._phase_start is None:
+            self._phase_start = now
+
+        if self.state == SETTLING:
+            for key, reading in readings.items():
+                self._imon[key].append(reading.imon)
+            settle = self.recipe['settle']
+            elapsed = now - self._phase_start
+            if elapsed >= settle['min_time'] and all(self._stable(key) for key in self.channels):
+                self._settled(True, elapsed)
+            elif elapsed >= settle['timeout']:
+                self._settled(False, elapsed)
+        elif self.state == HOLDING:
+            if now - self._phase_start >= self.recipe['steps'][self.step]['hold']:
+                self._enter(SAMPLING)
+        elif self.state == SAMPLING:
+            for key, reading in readings.items():
+                self._samples[key].append((reading.vmon, reading.imon))
+            wanted = self.recipe['steps'][self.step]['samples']
+            if all(len(self._samples[key]) >= wanted for key in self.channels):
+                self._record(now)
+                self._next_step()
+
+    def _stable(self, key):
+        values = self._imon[key]
+        if len(values) < values.maxlen:
+            return False
+        settle = self.recipe['settle']
+        spread = max(values) - min(values)
+        mean = sum(values) / len(values)
+        return spread <= max(settle['tolerance'] * abs(mean), settle['abs_tolerance'])
+
+    def _settled(self, settled, elapsed):
+        self._settle = (settled, elapsed)
+        if not settled:
+            self.message = "IMON did not settle"
+        self._samples = {key: [] for key in self.channels}
+        self._enter(HOLDING if self.recipe['steps'][self.step]['hold'] > 0 else SAMPLING)
+
+    def _record(self, now):
+        settled, settle_time = self._settle
+        voltage = self.recipe['steps'][self.step]['voltage']
+        for device, ch in self.channels:
+            values = np.array(self._samples[(device, ch)])
+            self._rows.append((
+                self.step, now, device.label, ch, self._voltage(voltage, device, ch),
+                values[:, 0].mean(), values[:, 0].std(), values[:, 1].mean(), values[:, 1].std(),
+                len(values), settled, settle_time,
+            ))
+        self.results = np.array(self._rows, dtype=RESULT_DTYPE)
+
+    def _voltage(self, voltage, device, ch):
+        if isinstance(voltage, dict):
+            for key in (f"{device.label}:{ch}", str(ch)):
+                if key in voltage:
+                    return float(voltage[key])
+            raise ValueError(f"step has no voltage for {device.label} CH{ch}")
+        return float(voltage)
+
+    def _next_step(self):
+        self.step += 1
+        self.message = ""
+        if self.step >= len(self.recipe['steps']):
+            self._ramp_to_final()
+            self._finish(DONE)
+            return
+        voltage = self.recipe['steps'][self.step]['voltage']
+        self._ramps = []
+        try:
+            for device, ch in self.channels:
+                # The engine enforces the compliance as well, between our snapshots
+                self._ramps.append(self.ramps.start(
+                    device, ch, self._voltage(voltage, device, ch), self.recipe['rate'],
+                    imon_limit=self.recipe['compliance'], limit_action=LIMIT_ABORT))
+        except ValueError as e:
+            self._abort(str(e))
+            return
+        self._enter(RAMPING)
+
+    def _enter(self, state):
+        self.state = state
+        self._phase_start = None
+        self._report()
+
+    def _abort(self, message):
+        if self.finished:
+            return
+        for ramp in self._ramps:
+            self.ramps.abort(ramp, "sequence aborted")
+        self._ramp_to_final()
+        self._finish(ABORTED, message)
+
+    def _ramp_to_final(self):
+        final = self.recipe['final_voltage']
+        if final is None:
+            return
+        for device, ch in self.channels:
+            if device.connected and self.ramps.find(device, ch) is None:
+                self.ramps.start(device, ch, final, self.recipe['rate'])
+
+    def _finish(self, state, message=""):
+        self.state = state
+        self.message = message
+        for device in self.devices:
+            device.fast_poll.discard(self)
+        self._report()
+        if self.on_finished:
+            self.on_finished(self)
+
+    def _report(self):
+        if self.on_progress:
+            self.on_progress(self)
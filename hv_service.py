@@ -0,0 +1,481 @@
+"""
+Headless acquisition service
+
+AcquisitionService runs the same DeviceManager as the GUI, but on a
+ServiceLoop instead of the Tk mainloop, and makes it available to any number
+of clients.  Every snapshot is encoded once and fanned out to all
+subscribers, so extra clients cost no extra device transactions; queries
+for the latest readings are answered from memory.
+
+Requests and events are JSON objects, one per line:
+
+    {"id": 1, "cmd": "devices"}
+    {"id": 2, "cmd": "subscribe"}
+    {"id": 3, "cmd": "set", "device": "D0", "channel": 1, "param": "VSET", "value": 100}
+    {"id": 4, "cmd": "set_many", "device": "D0", "writes": [[0, "VSET", 100], [1, "VSET", 100]]}
+    {"id": 5, "cmd": "ramp", "device": "D0", "channel": 1, "target": 500, "rate": 5,
+     "imon_limit": 1e-5, "limit_action": "hold"}
+
+Replies carry the request id and either "result" or "error".  Snapshots are
+sent as {"event": "snapshot", "device": "D0", ...} to subscribed clients,
+ramp progress as {"event": "ramp", ...}, alarms as {"event": "alarm", ...},
+link state changes (see hv_link) as {"event": "link", ...} and captured
+bursts (see hv_burst) as {"event": "burst", ...}.
+"""
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+
+from hv_readout import ReadAborted
+from hv_devices import DeviceManager, PollSettings, check_setpoint
+from hv_metrics import Metrics
+from hv_ramp import RampEngine, LIMIT_HOLD
+from hv_alarm import AlarmEngine, AlarmRule, dispatch_alarms, ACTION_LOG
+from hv_sequence import SequenceRunner, parse_recipe, save_results
+
+# Parameters clients may write
+WRITABLE_PARAMETERS = ("VSET", "ISET", "RUP", "RDW", "MAXV")
+
+
+def encode(message):
+    """One line of the protocol"""
+    return (json.dumps(message) + "\n").encode()
+
+
+class ServiceLoop:
+    """Single thread running timers and handed-over calls, a headless Tk mainloop"""
+
+    def __init__(self):
+        self._timers = []
+        self._calls = []
+        self._seq = itertools.count()
+        self._cancelled = set()
+        self._condition = threading.Condition()
+        self._running = False
+
+    def call_later(self, ms, func):
+        """Run func after ms milliseconds, returns a handle for cancel()"""
+        handle = next(self._seq)
+        with self._condition:
+            heapq.heappush(self._timers, (time.monotonic() + ms / 1000, handle, func))
+            self._condition.notify()
+        return handle
+
+    def cancel(self, handle):
+        with self._condition:
+            self._cancelled.add(handle)
+
+    def call_soon(self, func, *args):
+        """Run func(*args) on the loop thread, safe to call from any thread"""
+        with self._condition:
+            self._calls.append((func, args))
+            self._condition.notify()
+
+    def run(self):
+        """Serve calls and timers until stop()"""
+        self._running = True
+        while self._running:
+            with self._condition:
+                while not self._calls:
+                    if self._timers and self._timers[0][1] in self._cancelled:
+                        self._cancelled.discard(heapq.heappop(self._timers)[1])
+                        continue
+                    timeout = None
+                    if self._timers:
+                        timeout = self._timers[0][0] - time.monotonic()
+                        if timeout <= 0:
+                            _, _, func = heapq.heappop(self._timers)
+                            self._calls.append((func, ()))
+                            break
+                    if not self._running:
+                        break
+                    self._condition.wait(timeout)
+                calls, self._calls = self._calls, []
+            for func, args in calls:
+                try:
+                    func(*args)
+                except Exception:
+                    logging.getLogger("hvgui").exception("Service callback failed")
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+
+class AcquisitionService:
+    """Devices, polling and client fan-out, all run on one ServiceLoop"""
+
+    def __init__(self, loop, settings=None, record_dir=None, transport="caenpy", alarm_rules=(),
+                 bursts=None):
+        self.loop = loop
+        self.record_dir = record_dir
+        self.logger = logging.getLogger("hvgui")
+        self.alarms = AlarmEngine(alarm_rules)
+        self.metrics = Metrics()
+        self.devices = DeviceManager(loop.call_soon, loop.call_later, loop.cancel,
+                                     settings or PollSettings(),
+                                     on_snapshot=self._on_snapshot,
+                                     on_poll_error=self._on_poll_error,
+                                     transport=transport, alarms=self.alarms,
+                                     on_alarm=self._on_alarm, on_link=self._on_link,
+                                     metrics=self.metrics, bursts=bursts,
+                                     on_burst=self._on_burst)
+        # Latest snapshot message per device, served without touching the device
+        self.latest = {}
+        self.subscribers = set()
+        self.ramps = RampEngine(on_progress=self._on_ramp)
+        self.sequence = None
+
+    def connect_device(self, conn_type, address, on_done=None, on_error=None):
+        """Open a device and start polling it"""
+        device = self.devices.add(conn_type, address)
+
+        def connected(device):
+            self.logger.info(f"Connected {device.label} {device.address}: {device.idn}")
+            if self.record_dir:
+                device.start_recording(self.record_dir)
+            device.start_polling()
+            if on_done:
+                on_done(device)
+
+        def failed(error):
+            self.devices.remove(device)
+            self.logger.error(f"Connection to {address} failed: {error}")
+            if on_error:
+                on_error(error)
+
+        device.connect(connected, failed)
+        return device
+
+    def subscribe(self, send):
+        """send(bytes) receives every snapshot from now on"""
+        self.subscribers.add(send)
+
+    def unsubscribe(self, send):
+        self.subscribers.discard(send)
+
+    def shutdown(self):
+        self.devices.stop()
+
+    def prometheus(self):
+        """Latency histograms and link state in the Prometheus text format
+
+        Only reads counters, so it may be called from any thread.
+        """
+        lines = [
+            "# HELP hv_link_up Whether the link to the supply answers",
+            "# TYPE hv_link_up gauge",
+        ]
+        devices = list(self.devices)
+        lines += [f'hv_link_up{{device="{device.label}"}} {int(device.online)}'
+                  for device in devices]
+        lines += [
+            "# HELP hv_link_reconnects_total Times the link was reopened after it was lost",
+            "# TYPE hv_link_reconnects_total counter",
+        ]
+        lines += [f'hv_link_reconnects_total{{device="{device.label}"}} {device.link.reconnects}'
+                  for device in devices]
+        return self.metrics.prometheus() + "\n".join(lines) + "\n"
+
+    def _on_snapshot(self, device, snapshot):
+        message = dict(snapshot.to_dict(), event='snapshot', device=device.label,
+                       poll_interval=device.poll_interval)
+        self.latest[device.label] = message
+        self.broadcast(message)
+        self.ramps.update(device, snapshot)
+        if self.sequence is not None:
+            self.sequence.update(device, snapshot)
+
+    def _on_ramp(self, ramp):
+        self.broadcast(dict(ramp.to_dict(), event='ramp'))
+
+    def _on_alarm(self, device, alarms):
+        dispatch_alarms(alarms, self.devices, self.ramps, self.logger)
+        for alarm in alarms:
+            if self.sequence is not None and alarm.rule.action != ACTION_LOG:
+                self.sequence.forget(alarm.device, f"alarm {alarm.rule.name}")
+            self.broadcast(dict(alarm.to_dict(), event='alarm'))
+
+    def _on_link(self, device):
+        link = device.link
+        level = logging.INFO if link.up else logging.ERROR
+        self.logger.log(level, f"{device.label} {link.describe()}")
+        self.broadcast(dict(link.to_dict(), event='link', device=device.label))
+
+    def _on_burst(self, device, burst):
+        self.logger.info(burst.describe() + (f", saved to {burst.path}" if burst.path else ""))
+        self.broadcast(dict(burst.to_dict(), event='burst'))
+
+    def _on_sequence(self, sequence):
+        self.broadcast({'event': 'sequence', 'name': sequence.recipe['name'],
+                        'step': sequence.step, 'state': sequence.state,
+                        'message': sequence.message, 'points': len(sequence.results)})
+
+    def broadcast(self, message):
+        """Send an event to every subscriber, encoded once"""
+        line = encode(message)
+        for send in list(self.subscribers):
+            send(line)
+
+    def _on_poll_error(self, device, error):
+        if not isinstance(error, ReadAborted):
+            self.logger.error(f"Refresh error on {device.label}: {error}")
+
+    def handle(self, request, send):
+        """Serve one client request, the reply goes to send(bytes) possibly later"""
+        request_id = request.get('id')
+
+        def reply(result=None):
+            send(encode({'id': request_id, 'result': result}))
+
+        def fail(error):
+            send(encode({'id': request_id, 'error': str(error)}))
+
+        try:
+            handler = getattr(self, f"_cmd_{request.get('cmd')}", None)
+            if handler is None:
+                raise ValueError(f"unknown command {request.get('cmd')!r}")
+            handler(request, send, reply, fail)
+        except Exception as e:
+            fail(e)
+
+    def _device(self, request):
+        device = self.devices.find(request.get('device'))
+        if device is None or not device.connected:
+            raise ValueError(f"no connected device {request.get('device')!r}")
+        return device
+
+    def _channel(self, request, device):
+        channel = int(request['channel'])
+        if not 0 <= channel < device.num_channels:
+            raise ValueError(f"{device.label} has no channel {channel}")
+        return channel
+
+    def _cmd_devices(self, request, send, reply, fail):
+        reply([
+            {
+                'device': device.label,
+                'conn_type': device.conn_type,
+                'address': device.address,
+                'idn': device.idn,
+                'channels': device.num_channels,
+                'connected': device.connected,
+                'link': device.link.to_dict(),
+            }
+            for device in self.devices
+        ])
+
+    def _cmd_snapshot(self, request, send, reply, fail):
+        device = self._device(request)
+        reply(self.latest.get(device.label))
+
+    def _cmd_subscribe(self, request, send, reply, fail):
+        self.subscribe(send)
+        reply(True)
+        # Start the new client off with what the others already have
+        for message in self.latest.values():
+            send(encode(message))
+
+    def _cmd_unsubscribe(self, request, send, reply, fail):
+        self.unsubscribe(send)
+        reply(True)
+
+    def _cmd_refresh(self, request, send, reply, fail):
+        self._device(request).refresh()
+        reply(True)
+
+    def _cmd_set(self, request, send, reply, fail):
+        device = self._device(request)
+        channel = self._channel(request, device)
+        param = request['param']
+        if param not in WRITABLE_PARAMETERS:
+            raise ValueError(f"{param} cannot be written")
+        value = check_setpoint(param, request['value'])
+        device.write(channel, [(param, value)], on_done=lambda _: reply(True), on_error=fail)
+        device.refresh()
+
+    def _cmd_hold(self, request, send, reply, fail):
+        device = self._device(request)
+        channel = self._channel(request, device)
+        device.hold_voltage(channel, on_done=reply, on_error=fail)
+        device.refresh()
+
+    def _writes(self, request, device):
+        """Validated [(channel, param, value)] of the request's writes"""
+        writes = []
+        for channel, param, value in request['writes']:
+            if param not in WRITABLE_PARAMETERS:
+                raise ValueError(f"{param} cannot be written")
+            writes.append((self._channel({'channel': channel}, device), param,
+                           check_setpoint(param, value)))
+        return writes
+
+    @staticmethod
+    def _write_results(results):
+        return [dict(result, channel=channel, param=param)
+                for (channel, param), result in results.items()]
+
+    def _cmd_set_many(self, request, send, reply, fail):
+        """Write "writes" [[channel, param, value], ...] in one job, see Device.write_many
+
+        Replies [{"channel", "param", "value", "error"}] with the read back values.
+        """
+        device = self._device(request)
+        device.write_many(self._writes(request, device),
+                          on_done=lambda results: reply(self._write_results(results)),
+                          on_error=fail)
+
+    def _cmd_apply_setpoints(self, request, send, reply, fail):
+        """Write those of "writes" that differ from the supply, see Device.apply_setpoints
+
+        Replies like set_many, with "changed" in every item.
+        """
+        device = self._device(request)
+        device.apply_setpoints(self._writes(request, device),
+                               on_done=lambda results: reply(self._write_results(results)),
+                               on_error=fail)
+
+    def _cmd_setpoints(self, request, send, reply, fail):
+        """Read every setpoint of a device, replies [{"channel", "param", "value"}]"""
+        self._device(request).read_setpoints(
+            on_done=lambda values: reply([{'channel': channel, 'param': param, 'value': value}
+                                          for (channel, param), value in values.items()]),
+            on_error=fail)
+
+    def _cmd_on(self, request, send, reply, fail):
+        device = self._device(request)
+        device.switch(self._channel(request, device), True,
+                      on_done=lambda _: reply(True), on_error=fail)
+
+    def _cmd_off(self, request, send, reply, fail):
+        device = self._device(request)
+        device.switch(self._channel(request, device), False,
+                      on_done=lambda _: reply(True), on_error=fail)
+
+    def _cmd_all_off(self, request, send, reply, fail):
+        """Emergency OFF of every device, or of "device" only
+
+        Replies {label: {channel: {"error": ..., "state": ...}}} once all answered,
+        a device whose link is down answers once it is back (or closed).
+        """
+        devices = [self._device(request)] if request.get('device') else self.devices.connected
+        for device in devices:
+            self.ramps.forget(device, "all channels off")
+            if self.sequence is not None:
+                self.sequence.forget(device, "all channels off")
+        results = {}
+
+        def done(device, result):
+            results[device.label] = result
+            if len(results) == len(devices):
+                reply(results)
+
+        if not devices:
+            reply(results)
+        for device in devices:
+            device.emergency_off(on_done=lambda result, d=device: done(d, result),
+                                 on_error=lambda e, d=device: done(d, {'error': str(e)}))
+            if getattr(device, 'off_pending', False):
+                self.logger.error(f"{device.label} {device.link.describe()}, its OFF goes out "
+                                  f"as soon as the link is back")
+
+    def _cmd_ramp(self, request, send, reply, fail):
+        device = self._device(request)
+        limit = request.get('imon_limit')
+        ramp = self.ramps.start(device, self._channel(request, device),
+                                check_setpoint('VSET', request['target']),
+                                float(request['rate']),
+                                imon_limit=None if limit is None else float(limit),
+                                limit_action=request.get('limit_action', LIMIT_HOLD))
+        reply(ramp.to_dict())
+
+    def _cmd_ramps(self, request, send, reply, fail):
+        reply([ramp.to_dict() for ramp in self.ramps.active()])
+
+    def _selected_ramps(self, request):
+        """The ramp of device/channel, all ramps of device, or all ramps"""
+        if request.get('device') is None:
+            return self.ramps.active()
+        device = self._device(request)
+        if request.get('channel') is None:
+            return self.ramps.active(device)
+        ramp = self.ramps.find(device, self._channel(request, device))
+        if ramp is None:
+            raise ValueError(f"{device.label} CH{request['channel']} is not ramping")
+        return [ramp]
+
+    def _cmd_ramp_pause(self, request, send, reply, fail):
+        for ramp in self._selected_ramps(request):
+            self.ramps.pause(ramp)
+        reply(True)
+
+    def _cmd_ramp_resume(self, request, send, reply, fail):
+        for ramp in self._selected_ramps(request):
+            self.ramps.resume(ramp)
+        reply(True)
+
+    def _cmd_ramp_abort(self, request, send, reply, fail):
+        for ramp in self._selected_ramps(request):
+            self.ramps.abort(ramp)
+        reply(True)
+
+    def _cmd_sequence_start(self, request, send, reply, fail):
+        """Run a recipe (the parsed JSON, see hv_sequence), results go to "output" as CSV"""
+        if self.sequence is not None and not self.sequence.finished:
+            raise ValueError("a sequence is already running")
+        recipe = parse_recipe(request['recipe'])
+        output = request.get('output')
+
+        def finished(sequence):
+            if output and len(sequence.results):
+                try:
+                    save_results(output, sequence.results, sequence.recipe)
+                except OSError as e:
+                    self.logger.error(f"Could not save sequence results to {output}: {e}")
+
+        self.sequence = SequenceRunner(recipe, self.devices, self.ramps,
+                                       on_progress=self._on_sequence, on_finished=finished)
+        self.sequence.start()
+        reply(True)
+
+    def _cmd_sequence_stop(self, request, send, reply, fail):
+        if self.sequence is not None:
+            self.sequence.stop()
+        reply(True)
+
+    def _cmd_sequence_status(self, request, send, reply, fail):
+        if self.sequence is None:
+            reply(None)
+            return
+        reply({'name': self.sequence.recipe['name'], 'step': self.sequence.step,
+               'state': self.sequence.state, 'message': self.sequence.message,
+               'results': self.sequence.rows()})
+
+    def _cmd_alarm_rules(self, request, send, reply, fail):
+        """Replace the alarm rules if "rules" is given, reply with the rule names"""
+        if 'rules' in request:
+            self.alarms.set_rules([AlarmRule(**item) for item in request['rules']])
+        reply([rule.name for rule in self.alarms.rules])
+
+    def _cmd_metrics(self, request, send, reply, fail):
+        if request.get('format') == "prometheus":
+            reply(self.prometheus())
+        else:
+            reply(self.metrics.rows())
+
+    def _cmd_connect(self, request, send, reply, fail):
+        self.connect_device(request.get('conn_type', "USB"), request['address'],
+                            on_done=lambda device: reply(device.label), on_error=fail)
+
+    def _cmd_disconnect(self, request, send, reply, fail):
+        device = self._device(request)
+        self.ramps.forget(device)
+        if self.sequence is not None:
+            self.sequence.forget(device)
+        self.devices.remove(device)
+        self.latest.pop(device.label, None)
+        reply(True)
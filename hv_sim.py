@@ -0,0 +1,227 @@
+"""
+Simulated CAEN desktop HV supply
+
+SimulatedSupply has the interface of CAENpy's
+CAENDesktopHighVoltagePowerSupply as far as this program uses it (query,
+get/set_single_channel_parameter, channels[ch].set, idn, channels_count)
+and answers the desktop protocol, broadcast reads included.  Every command
+waits a configurable latency plus jitter, may fail at a configurable rate,
+and the channels follow simple physics: VMON moves towards VSET at RUP/RDW
+while ON and back to 0 V at RDW when OFF, IMON is VMON over a load
+resistance plus noise, and an IMON above ISET sets OVC and trips the
+channel after TRIP seconds.
+
+Select it with transport "sim" (--transport sim in the GUI and daemon);
+the address then carries the options, e.g. "channels=4,latency=0.01,errors=0.001".
+"""
+import random
+import threading
+import time
+
+from hv_readout import CURRENT_PARAMETERS
+
+# Defaults of the options an address may set
+OPTIONS = {
+    'channels': 4,
+    # Seconds per command, plus uniform jitter in [0, jitter)
+    'latency': 0.01,
+    'jitter': 0.002,
+    # Share of commands that fail like a serial timeout
+    'errors': 0.0,
+    # Load per channel (Ohm) and IMON noise (A)
+    'load': 1e9,
+    'noise': 1e-9,
+    # False makes the firmware refuse broadcast reads, as older ones do
+    'broadcast': True,
+    'seed': None,
+}
+
+STAT_ON = 1
+STAT_RUP = 2
+STAT_RDW = 4
+STAT_OVC = 8
+STAT_TRIP = 128
+
+
+class SimulatedError(OSError):
+    """A command that the simulator let fail"""
+
+
+def parse_options(address):
+    """Options from "key=value,key=value", unknown keys raise ValueError"""
+    options = dict(OPTIONS)
+    for item in filter(None, (part.strip() for part in (address or "").split(","))):
+        key, _, value = item.partition("=")
+        if key not in OPTIONS:
+            raise ValueError(f"unknown simulator option {key!r}")
+        if key == 'broadcast':
+            options[key] = value.lower() in ("1", "true", "yes")
+        elif key in ('channels', 'seed'):
+            options[key] = int(value)
+        else:
+            options[key] = float(value)
+    return options
+
+
+class _SimChannel:
+    """State and physics of one output"""
+
+    def __init__(self):
+        self.values = {'VSET': 0.0, 'VMON': 0.0, 'ISET': 10.0, 'IMON': 0.0,
+                       'MAXV': 8000.0, 'RUP': 10.0, 'RDW': 10.0, 'TRIP': 1.0}
+        self.on = False
+        self.tripped = False
+        self.over_since = None
+        self.direction = 0
+
+    def advance(self, dt, now, load, noise, rng):
+        vmon = self.values['VMON']
+        target = min(self.values['VSET'], self.values['MAXV']) if self.on else 0.0
+        if target > vmon:
+            vmon = min(vmon + self.values['RUP'] * dt, target)
+        elif target < vmon:
+            vmon = max(vmon - self.values['RDW'] * dt, target)
+        self.direction = (target > vmon) - (target < vmon)
+        self.values['VMON'] = vmon
+        # Currents are kept in microamps, as the supply reports them
+        imon = max(vmon / load + rng.gauss(0.0, noise), 0.0) * 1e6
+        self.values['IMON'] = imon
+        if self.on and imon > self.values['ISET']:
+            if self.over_since is None:
+                self.over_since = now
+            elif now - self.over_since >= self.values['TRIP']:
+                self.on = False
+                self.tripped = True
+        else:
+            self.over_since = None
+
+    @property
+    def status(self):
+        word = STAT_ON if self.on else 0
+        if self.direction > 0:
+            word |= STAT_RUP
+        elif self.direction < 0:
+            word |= STAT_RDW
+        if self.over_since is not None:
+            word |= STAT_OVC
+        if self.tripped:
+            word |= STAT_TRIP
+        return word
+
+
+class _Channel:
+    def __init__(self, supply, channel):
+        self.supply = supply
+        self.channel = channel
+
+    def set(self, param, value):
+        self.supply.set_single_channel_parameter(param, self.channel, value)
+
+
+class SimulatedSupply:
+    """In-process stand-in for a DT8034N, safe to share between threads"""
+
+    def __init__(self, address="", **options):
+        self.options = dict(parse_options(address), **options)
+        self.rng = random.Random(self.options['seed'])
+        self.channels_count = self.options['channels']
+        self.serial_number = self.rng.randrange(10000)
+        self.channels = [_Channel(self, ch) for ch in range(self.channels_count)]
+        self.commands = 0
+        self._state = [_SimChannel() for _ in range(self.channels_count)]
+        self._lock = threading.Lock()
+        self._last = time.monotonic()
+
+    @property
+    def idn(self):
+        return f"CAEN DT8034N (simulated), SN:{self.serial_number}"
+
+    def query(self, CMD, PAR, CH=None, VAL=None, BD=0):
+        """Answer one protocol command like the supply would"""
+        with self._lock:
+            self._transaction()
+            if CMD == 'MON' and CH is None:
+                value = self._board(PAR)
+                if value is None:
+                    return f"#BD:{BD:02d},CMD:ERR"
+                return f"#BD:{BD:02d},CMD:OK,VAL:{value}"
+            channels = self._addressed(CH)
+            if channels is None:
+                return f"#BD:{BD:02d},CMD:ERR"
+            if CMD == 'MON':
+                values = [self._read(ch, PAR) for ch in channels]
+                if None in values:
+                    return f"#BD:{BD:02d},CMD:ERR"
+                return f"#BD:{BD:02d},CMD:OK,VAL:{';'.join(values)}"
+            if CMD == 'SET':
+                for ch in channels:
+                    if not self._write(ch, PAR, VAL):
+                        return f"#BD:{BD:02d},CMD:ERR"
+                return f"#BD:{BD:02d},CMD:OK"
+            return f"#BD:{BD:02d},CMD:ERR"
+
+    def get_single_channel_parameter(self, param, channel):
+        response = self.query('MON', param, CH=channel)
+        if 'CMD:OK' not in response:
+            raise RuntimeError(f"error reading {param}: {response}")
+        return float(response.split('VAL:')[-1])
+
+    def set_single_channel_parameter(self, param, channel, value):
+        response = self.query('SET', param, CH=channel, VAL=value)
+        if 'CMD:OK' not in response:
+            raise RuntimeError(f"error setting {param}: {response}")
+
+    def close(self):
+        pass
+
+    def _transaction(self):
+        options = self.options
+        self.commands += 1
+        delay = options['latency'] + self.rng.random() * options['jitter']
+        if delay > 0:
+            time.sleep(delay)
+        self._advance()
+        if options['errors'] and self.rng.random() < options['errors']:
+            raise SimulatedError("simulated timeout")
+
+    def _advance(self):
+        now = time.monotonic()
+        dt, self._last = now - self._last, now
+        for channel in self._state:
+            channel.advance(dt, now, self.options['load'], self.options['noise'], self.rng)
+
+    def _addressed(self, CH):
+        if CH is None:
+            return []
+        CH = int(CH)
+        if CH == self.channels_count and self.options['broadcast']:
+            return range(self.channels_count)
+        if 0 <= CH < self.channels_count:
+            return [CH]
+        return None
+
+    def _board(self, param):
+        return {'BDNAME': "DT8034N", 'BDNCH': str(self.channels_count),
+                'BDSNUM': str(self.serial_number), 'BDFREL': "sim"}.get(param)
+
+    def _read(self, ch, param):
+        channel = self._state[ch]
+        if param == 'STAT':
+            return str(channel.status)
+        value = channel.values.get(param)
+        if value is None:
+            return None
+        return f"{value:.4f}" if param in CURRENT_PARAMETERS else f"{value:.1f}"
+
+    def _write(self, ch, param, value):
+        channel = self._state[ch]
+        if param == 'ON':
+            channel.on = True
+            channel.tripped = False
+        elif param == 'OFF':
+            channel.on = False
+        elif param in channel.values and param != 'VMON' and param != 'IMON':
+            channel.values[param] = float(value)
+        else:
+            return False
+        return True
@@ -0,0 +1,247 @@
+"""
+Asyncio transport for CAEN desktop HV power supplies
+
+The CAENpy handle does blocking reads on its serial port or socket, so a
+supply that stops answering holds its I/O thread until the library gives
+up.  Here the ASCII protocol ("$BD:00,CMD:MON,CH:4,PAR:VMON" answered by
+"#BD:00,CMD:OK,VAL:...") is spoken directly on one shared asyncio loop:
+
+    link = await AsyncLink.open("Ethernet", "192.168.1.100")
+    response = await link.query('MON', 'VMON', CH=4, timeout=1.0)
+
+Every command is a future with its own timeout that can be cancelled; the
+links of all devices are multiplexed on the one loop thread.  A command that
+times out or is cancelled leaves its late answer in the stream, so the link
+discards pending input before the next command.
+
+AsyncSupply wraps a link in the blocking interface of the CAENpy handle, so
+DeviceWorker and the readers run unchanged on top of it.
+"""
+import asyncio
+import concurrent.futures
+import os
+import threading
+
+try:
+    import serial
+except ImportError:
+    serial = None
+
+# TCP port of the desktop supplies' ASCII protocol
+TCP_PORT = 1470
+
+# Seconds to wait for the answer to one command
+COMMAND_TIMEOUT = 2.0
+
+BAUDRATE = 9600
+
+
+class CAENCommandError(Exception):
+    """The supply answered a command with an error"""
+
+
+def format_command(CMD, PAR, CH=None, VAL=None, BD=0):
+    """Encode one command of the desktop protocol"""
+    command = f"$BD:{BD:02d},CMD:{CMD}"
+    if CH is not None:
+        command += f",CH:{CH}"
+    command += f",PAR:{PAR}"
+    if VAL is not None:
+        command += f",VAL:{VAL}"
+    return (command + "\r\n").encode('ascii')
+
+
+def parse_value(response):
+    """Value of a "#BD:00,CMD:OK,VAL:..." answer, raises CAENCommandError otherwise"""
+    if 'CMD:OK' not in response:
+        raise CAENCommandError(response)
+    value = response.split('VAL:')[-1] if 'VAL:' in response else None
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+class _IOLoop:
+    """The asyncio loop shared by all links, running on its own daemon thread"""
+
+    _lock = threading.Lock()
+    _loop = None
+
+    @classmethod
+    def get(cls):
+        with cls._lock:
+            if cls._loop is None:
+                cls._loop = asyncio.new_event_loop()
+                threading.Thread(target=cls._loop.run_forever, name="hv-aio",
+                                 daemon=True).start()
+            return cls._loop
+
+
+def io_loop():
+    """The shared transport loop, started on first use"""
+    return _IOLoop.get()
+
+
+def run(coro, timeout=None):
+    """Run a coroutine on the transport loop from another thread and wait for it"""
+    future = asyncio.run_coroutine_threadsafe(coro, io_loop())
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise
+
+
+class AsyncLink:
+    """One serial or TCP link to a supply, commands are awaited one at a time"""
+
+    def __init__(self, reader, writer, name):
+        self.reader = reader
+        self.writer = writer
+        self.name = name
+        self._lock = asyncio.Lock()
+        self._dirty = False
+
+    @classmethod
+    async def open(cls, conn_type, address, timeout=COMMAND_TIMEOUT):
+        """Connect over USB (serial port) or Ethernet (IP address, optionally ip:port)"""
+        if conn_type == "USB":
+            reader, writer = await _open_serial(address)
+        else:
+            host, _, port = address.partition(":")
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, int(port or TCP_PORT)), timeout)
+        return cls(reader, writer, address)
+
+    async def query(self, CMD, PAR, CH=None, VAL=None, BD=0, timeout=COMMAND_TIMEOUT):
+        """Send one command and return the raw answer line"""
+        async with self._lock:
+            if self._dirty:
+                await self._discard_input()
+            self.writer.write(format_command(CMD, PAR, CH, VAL, BD))
+            try:
+                await self.writer.drain()
+                line = await asyncio.wait_for(self.reader.readuntil(b"\r\n"), timeout)
+            except asyncio.IncompleteReadError:
+                raise ConnectionError(f"{self.name} closed the connection") from None
+            except BaseException:
+                # The answer may still arrive, it must not be taken for the next one
+                self._dirty = True
+                raise
+            return line.decode('ascii', errors='replace').strip()
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+    async def _discard_input(self):
+        # Give a late answer a moment to arrive, then drop whatever is buffered
+        await asyncio.sleep(0.05)
+        while True:
+            try:
+                data = await asyncio.wait_for(self.reader.read(4096), 0.01)
+            except asyncio.TimeoutError:
+                break
+            # At EOF read() returns b'' at once, looping on it would starve the shared loop
+            if not data or self.reader.at_eof():
+                raise ConnectionError(f"{self.name} closed the connection")
+        self._dirty = False
+
+
+class _SerialWriter:
+    """The writer half of a serial link, with the StreamWriter methods AsyncLink uses"""
+
+    def __init__(self, port, loop):
+        self.port = port
+        self.loop = loop
+
+    def write(self, data):
+        # Commands are a few dozen bytes, the tty buffer always takes them whole
+        os.write(self.port.fileno(), data)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.loop.remove_reader(self.port.fileno())
+        self.port.close()
+
+    async def wait_closed(self):
+        pass
+
+
+async def _open_serial(port):
+    if serial is None:
+        raise RuntimeError("pyserial is needed for USB links with the asyncio transport")
+    loop = asyncio.get_running_loop()
+    device = serial.Serial(port=port, baudrate=BAUDRATE, timeout=0)
+    os.set_blocking(device.fileno(), False)
+    reader = asyncio.StreamReader()
+
+    def readable():
+        try:
+            data = os.read(device.fileno(), 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            loop.remove_reader(device.fileno())
+            reader.set_exception(e)
+            return
+        if data:
+            reader.feed_data(data)
+        else:
+            loop.remove_reader(device.fileno())
+            reader.feed_eof()
+
+    loop.add_reader(device.fileno(), readable)
+    return reader, _SerialWriter(device, loop)
+
+
+class _Channel:
+    def __init__(self, supply, channel):
+        self.supply = supply
+        self.channel = channel
+
+    def set(self, param, value):
+        self.supply.set_single_channel_parameter(param, self.channel, value)
+
+
+class AsyncSupply:
+    """Blocking handle with the interface of the CAENpy supply, served by an AsyncLink"""
+
+    def __init__(self, conn_type, address, timeout=COMMAND_TIMEOUT):
+        self.timeout = timeout
+        self.link = run(AsyncLink.open(conn_type, address, timeout), timeout + 1.0)
+        self.channels_count = int(self.get_single_channel_parameter('BDNCH'))
+        self.channels = [_Channel(self, ch) for ch in range(self.channels_count)]
+
+    @property
+    def idn(self):
+        name = self.get_single_channel_parameter('BDNAME')
+        serial_number = self.get_single_channel_parameter('BDSNUM')
+        if isinstance(serial_number, float):
+            serial_number = int(serial_number)
+        return f"CAEN {name}, SN:{serial_number}"
+
+    def query(self, CMD, PAR, CH=None, VAL=None, BD=0):
+        # The command timeout cancels the read on the loop, the outer one only backs it up
+        return run(self.link.query(CMD, PAR, CH, VAL, BD, timeout=self.timeout),
+                   self.timeout + 1.0)
+
+    def get_single_channel_parameter(self, param, channel=None):
+        return parse_value(self.query('MON', param, CH=channel))
+
+    def set_single_channel_parameter(self, param, channel, value):
+        # ON and OFF take no value
+        if param in ('ON', 'OFF'):
+            value = None
+        parse_value(self.query('SET', param, CH=channel, VAL=value))
+
+    def close(self):
+        run(self.link.close(), self.timeout)
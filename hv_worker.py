@@ -0,0 +1,115 @@
+"""
+Device I/O worker for CAEN desktop HV power supplies
+
+All traffic to a supply goes through one long-lived thread that owns the
+device handle, so serial/TCP transactions never interleave.  Commands are
+served by priority: safety commands (OFF) first, then setpoint writes, then
+monitoring reads.  Results are handed back through a single deliver callable
+so the caller decides which thread runs the callbacks.
+"""
+import itertools
+import queue
+import threading
+
+# Command priorities, lower runs first
+PRIORITY_SAFETY = 0
+PRIORITY_WRITE = 1
+PRIORITY_READ = 2
+
+
+class DeviceWorker:
+    """Thread that owns the device handle and runs queued commands in priority order"""
+
+    def __init__(self, deliver, name="hv-io"):
+        # deliver(callback, *args) must hand the call over to the consumer thread
+        self.deliver = deliver
+        self.hv = None
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._safety_pending = 0
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    @property
+    def connected(self):
+        return self.hv is not None
+
+    def submit(self, priority, func, on_done=None, on_error=None):
+        """Queue func(hv), on_done(result) or on_error(exception) are delivered afterwards"""
+        self._put(priority, (func, on_done, on_error, True))
+
+    def open(self, factory, func=None, on_done=None, on_error=None):
+        """Create the device handle with factory() and run func(hv) right after it"""
+        def open_job(_):
+            if self.hv is not None:
+                self._close_handle()
+            self.hv = factory()
+            return func(self.hv) if func else None
+
+        self._put(PRIORITY_WRITE, (open_job, on_done, on_error, False))
+
+    def close(self, on_done=None):
+        """Release the device handle once the commands queued before it are done"""
+        self._put(PRIORITY_WRITE, (lambda _: self._close_handle(), on_done, None, False))
+
+    def stop(self, timeout=2.0, after_queued=False):
+        """Close the handle after pending safety commands and end the thread
+
+        Commands queued behind the stop get on_error(ConnectionError).  With
+        after_queued the stop waits for every command already queued instead,
+        writes included.
+        """
+        self._put(PRIORITY_READ + 1 if after_queued else PRIORITY_SAFETY, None)
+        self._thread.join(timeout)
+
+    def safety_pending(self):
+        """True while a safety command is waiting, long reads should give way to it"""
+        return self._safety_pending > 0
+
+    def _put(self, priority, job):
+        if priority == PRIORITY_SAFETY and job is not None:
+            with self._lock:
+                self._safety_pending += 1
+        self._queue.put((priority, next(self._seq), job))
+
+    def _close_handle(self):
+        hv, self.hv = self.hv, None
+        if hv is not None and hasattr(hv, 'close'):
+            hv.close()
+
+    def _fail_pending(self):
+        """Answer the commands still queued once the thread ends"""
+        while True:
+            try:
+                _, _, job = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if job is not None and job[2] is not None:
+                self.deliver(job[2], ConnectionError("device worker stopped"))
+
+    def _run(self):
+        while True:
+            priority, _, job = self._queue.get()
+            if job is None:
+                try:
+                    self._close_handle()
+                except Exception:
+                    pass
+                self._fail_pending()
+                return
+            if priority == PRIORITY_SAFETY:
+                with self._lock:
+                    self._safety_pending -= 1
+
+            func, on_done, on_error, needs_handle = job
+            try:
+                if needs_handle and self.hv is None:
+                    raise RuntimeError("Not connected to device")
+                result = func(self.hv)
+            except Exception as e:
+                if on_error:
+                    self.deliver(on_error, e)
+                continue
+            if on_done:
+                self.deliver(on_done, result)